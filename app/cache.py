@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from fastapi import UploadFile
+from redis.asyncio import Redis
+
+from app.metrics import CACHE_LOOKUPS, REDIS_STORE_SECONDS
+from app.storage import CHUNK_SIZE, iter_redis_value
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Total size of cached results kept in Redis before the least recently used
+# entries are evicted
+CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# How long a process may hold the compute lock for a cache key. Must outlive
+# the ESRGAN request, otherwise a second process would start the same job.
+CACHE_LOCK_TTL = int(os.getenv("REQUEST_TIMEOUT", "300")) + 30
+
+# How often processes waiting on another process's inference check for it
+CACHE_POLL_INTERVAL = float(os.getenv("RESULT_CACHE_POLL_INTERVAL", "0.5"))
+
+CACHE_INDEX_KEY = "cache:index"
+CACHE_BYTES_KEY = "cache:bytes"
+CACHE_STATS_KEY = "cache:stats"
+
+# Parameters the ESRGAN service currently upscales with. They are part of the
+# cache key so changing them never serves a result produced with other settings.
+DEFAULT_PARAMS: Dict[str, Any] = {"model": "RealESRGAN_x4plus", "scale": 4}
+
+# Models a request may ask ESRGAN for by name, with their native scale
+MODELS: Dict[str, int] = {
+    "RealESRGAN_x4plus": 4,
+    "RealESRGAN_x2plus": 2,
+    "RealESRGAN_x4plus_anime_6B": 4,
+    "realesr-general-x4v3": 4,
+}
+
+
+def upscale_params(output: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Cache key parameters of an upscale with the given options (model, scale,
+    width, height). Without any, they are DEFAULT_PARAMS as before the options
+    existed, so earlier results are still found.
+    """
+    output = dict(output or {})
+    model = output.pop("model", None)
+    params = {"model": model, "scale": MODELS[model]} if model else DEFAULT_PARAMS
+    return {**params, "output": output} if output else params
+
+
+# In-process single-flight: cache key -> future set when its inference ends
+_inflight: Dict[str, "asyncio.Future[None]"] = {}
+
+
+def cache_key(image_data: bytes, params: Dict[str, Any]) -> str:
+    """Content address of an upscale: hash of the input bytes and parameters"""
+    digest = hashlib.sha256(image_data)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+async def upload_cache_key(image: UploadFile, params: Dict[str, Any]) -> str:
+    """cache_key for an upload, hashed in chunks and rewound for re-reading"""
+    digest = hashlib.sha256()
+    while chunk := await image.read(CHUNK_SIZE):
+        digest.update(chunk)
+    await image.seek(0)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+async def cached_upscale(
+    redis: Redis,
+    image_data: bytes,
+    compute: Callable[[], Awaitable[bytes]],
+    params: Optional[Dict[str, Any]] = None,
+) -> bytes:
+    """Return the upscaled image for image_data, running compute() only on a miss"""
+
+    async def compute_chunks() -> AsyncIterator[bytes]:
+        yield await compute()
+
+    key = cache_key(image_data, params or DEFAULT_PARAMS)
+    return b"".join(
+        [chunk async for chunk in stream_cached(redis, key, compute_chunks)]
+    )
+
+
+async def stream_cached(
+    redis: Redis, key: str, compute: Callable[[], AsyncIterator[bytes]]
+) -> AsyncIterator[bytes]:
+    """
+    Stream the cached result for key, running compute() only on a miss.
+
+    On a miss the computed chunks are passed through to the caller while being
+    appended to the cache, so neither side holds the whole result in memory.
+    Identical concurrent requests share a single inference: within a process
+    they wait on the leader's future, across processes on a Redis lock, and then
+    stream the stored result.
+    """
+    entry_key = f"cache:entry:{key}"
+    lock_key = f"cache:lock:{key}"
+
+    inflight = _inflight.get(key)
+    if inflight is not None:
+        logger.info(f"Cache {key[:12]}: joining in-flight inference")
+        CACHE_LOOKUPS.labels("coalesced").inc()
+        await redis.hincrby(CACHE_STATS_KEY, "coalesced", 1)
+        await asyncio.shield(inflight)
+
+    while True:
+        size = await redis.strlen(entry_key)
+        if size:
+            logger.info(f"Cache {key[:12]}: hit ({size} bytes)")
+            CACHE_LOOKUPS.labels("hit").inc()
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(CACHE_INDEX_KEY, {key: time.time()})
+                pipe.hincrby(CACHE_STATS_KEY, "hits", 1)
+                await pipe.execute()
+            async for chunk in iter_redis_value(redis, entry_key, size):
+                yield chunk
+            return
+
+        if await redis.set(lock_key, b"1", nx=True, ex=CACHE_LOCK_TTL):
+            break
+
+        # Another process is running this inference; wait for its result
+        await asyncio.sleep(CACHE_POLL_INTERVAL)
+
+    logger.info(f"Cache {key[:12]}: miss")
+    CACHE_LOOKUPS.labels("miss").inc()
+    await redis.hincrby(CACHE_STATS_KEY, "misses", 1)
+
+    future: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    partial_key = f"cache:partial:{key}:{uuid.uuid4()}"
+    try:
+        size = 0
+        async for chunk in compute():
+            yield chunk
+            size += len(chunk)
+            if size <= CACHE_MAX_BYTES:
+                async with redis.pipeline(transaction=False) as pipe:
+                    pipe.append(partial_key, chunk)
+                    pipe.expire(partial_key, CACHE_LOCK_TTL)
+                    await pipe.execute()
+        if 0 < size <= CACHE_MAX_BYTES:
+            with REDIS_STORE_SECONDS.labels("cache").time():
+                await _store(redis, key, partial_key, size)
+    finally:
+        # Followers re-check the cache once the leader is done, whatever happened
+        future.set_result(None)
+        _inflight.pop(key, None)
+        await redis.delete(partial_key, lock_key)
+
+
+async def _store(redis: Redis, key: str, partial_key: str, size: int) -> None:
+    if not await redis.renamenx(partial_key, f"cache:entry:{key}"):
+        return
+
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zadd(CACHE_INDEX_KEY, {key: time.time()})
+        pipe.incrby(CACHE_BYTES_KEY, size)
+        await pipe.execute()
+
+    await _evict(redis)
+
+
+async def _evict(redis: Redis) -> None:
+    """Drop least recently used entries until the cache fits its byte budget"""
+    while int(await redis.get(CACHE_BYTES_KEY) or 0) > CACHE_MAX_BYTES:
+        oldest = await redis.zpopmin(CACHE_INDEX_KEY)
+        if not oldest:
+            break
+        key = oldest[0][0].decode()
+        entry_key = f"cache:entry:{key}"
+        size = await redis.strlen(entry_key)
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.delete(entry_key)
+            pipe.decrby(CACHE_BYTES_KEY, size)
+            pipe.hincrby(CACHE_STATS_KEY, "evictions", 1)
+            await pipe.execute()
+        logger.info(f"Cache {key[:12]}: evicted ({size} bytes)")
+
+
+async def cache_stats(redis: Redis) -> Dict[str, int]:
+    """Hit/miss counters and current size of the result cache"""
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hgetall(CACHE_STATS_KEY)
+        pipe.zcard(CACHE_INDEX_KEY)
+        pipe.get(CACHE_BYTES_KEY)
+        stats, entries, size = await pipe.execute()
+
+    return {
+        "hits": int(stats.get(b"hits", 0)),
+        "misses": int(stats.get(b"misses", 0)),
+        "coalesced": int(stats.get(b"coalesced", 0)),
+        "evictions": int(stats.get(b"evictions", 0)),
+        "entries": entries,
+        "bytes": int(size or 0),
+        "max_bytes": CACHE_MAX_BYTES,
+    }
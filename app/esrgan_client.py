@@ -0,0 +1,281 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from app.metrics import ESRGAN_OUTSTANDING, ESRGAN_REQUEST_SECONDS, ESRGAN_REQUESTS
+from app.storage import CHUNK_SIZE
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "300"))
+
+# How often each backend's /health is checked, in seconds
+HEALTH_INTERVAL = float(os.getenv("ESRGAN_HEALTH_INTERVAL", "10"))
+
+# Consecutive failures that open a backend's circuit, and how long it stays
+# open before a single trial request is let through
+CIRCUIT_FAILURES = int(os.getenv("ESRGAN_CIRCUIT_FAILURES", "3"))
+CIRCUIT_COOLDOWN = float(os.getenv("ESRGAN_CIRCUIT_COOLDOWN", "30"))
+
+
+def backend_urls() -> List[str]:
+    """ESRGAN base URLs from ESRGAN_BACKENDS, or ESRGAN_HOST/ESRGAN_PORT"""
+    backends = os.getenv("ESRGAN_BACKENDS", "")
+    if not backends:
+        host = os.getenv("ESRGAN_HOST", "esrgan")
+        port = os.getenv("ESRGAN_PORT", "8001")
+        backends = f"{host}:{port}"
+    return [
+        url if url.startswith("http") else f"http://{url}"
+        for url in (backend.strip() for backend in backends.split(","))
+        if url
+    ]
+
+
+class EsrganUnavailableError(Exception):
+    """No ESRGAN backend can take the request right now"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class EsrganProcessingError(Exception):
+    """ESRGAN accepted an image but failed while processing it"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Called with the tiles done and the total as ESRGAN works through an image
+OnProgress = Callable[[int, int], Awaitable[None]]
+
+
+async def read_progress_frames(
+    chunks: AsyncIterator[bytes], on_progress: OnProgress
+) -> bytes:
+    """The JPEG from an ESRGAN progress response, reporting progress lines on the way"""
+    buffer = bytearray()
+    size: Optional[int] = None
+    async for chunk in chunks:
+        buffer += chunk
+        while size is None and b"\n" in buffer:
+            line, _, rest = bytes(buffer).partition(b"\n")
+            buffer = bytearray(rest)
+            frame = json.loads(line)
+            if "error" in frame:
+                raise EsrganProcessingError(frame["error"], frame["status"])
+            if "size" in frame:
+                size = frame["size"]
+            else:
+                await on_progress(frame["tiles_done"], frame["tiles_total"])
+    if size is None or len(buffer) != size:
+        raise EsrganProcessingError("ESRGAN response ended early", 502)
+    return bytes(buffer)
+
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    def available(self) -> bool:
+        if not self.healthy:
+            return False
+        if self.opened_at is None:
+            return True
+        # Half-open: let one trial request through once the cooldown is over
+        return (
+            time.monotonic() - self.opened_at >= CIRCUIT_COOLDOWN
+            and not self.trial_in_flight
+        )
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info(f"ESRGAN backend {self.url}: circuit closed")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= CIRCUIT_FAILURES:
+            logger.warning(f"ESRGAN backend {self.url}: circuit open")
+            self.opened_at = time.monotonic()
+
+
+class EsrganClient:
+    """
+    Long-lived, pooled client for one or more ESRGAN backends.
+
+    Requests go to the available backend with the fewest outstanding requests.
+    Backends failing /health are taken out of rotation, and each backend has a
+    circuit breaker that opens after repeated request failures.
+    """
+
+    def __init__(self, urls: List[str]):
+        self.backends = [Backend(url) for url in urls]
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60),
+        )
+        self._health_task: Optional[asyncio.Task] = None
+
+    def _pick(self, exclude: List[Backend]) -> Optional[Backend]:
+        candidates = [
+            backend
+            for backend in self.backends
+            if backend not in exclude and backend.available()
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: backend.outstanding)
+
+    async def upscale(
+        self,
+        image_data: bytes,
+        content_type: str,
+        on_progress: Optional[OnProgress] = None,
+        output: Optional[Dict[str, Any]] = None,
+    ) -> bytes:
+        """
+        Send image data to an ESRGAN backend and return the upscaled JPEG.
+
+        on_progress, if given, is awaited as ESRGAN finishes each tile. output
+        holds the options (model, scale, width, height) passed on to ESRGAN.
+        """
+
+        async def body() -> AsyncIterator[bytes]:
+            yield image_data
+
+        chunks = self.upscale_stream(
+            body, content_type, progress=bool(on_progress), output=output
+        )
+        if on_progress:
+            return await read_progress_frames(chunks, on_progress)
+        return b"".join([chunk async for chunk in chunks])
+
+    async def upscale_stream(
+        self,
+        body: Callable[[], AsyncIterator[bytes]],
+        content_type: str,
+        progress: bool = False,
+        output: Optional[Dict[str, Any]] = None,
+    ) -> AsyncIterator[bytes]:
+        """
+        Stream image data to an ESRGAN backend and stream back the upscaled JPEG.
+
+        body is called once per attempt, so a request can be resent to another
+        backend when the first one cannot be reached. With progress, the
+        response is ESRGAN's progress stream instead of the bare JPEG. output
+        holds the options (model, scale, width, height) passed on to ESRGAN.
+        """
+        self._ensure_health_checks()
+        params = {key: str(value) for key, value in (output or {}).items()}
+        if progress:
+            params["progress"] = "true"
+
+        tried: List[Backend] = []
+        retry_after = int(CIRCUIT_COOLDOWN)
+        while True:
+            backend = self._pick(tried)
+            if backend is None:
+                raise EsrganUnavailableError("No ESRGAN backend available", retry_after)
+            tried.append(backend)
+
+            trial = backend.opened_at is not None
+            backend.trial_in_flight = trial
+            backend.outstanding += 1
+            ESRGAN_OUTSTANDING.labels(backend.url).inc()
+            start = time.perf_counter()
+            try:
+                async with self._client.stream(
+                    "POST",
+                    f"{backend.url}/upscale",
+                    params=params or None,
+                    content=body(),
+                    headers={"Content-Type": content_type or "image/jpeg"},
+                ) as response:
+                    if response.status_code == 503:
+                        # Backend is busy, not broken: try another one
+                        ESRGAN_REQUESTS.labels(backend.url, "busy").inc()
+                        retry_after = int(
+                            response.headers.get("Retry-After", retry_after)
+                        )
+                        backend.record_success()
+                        continue
+                    if response.status_code >= 500:
+                        backend.record_failure()
+                    else:
+                        backend.record_success()
+                    if response.is_error:
+                        outcome = f"{response.status_code // 100}xx"
+                        ESRGAN_REQUESTS.labels(backend.url, outcome).inc()
+                        await response.aread()
+                        response.raise_for_status()
+
+                    # Progress lines are passed on as they arrive, not once a
+                    # chunk's worth has built up
+                    chunk_size = None if progress else CHUNK_SIZE
+                    async for chunk in response.aiter_bytes(chunk_size):
+                        yield chunk
+                    ESRGAN_REQUESTS.labels(backend.url, "ok").inc()
+                    ESRGAN_REQUEST_SECONDS.labels(backend.url).observe(
+                        time.perf_counter() - start
+                    )
+                    return
+            except httpx.TransportError as e:
+                ESRGAN_REQUESTS.labels(backend.url, "transport_error").inc()
+                backend.record_failure()
+                logger.warning(f"ESRGAN backend {backend.url} failed: {e}")
+                # Only a request that never reached the backend is safe to resend
+                if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)):
+                    continue
+                raise
+            finally:
+                backend.outstanding -= 1
+                ESRGAN_OUTSTANDING.labels(backend.url).dec()
+                if trial:
+                    backend.trial_in_flight = False
+
+    def _ensure_health_checks(self) -> None:
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.gather(
+                *(self._check_health(backend) for backend in self.backends)
+            )
+            await asyncio.sleep(HEALTH_INTERVAL)
+
+    async def _check_health(self, backend: Backend) -> None:
+        try:
+            response = await self._client.get(f"{backend.url}/health", timeout=5.0)
+            # A backend still loading its model reports "starting"
+            healthy = (
+                response.status_code == 200
+                and response.json().get("status") == "healthy"
+            )
+        except (httpx.HTTPError, ValueError):
+            # Unreachable, or answering with something other than JSON
+            healthy = False
+
+        if healthy != backend.healthy:
+            state = "back in rotation" if healthy else "out of rotation"
+            logger.warning(f"ESRGAN backend {backend.url}: {state}")
+        backend.healthy = healthy
+
+
+esrgan = EsrganClient(backend_urls())
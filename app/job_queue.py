@@ -0,0 +1,376 @@
+import json
+import logging
+import math
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
+
+from app.task_store import TASK_TTL
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Jobs wait in one lane per priority, served in this order: cheap jobs are
+# never stuck behind large ones. Each lane is a sorted set of task IDs scored
+# by a virtual start time (start-time fair queuing): a client's job starts
+# after its previous job, so a client submitting many jobs only delays its own
+# work, not that of clients submitting a few.
+LANES = ("interactive", "bulk")
+# Job fields by task ID, the virtual time of the last job started, and the
+# virtual time each client's queued work ends at
+JOBS_KEY = "queue:jobs"
+VIRTUAL_TIME_KEY = "queue:vtime"
+CLIENT_FINISH_KEY = "queue:clients"
+# Jobs waiting out a retry backoff, scored by when they are due
+RETRY_KEY = "queue:retry"
+# Pushed on every enqueue so idle workers wake up without polling
+WAKEUP_KEY = "queue:wakeup"
+# Estimated cost of every admitted job not finished yet, their total, and
+# the total per client
+COSTS_KEY = "queue:costs"
+BACKLOG_KEY = "queue:backlog"
+CLIENT_BACKLOG_KEY = "queue:backlog:clients"
+
+# Where jobs were queued before lanes existed; moved over by migrate_stream
+STREAM_KEY = "upscale:jobs"
+LEGACY_RETRY_KEY = "upscale:retry"
+
+# A job that has not been acked or heartbeated for this long is considered
+# abandoned (its worker died) and is re-queued for another worker
+VISIBILITY_TIMEOUT = int(
+    os.getenv(
+        "QUEUE_VISIBILITY_TIMEOUT", str(int(os.getenv("REQUEST_TIMEOUT", "300")) + 60)
+    )
+)
+
+# Attempts per job before it is marked as failed, and the base retry delay in
+# seconds (doubled after every failed attempt)
+MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF = float(os.getenv("QUEUE_RETRY_BACKOFF", "5"))
+
+# Jobs estimated to take at most this many seconds go to the interactive lane
+INTERACTIVE_MAX_SECONDS = float(os.getenv("QUEUE_INTERACTIVE_MAX_SECONDS", "10"))
+# Bulk jobs running at once over all workers, leaving the other ESRGAN slots
+# to interactive and sync requests; 0 for no limit
+BULK_MAX_RUNNING = int(os.getenv("QUEUE_BULK_MAX_RUNNING", "0"))
+
+# Estimated seconds of work the queue may hold, in total and per client, and
+# the number of jobs processed at once over all workers, which it drains at
+BACKLOG_MAX_SECONDS = float(os.getenv("QUEUE_BACKLOG_MAX_SECONDS", "3600"))
+CLIENT_BACKLOG_MAX_SECONDS = float(
+    os.getenv("QUEUE_CLIENT_BACKLOG_MAX_SECONDS", "1800")
+)
+PARALLELISM = int(os.getenv("QUEUE_PARALLELISM", "1"))
+
+
+class QueueFullError(Exception):
+    """The queue cannot take a job without exceeding its backlog budget"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def lane_key(lane: str) -> str:
+    return f"queue:{lane}"
+
+
+def running_key(lane: str) -> str:
+    """Task IDs of a lane's running jobs, scored by when their lease runs out"""
+    return f"queue:{lane}:running"
+
+
+def seconds(value: Optional[bytes]) -> float:
+    """A stored backlog total, without the residue of adding and removing floats"""
+    return max(0.0, round(float(value or 0), 3))
+
+
+def lane_for(cost: float) -> str:
+    return "interactive" if cost <= INTERACTIVE_MAX_SECONDS else "bulk"
+
+
+def check_budgets(backlog: float, client_backlog: float, cost: float) -> None:
+    """
+    Check that a job of the given estimated cost fits the backlog budgets.
+
+    Raises QueueFullError with the seconds until enough of the backlog has
+    drained. A job is always admitted into an empty backlog, however large.
+    """
+    # Seconds of work beyond each budget, were the job admitted. The whole
+    # backlog drains PARALLELISM jobs at a time; a client's own work is served
+    # by at least one worker.
+    if backlog > 0:
+        excess = (backlog + cost) / PARALLELISM - BACKLOG_MAX_SECONDS
+        if excess > 0:
+            raise QueueFullError(
+                f"Queue is full ({backlog:.0f}s of work queued)",
+                max(1, math.ceil(excess)),
+            )
+    if client_backlog > 0:
+        excess = client_backlog + cost - CLIENT_BACKLOG_MAX_SECONDS
+        if excess > 0:
+            raise QueueFullError(
+                f"Too much work queued for this client ({client_backlog:.0f}s)",
+                max(1, math.ceil(excess)),
+            )
+
+
+async def admit(redis: Redis, client: str, cost: float) -> None:
+    """
+    Turn away a job that does not fit the backlog budgets before anything is
+    stored for it. enqueue checks again as it queues the job, which is final.
+    """
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.get(BACKLOG_KEY)
+        pipe.hget(CLIENT_BACKLOG_KEY, client)
+        backlog, client_backlog = await pipe.execute()
+    check_budgets(seconds(backlog), seconds(client_backlog), cost)
+
+
+async def enqueue(
+    redis: Redis,
+    task_id: str,
+    image_data: bytes,
+    content_type: str,
+    client: str = "",
+    cost: float = 0.0,
+    output: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Persist the upload and queue the task in the lane for its cost. output holds
+    the options (model, scale, width, height) the worker passes on to ESRGAN.
+
+    The backlog budgets are checked in the same transaction that adds the cost
+    to the backlog, so concurrent uploads cannot all fit the same room; raises
+    QueueFullError, with nothing stored, when the job does not fit.
+    """
+    lane = lane_for(cost)
+    async with redis.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                # Any change to these from here to the writes aborts and retries
+                await pipe.watch(
+                    BACKLOG_KEY, CLIENT_BACKLOG_KEY, VIRTUAL_TIME_KEY, CLIENT_FINISH_KEY
+                )
+                backlog = seconds(await pipe.get(BACKLOG_KEY))
+                client_backlog = seconds(await pipe.hget(CLIENT_BACKLOG_KEY, client))
+                check_budgets(backlog, client_backlog, cost)
+                virtual_time = float(await pipe.get(VIRTUAL_TIME_KEY) or 0)
+                client_finish = await pipe.zscore(CLIENT_FINISH_KEY, client)
+                start = max(virtual_time, client_finish or 0)
+                job = {
+                    "task_id": task_id,
+                    "content_type": content_type or "",
+                    "enqueued_at": str(time.time()),
+                    "client": client,
+                    "cost": str(cost),
+                    "lane": lane,
+                    "start": repr(start),
+                    "output": json.dumps(output or {}),
+                }
+
+                pipe.multi()
+                # Expires with its task, in case the job is never finished
+                pipe.set(f"upload:{task_id}", image_data, ex=TASK_TTL)
+                pipe.hset(JOBS_KEY, task_id, json.dumps(job))
+                pipe.zadd(lane_key(lane), {task_id: start})
+                # Every job counts for at least a little, so clients sending
+                # many tiny images still take turns
+                pipe.zadd(CLIENT_FINISH_KEY, {client: start + max(cost, 0.1)})
+                # Clients whose work has all started no longer need their own time
+                pipe.zremrangebyscore(CLIENT_FINISH_KEY, "-inf", f"({virtual_time!r}")
+                pipe.hset(COSTS_KEY, task_id, cost)
+                pipe.incrbyfloat(BACKLOG_KEY, cost)
+                pipe.hincrbyfloat(CLIENT_BACKLOG_KEY, client, cost)
+                pipe.lpush(WAKEUP_KEY, 1)
+                pipe.ltrim(WAKEUP_KEY, 0, 99)
+                await pipe.execute()
+                return lane
+            except WatchError:
+                continue
+
+
+async def migrate_stream(redis: Redis) -> None:
+    """Move jobs queued on the Redis stream used before lanes into the lanes"""
+    entries = await redis.xrange(STREAM_KEY) if await redis.exists(STREAM_KEY) else []
+    retries = await redis.zrange(LEGACY_RETRY_KEY, 0, -1)
+    jobs = [
+        {key.decode(): value.decode() for key, value in fields.items()}
+        for _, fields in entries
+    ] + [json.loads(member) for member in retries]
+    virtual_time = float(await redis.get(VIRTUAL_TIME_KEY) or 0)
+    for job in jobs:
+        job.update(client="", cost="0", lane="interactive", start=repr(virtual_time))
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.hset(JOBS_KEY, job["task_id"], json.dumps(job))
+            pipe.zadd(lane_key("interactive"), {job["task_id"]: virtual_time})
+            await pipe.execute()
+    await redis.delete(STREAM_KEY, LEGACY_RETRY_KEY)
+    if jobs:
+        logger.info(f"Moved {len(jobs)} job(s) from the old stream into the lanes")
+
+
+async def requeue_abandoned(redis: Redis) -> None:
+    """Put jobs whose lease ran out (their worker died) back in their lane"""
+    for lane in LANES:
+        expired = await redis.zrangebyscore(running_key(lane), "-inf", time.time())
+        for task_id in expired:
+            job = await job_fields(redis, task_id.decode())
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.zrem(running_key(lane), task_id)
+                if job:
+                    # Keeps its start time, so it is next in line
+                    pipe.zadd(lane_key(lane), {task_id: float(job["start"])})
+                await pipe.execute()
+        if expired:
+            logger.info(f"Re-queued {len(expired)} abandoned {lane} job(s)")
+
+
+async def job_fields(redis: Redis, task_id: str) -> Optional[Dict[str, str]]:
+    job = await redis.hget(JOBS_KEY, task_id)
+    return json.loads(job) if job else None
+
+
+async def _claim_from(redis: Redis, lane: str, count: int) -> List[Dict[str, str]]:
+    """Take up to count jobs from a lane, earliest virtual start first"""
+    claimed: List[Dict[str, str]] = []
+    candidates = await redis.zrange(lane_key(lane), 0, count * 2 - 1, withscores=True)
+    for task_id, start in candidates:
+        if len(claimed) == count:
+            break
+        deadline = time.time() + VISIBILITY_TIMEOUT
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(running_key(lane), {task_id: deadline}, nx=True)
+            pipe.zrem(lane_key(lane), task_id)
+            leased, removed = await pipe.execute()
+        if not removed:
+            # Another worker took it first
+            if leased:
+                await redis.zrem(running_key(lane), task_id)
+            continue
+        job = await job_fields(redis, task_id.decode())
+        if job is None:
+            await redis.zrem(running_key(lane), task_id)
+            continue
+        if start > float(await redis.get(VIRTUAL_TIME_KEY) or 0):
+            await redis.set(VIRTUAL_TIME_KEY, repr(start))
+        claimed.append(job)
+    return claimed
+
+
+async def claim_jobs(redis: Redis, count: int, block_ms: int) -> List[Dict[str, str]]:
+    """
+    Take up to count jobs, interactive ones first.
+
+    Jobs abandoned by dead workers are re-queued first. When no job is
+    waiting, blocks for up to block_ms until one is enqueued.
+    """
+    await requeue_abandoned(redis)
+    for attempt in range(2):
+        claimed: List[Dict[str, str]] = []
+        for lane in LANES:
+            wanted = count - len(claimed)
+            if lane == "bulk" and BULK_MAX_RUNNING:
+                running = await redis.zcard(running_key(lane))
+                wanted = min(wanted, BULK_MAX_RUNNING - running)
+            if wanted > 0:
+                claimed += await _claim_from(redis, lane, wanted)
+        if claimed or attempt or not block_ms:
+            return claimed
+        await redis.blpop([WAKEUP_KEY], timeout=block_ms / 1000)
+    return []
+
+
+async def heartbeat(redis: Redis, job: Dict[str, str]) -> None:
+    """Extend the lease of a running job so it is not re-queued"""
+    await redis.zadd(
+        running_key(job["lane"]),
+        {job["task_id"]: time.time() + VISIBILITY_TIMEOUT},
+        xx=True,
+    )
+
+
+async def release_cost(redis: Redis, job: Dict[str, str]) -> None:
+    """Take a finished job's cost off the backlog"""
+    # Only the process that removes the entry accounts for it
+    if not await redis.hdel(COSTS_KEY, job["task_id"]):
+        return
+    cost = float(job.get("cost") or 0)
+    client = job.get("client", "")
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.incrbyfloat(BACKLOG_KEY, -cost)
+        pipe.hincrbyfloat(CLIENT_BACKLOG_KEY, client, -cost)
+        _, client_backlog = await pipe.execute()
+    if seconds(client_backlog) == 0:
+        await redis.hdel(CLIENT_BACKLOG_KEY, client)
+
+
+async def ack(redis: Redis, job: Dict[str, str]) -> None:
+    """Remove a finished job from the queue along with its upload"""
+    task_id = job["task_id"]
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zrem(running_key(job["lane"]), task_id)
+        pipe.hdel(JOBS_KEY, task_id)
+        pipe.delete(f"upload:{task_id}")
+        await pipe.execute()
+    await release_cost(redis, job)
+
+
+async def retry_later(redis: Redis, job: Dict[str, str], attempt: int) -> float:
+    """Release a failed job and schedule it to be re-queued after a backoff delay"""
+    delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zrem(running_key(job["lane"]), job["task_id"])
+        pipe.zadd(RETRY_KEY, {job["task_id"]: time.time() + delay})
+        await pipe.execute()
+    return delay
+
+
+async def promote_due_retries(redis: Redis) -> None:
+    """Move jobs whose backoff has elapsed back into their lane"""
+    due = await redis.zrangebyscore(RETRY_KEY, "-inf", time.time())
+    for task_id in due:
+        # Only the worker that removes the entry re-adds it
+        if await redis.zrem(RETRY_KEY, task_id):
+            job = await job_fields(redis, task_id.decode())
+            if job:
+                job["enqueued_at"] = str(time.time())
+                async with redis.pipeline(transaction=True) as pipe:
+                    pipe.hset(JOBS_KEY, job["task_id"], json.dumps(job))
+                    pipe.zadd(lane_key(job["lane"]), {task_id: float(job["start"])})
+                    await pipe.execute()
+
+
+async def remove_queued(redis: Redis, task_id: str) -> bool:
+    """
+    Take a job out of the queue before a worker starts it.
+
+    Returns False if there is no such job or a worker is running it.
+    """
+    job = await job_fields(redis, task_id)
+    if job is None:
+        return False
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.zrem(lane_key(job["lane"]), task_id)
+        pipe.zrem(RETRY_KEY, task_id)
+        removed = any(await pipe.execute())
+    if removed:
+        await ack(redis, job)
+    return removed
+
+
+async def queue_depths(redis: Redis) -> Tuple[Dict[str, int], int, float]:
+    """Jobs queued or running per lane, jobs waiting to be retried, and the backlog"""
+    async with redis.pipeline(transaction=False) as pipe:
+        for lane in LANES:
+            pipe.zcard(lane_key(lane))
+            pipe.zcard(running_key(lane))
+        pipe.zcard(RETRY_KEY)
+        pipe.get(BACKLOG_KEY)
+        *counts, retrying, backlog = await pipe.execute()
+    depths = {lane: counts[2 * i] + counts[2 * i + 1] for i, lane in enumerate(LANES)}
+    return depths, retrying, seconds(backlog)
@@ -1,22 +1,76 @@
-import datetime
+import asyncio
+import contextlib
+import json
 import logging
 import os
 import time
 import uuid
-from typing import Dict, List
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional, Tuple, TypeVar
 
 import httpx
 from fastapi import (
-    BackgroundTasks,
     FastAPI,
     HTTPException,
+    Query,
+    Request,
     UploadFile,
 )
-from fastapi.responses import Response
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from pydantic import BaseModel, Field
 from redis.asyncio import Redis
-
-from app.tasks import process_image
+from redis.exceptions import ResponseError
+from starlette.routing import Match
+
+from app.cache import (
+    DEFAULT_PARAMS,
+    MODELS,
+    cache_stats,
+    stream_cached,
+    upload_cache_key,
+    upscale_params,
+)
+from app.esrgan_client import EsrganUnavailableError, esrgan
+from app.job_queue import (
+    QueueFullError,
+    admit,
+    enqueue,
+    lane_for,
+    queue_depths,
+    remove_queued,
+)
+from app.metrics import (
+    ADMISSIONS,
+    BACKLOG_SECONDS,
+    HTTP_IN_FLIGHT,
+    HTTP_REQUEST_SECONDS,
+    HTTP_REQUESTS,
+    QUEUE_DEPTH,
+    RETRY_DEPTH,
+    UPLOAD_READ_SECONDS,
+)
+from app.storage import CHUNK_SIZE, iter_redis_value, parse_range, result_store
+from app.task_events import TaskEvents
+from app.task_store import (
+    RESULT_TTL,
+    TASK_STATUSES,
+    backfill_index,
+    cancel,
+    create_task,
+    delete_task,
+    is_final,
+    list_tasks,
+    status_group,
+)
+from app.throughput import estimate_seconds, work_megapixels
+from app.validation import (
+    MAX_UPLOAD_BYTES,
+    MULTIPART_OVERHEAD,
+    ImageInfo,
+    ImageRejectedError,
+    check_upload_size,
+    probe_image,
+)
 
 app = FastAPI(
     title="Image Upscaler API",
@@ -35,8 +89,10 @@ app = FastAPI(
     3. Once complete, get the result using `/result/{task_id}`
 
     ## Notes
-    - Maximum image size: 10MB
-    - Supported formats: JPEG, PNG
+    - Maximum upload size: 10MB (MAX_UPLOAD_BYTES), maximum image size: 50 megapixels
+      (MAX_IMAGE_PIXELS); larger uploads are rejected with 413, as are images that
+      do not fit in ESRGAN's memory budget
+    - Supported formats: JPEG, PNG (ALLOWED_IMAGE_FORMATS); others are rejected with 415
     - Processing time varies based on image size
     """,
     version="1.0.0",
@@ -57,11 +113,73 @@ redis = Redis(
     decode_responses=False,  # Keep binary data for image results
 )
 
+# Status changes pushed to long-polling and streaming clients
+task_events = TaskEvents(redis)
+
+# Longest long poll on /status, and the interval between keepalive comments on
+# status streams, in seconds
+MAX_STATUS_WAIT = 60
+SSE_KEEPALIVE = 15
+
+T = TypeVar("T")
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+@app.on_event("startup")
+async def index_existing_tasks() -> None:
+    await backfill_index(redis)
+
+
+# Routes taking an image upload
+UPLOAD_ROUTES = ("/upscale", "/upscale/async")
+
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    # Declared too large to hold an acceptable image: answered before the body
+    # is read. Uploads without a Content-Length are checked once parsed. Added
+    # before record_metrics, which therefore still counts these rejections.
+    if request.method == "POST" and request.url.path in UPLOAD_ROUTES:
+        try:
+            length = int(request.headers.get("content-length", "0"))
+        except ValueError:
+            length = 0
+        if MAX_UPLOAD_BYTES and length > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD:
+            return JSONResponse(
+                {"detail": f"Upload too large, the limit is {MAX_UPLOAD_BYTES} bytes"},
+                status_code=413,
+            )
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    # Label by route template rather than raw path, so task IDs do not each
+    # create a new time series
+    route = request.url.path
+    for candidate in app.router.routes:
+        if candidate.matches(request.scope)[0] == Match.FULL:
+            route = candidate.path
+            break
+
+    HTTP_IN_FLIGHT.labels(route).inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.labels(route).dec()
+        HTTP_REQUEST_SECONDS.labels(request.method, route).observe(
+            time.perf_counter() - start
+        )
+        HTTP_REQUESTS.labels(request.method, route, status).inc()
+
+
 class ApiInfo(BaseModel):
     message: str = Field(..., description="Welcome message")
     version: str = Field(..., description="API version number")
@@ -94,22 +212,71 @@ class TaskStatus(BaseModel):
     task_id: str = Field(..., description="Unique identifier for the upscaling task")
     status: str = Field(
         ...,
-        description="Current status of the task (pending, processing, completed, failed)",
+        description="Current status of the task "
+        "(pending, processing, completed, expired, cancelled, failed)",
     )
     created_at: str = Field(..., description="Timestamp when the task was created")
+    tiles_done: Optional[int] = Field(
+        None, description="Tiles upscaled so far, while processing"
+    )
+    tiles_total: Optional[int] = Field(
+        None, description="Tiles the image is split into, while processing"
+    )
+    progress: Optional[float] = Field(
+        None, description="Fraction of the tiles done, from 0 to 1, while processing"
+    )
+    eta_seconds: Optional[float] = Field(
+        None, description="Estimated seconds until processing finishes"
+    )
+    model: Optional[str] = Field(None, description="Requested model")
+    scale: Optional[float] = Field(None, description="Requested output scale")
+    width: Optional[int] = Field(None, description="Requested output width")
+    height: Optional[int] = Field(None, description="Requested output height")
 
     class Config:
         schema_extra = {
             "example": {
                 "task_id": "123e4567-e89b-12d3-a456-426614174000",
-                "status": "completed",
+                "status": "processing",
                 "created_at": "2024-02-02T10:30:00",
+                "tiles_done": 12,
+                "tiles_total": 48,
+                "progress": 0.25,
+                "eta_seconds": 36.0,
+            }
+        }
+
+
+class CacheStats(BaseModel):
+    hits: int = Field(..., description="Requests served from the result cache")
+    misses: int = Field(..., description="Requests that ran a new inference")
+    coalesced: int = Field(
+        ..., description="Requests that joined an identical in-flight inference"
+    )
+    evictions: int = Field(..., description="Entries evicted to stay within budget")
+    entries: int = Field(..., description="Number of cached results")
+    bytes: int = Field(..., description="Total size of cached results in bytes")
+    max_bytes: int = Field(..., description="Configured cache size limit in bytes")
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "hits": 42,
+                "misses": 10,
+                "coalesced": 3,
+                "evictions": 0,
+                "entries": 10,
+                "bytes": 15728640,
+                "max_bytes": 536870912,
             }
         }
 
 
 class JobList(BaseModel):
-    jobs: List[TaskStatus] = Field(..., description="List of all upscaling tasks")
+    jobs: List[TaskStatus] = Field(..., description="One page of tasks, newest first")
+    next_cursor: Optional[str] = Field(
+        None, description="Pass as cursor to get the next page; null on the last page"
+    )
 
     class Config:
         schema_extra = {
@@ -120,7 +287,8 @@ class JobList(BaseModel):
                         "status": "completed",
                         "created_at": "2024-02-02T10:30:00",
                     }
-                ]
+                ],
+                "next_cursor": "1706869800.123456:123e4567-e89b-12d3-a456-426614174000",
             }
         }
 
@@ -141,15 +309,98 @@ async def root():
             "/upscale": "Synchronously upscale an image",
             "/upscale/async": "Asynchronously upscale an image",
             "/status/{task_id}": "Check status of async upscale task",
+            "/status/{task_id}/stream": "Stream status changes as Server-Sent Events",
             "/result/{task_id}": "Get result of completed task",
-            "/jobs": "List all jobs",
+            "/task/{task_id}": "Cancel a queued or running task (DELETE)",
+            "/jobs": "List jobs, newest first, one page at a time",
+            "/cache/stats": "Result cache hit/miss counters",
+            "/metrics": "Prometheus metrics",
         },
     }
 
 
+class ClientDisconnected(Exception):
+    """The client went away before its response was ready"""
+
+
+async def unless_disconnected(request: Request, awaitable: Awaitable[T]) -> T:
+    """
+    Await awaitable, cancelling it and raising ClientDisconnected if the client
+    disconnects first. Only for requests whose body has been read, so that the
+    next message can only be the disconnect.
+    """
+    work = asyncio.ensure_future(awaitable)
+
+    async def disconnected() -> None:
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        await asyncio.wait({work, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        work.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if work.done():
+        return work.result()
+    work.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await work
+    raise ClientDisconnected()
+
+
+def validate_upload(image: UploadFile) -> ImageInfo:
+    """
+    Check an upload against the size, pixel and format limits, reading only
+    the image header. Raises 413 or 415 for uploads ESRGAN should never see.
+    """
+    try:
+        check_upload_size(image.size or 0)
+        info = probe_image(image.file)
+    except ImageRejectedError as e:
+        logger.info(f"Rejected upload {image.filename!r}: {e}")
+        raise HTTPException(e.status_code, str(e)) from e
+    logger.info(f"Upload is a {info.width}x{info.height} {info.format} image")
+    return info
+
+
+def output_options(
+    scale: Optional[float],
+    width: Optional[int],
+    height: Optional[int],
+    model: Optional[str] = None,
+) -> Dict[str, Any]:
+    """The options a request passed, for ESRGAN, cache keys and tasks"""
+    if scale is not None and (width or height):
+        raise HTTPException(400, "Pass either scale or width and height, not both")
+    if model is not None and model not in MODELS:
+        raise HTTPException(
+            400, f"Unknown model {model}, expected one of {', '.join(MODELS)}"
+        )
+    options = {"model": model, "scale": scale, "width": width, "height": height}
+    return {name: value for name, value in options.items() if value is not None}
+
+
 @app.post("/upscale", tags=["Upscaling"])
 async def upscale_image_sync(
     image: UploadFile,
+    request: Request,
+    scale: Optional[float] = Query(
+        None, ge=1, le=4, description="Output size relative to the input (default 4)"
+    ),
+    width: Optional[int] = Query(
+        None, ge=1, description="Fit the output within this width"
+    ),
+    height: Optional[int] = Query(
+        None, ge=1, description="Fit the output within this height"
+    ),
+    model: Optional[str] = Query(
+        None,
+        description="Model to upscale with; by default the x4 or x2 model, "
+        "whichever is enough for the output size",
+    ),
 ) -> Response:
     """
     Synchronously upscale an image.
@@ -159,41 +410,101 @@ async def upscale_image_sync(
 
     - **Input**: Image file (JPEG or PNG)
     - **Output**: Upscaled image in JPEG format
-    - **Processing**: 4x upscaling using Real-ESRGAN
+    - **Processing**: 4x upscaling using Real-ESRGAN, or less with `scale`, or
+      fitted within `width` and/or `height` keeping the aspect ratio
+    - **Model**: `model` picks another Real-ESRGAN model, such as the much faster
+      `realesr-general-x4v3` or `RealESRGAN_x4plus_anime_6B` for drawings
 
     The request will timeout after the configured REQUEST_TIMEOUT (default: 300 seconds).
+    The upload is streamed to ESRGAN and the result is streamed back in chunks.
+    If the client disconnects while waiting, the upscale is cancelled in ESRGAN.
+    Uploads over the size or pixel limits get 413, other formats 415.
     """
     if not image:
         raise HTTPException(400, "No file uploaded")
+    output = output_options(scale, width, height, model)
+    info = validate_upload(image)
+
+    async def upload_chunks() -> AsyncIterator[bytes]:
+        await image.seek(0)
+        while chunk := await image.read(CHUNK_SIZE):
+            yield chunk
 
     try:
-        # Read image data
-        image_data = await image.read()
-
-        # Send to ESRGAN service
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://esrgan:8001/upscale",
-                content=image_data,
-                headers={"Content-Type": image.content_type or "image/jpeg"},
-                timeout=float(os.getenv("REQUEST_TIMEOUT", "300")),
-            )
-            response.raise_for_status()
-            return Response(content=response.content, media_type="image/jpeg")
+        with UPLOAD_READ_SECONDS.labels("upscale").time():
+            key = await upload_cache_key(image, upscale_params(output))
+
+        # Stream to ESRGAN service, unless the same image was upscaled before
+        chunks = stream_cached(
+            redis,
+            key,
+            lambda: esrgan.upscale_stream(
+                upload_chunks, info.content_type, output=output
+            ),
+        )
+        # Wait for the first chunk so ESRGAN errors still become error responses.
+        # ESRGAN only answers once it has read the whole upload, which matters
+        # because the upload is closed as soon as this function returns.
+        first_chunk = await unless_disconnected(request, chunks.__anext__())
+    except ClientDisconnected as e:
+        logger.info("Client disconnected, cancelled its upscale")
+        raise HTTPException(499, "Client closed request") from e
+    except EsrganUnavailableError as e:
+        raise HTTPException(
+            503, str(e), headers={"Retry-After": str(e.retry_after)}
+        ) from e
+    except httpx.HTTPStatusError as e:
+        # Pass on client errors from ESRGAN, such as invalid or oversized images
+        if e.response.status_code < 500:
+            try:
+                detail = e.response.json()["detail"]
+            except (ValueError, KeyError, TypeError):
+                detail = e.response.text
+            raise HTTPException(e.response.status_code, detail) from e
+        raise HTTPException(500, str(e)) from e
     except Exception as e:
         raise HTTPException(500, str(e)) from e
 
+    async def result_chunks() -> AsyncIterator[bytes]:
+        yield first_chunk
+        async for chunk in chunks:
+            yield chunk
+
+    return StreamingResponse(result_chunks(), media_type="image/jpeg")
+
+
+def client_id(request: Request) -> str:
+    """Who a request is queued for: its X-Client-ID header, or its address"""
+    return request.headers.get("X-Client-ID") or (
+        request.client.host if request.client else ""
+    )
+
 
 @app.post("/upscale/async", response_model=TaskResponse, tags=["Upscaling"])
 async def upscale_image_async(
-    background_tasks: BackgroundTasks,
     image: UploadFile,
+    request: Request,
+    scale: Optional[float] = Query(
+        None, ge=1, le=4, description="Output size relative to the input (default 4)"
+    ),
+    width: Optional[int] = Query(
+        None, ge=1, description="Fit the output within this width"
+    ),
+    height: Optional[int] = Query(
+        None, ge=1, description="Fit the output within this height"
+    ),
+    model: Optional[str] = Query(
+        None,
+        description="Model to upscale with; by default the x4 or x2 model, "
+        "whichever is enough for the output size",
+    ),
 ) -> Dict[str, str]:
     """
     Asynchronously upscale an image.
 
-    This endpoint immediately returns a task ID and processes the image in the background.
+    This endpoint immediately returns a task ID and queues the image for a worker.
     Recommended for larger images or when you don't want to wait for immediate results.
+    Queued tasks survive API restarts and failed tasks are retried with backoff.
 
     ## Process Flow:
     1. Upload image and receive task_id
@@ -201,128 +512,384 @@ async def upscale_image_async(
     3. Once status is "completed", get result using `/result/{task_id}`
 
     ## Notes:
-    - Task IDs expire after 24 hours
+    - Task IDs expire after TASK_TTL seconds (default 7 days), results after
+      RESULT_TTL (default 24 hours); the task then reports status "expired"
     - Failed tasks will be marked with status "failed"
+    - Jobs are priced by their estimated processing time. Cheap jobs are queued
+      ahead of large ones, and each client's jobs take turns with those of other
+      clients (identified by the `X-Client-ID` header, or their address).
+    - Returns 429 with a Retry-After header when the queued work, in total or for
+      this client, would exceed its budget
+    - Uploads over the size or pixel limits get 413, other formats 415
+    - `scale`, or `width` and/or `height`, ask for a smaller output than 4x, as
+      for `/upscale`; smaller outputs take less time
+    - `model` picks the Real-ESRGAN model, as for `/upscale`
     """
     logger.info("Received async upscale request")
     start_time = time.time()
     if not image:
         logger.error("No file uploaded")
         raise HTTPException(400, "No file uploaded")
+    output = output_options(scale, width, height, model)
+    info = validate_upload(image)
+
+    # Read file data before processing
+    with UPLOAD_READ_SECONDS.labels("upscale_async").time():
+        file_data = await image.read()
+    content_type = info.content_type
+    logger.info(f"Read {len(file_data)} bytes in {time.time() - start_time:.2f}s")
 
     try:
+        # Price the job before anything is stored for it
+        megapixels = work_megapixels(info.width, info.height, output)
+        cost = await estimate_seconds(
+            redis, megapixels, DEFAULT_PARAMS["scale"], output.get("model")
+        )
+        client = client_id(request)
+        lane = lane_for(cost)
+        await admit(redis, client, cost)
+
         # Generate task ID
         task_id = str(uuid.uuid4())
         logger.info(f"Created task ID: {task_id}")
 
         # Initialize task in Redis
-        await redis.hset(
-            f"task:{task_id}",
-            mapping={
-                "status": "pending",
-                "created_at": datetime.datetime.utcnow().isoformat(),
-            },
-        )
+        await create_task(redis, task_id, output)
         logger.info(f"Initialized Redis task in {time.time() - start_time:.2f}s")
 
-        # Read file data before processing
-        file_data = await image.read()
-        content_type = image.content_type
-        logger.info(f"Read {len(file_data)} bytes in {time.time() - start_time:.2f}s")
-
-        # Schedule the processing in background with the file data
-        background_tasks.add_task(
-            process_image, file_data, content_type, redis, task_id
-        )
+        # Queue the file data for a worker. The budgets are checked again as
+        # it is queued, which other uploads may have filled in the meantime.
+        try:
+            await enqueue(redis, task_id, file_data, content_type, client, cost, output)
+        except QueueFullError:
+            await delete_task(redis, task_id)
+            raise
+        ADMISSIONS.labels(lane, "admitted").inc()
         logger.info(
-            f"Task {task_id} scheduled for background processing in {time.time() - start_time:.2f}s"
+            f"Task {task_id} queued in the {lane} lane (estimated {cost:.1f}s) "
+            f"in {time.time() - start_time:.2f}s"
         )
 
         return {"task_id": task_id}
+    except QueueFullError as e:
+        ADMISSIONS.labels(lane, "rejected").inc()
+        logger.warning(f"Rejected {cost:.1f}s job from {client!r}: {e}")
+        raise HTTPException(
+            429, str(e), headers={"Retry-After": str(e.retry_after)}
+        ) from e
     except Exception as e:
         logger.error(f"Error scheduling task: {str(e)}")
         raise HTTPException(500, str(e)) from e
 
 
+def processing_progress(task_info: Dict[bytes, bytes]) -> Dict[str, Any]:
+    """
+    Tiles done and the ETA of a processing task.
+
+    Once tiles are done the ETA extrapolates the time they took; before that
+    it is the estimate the worker made from the throughput of recent jobs.
+    """
+    if b"started_at" not in task_info:
+        return {}
+    elapsed = time.time() - float(task_info[b"started_at"])
+    tiles_done = int(task_info.get(b"tiles_done", 0))
+    tiles_total = int(task_info.get(b"tiles_total", 0))
+    if tiles_done and tiles_total:
+        eta = elapsed * (tiles_total - tiles_done) / tiles_done
+    else:
+        eta = max(0.0, float(task_info.get(b"estimated_seconds", 0)) - elapsed)
+    return {
+        "tiles_done": tiles_done,
+        "tiles_total": tiles_total,
+        "progress": round(tiles_done / tiles_total, 4) if tiles_total else 0.0,
+        "eta_seconds": round(eta, 1),
+    }
+
+
+async def read_status(task_id: str) -> Optional[Dict[str, Any]]:
+    """A task's status as reported to clients, None if there is no such task"""
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hgetall(f"task:{task_id}")
+        pipe.exists(f"result:{task_id}")
+        task_info, has_result = await pipe.execute()
+    if not task_info:
+        return None
+
+    status = task_info.get(b"status", b"unknown").decode()
+    if status == "completed" and not has_result:
+        status = "expired"
+    info = {
+        "task_id": task_id,
+        "status": status,
+        "created_at": task_info.get(b"created_at", b"").decode(),
+    }
+    for name, kind in (
+        ("model", str),
+        ("scale", float),
+        ("width", int),
+        ("height", int),
+    ):
+        if name.encode() in task_info:
+            info[name] = kind(task_info[name.encode()].decode())
+    if status == "processing":
+        info.update(processing_progress(task_info))
+    return info
+
+
 @app.get("/status/{task_id}", response_model=TaskStatus, tags=["Task Management"])
-async def get_task_status(task_id: str) -> Dict[str, str]:
+async def get_task_status(
+    task_id: str,
+    wait: float = Query(
+        0,
+        ge=0,
+        le=MAX_STATUS_WAIT,
+        description="Seconds to wait for the status to change before answering",
+    ),
+) -> Dict[str, Any]:
     """
     Get the status of an upscaling task.
 
     ## Status Values:
     - **pending**: Task is queued
-    - **processing**: Task is being processed
+    - **processing**: Task is being processed; `tiles_done`, `tiles_total`,
+      `progress` and `eta_seconds` tell how far it got
     - **completed**: Task is complete, result available
     - **failed**: Task failed to process
+    - **expired**: Task completed, but its result is no longer stored
+    - **cancelled**: Task was cancelled with `DELETE /task/{task_id}`
 
-    Use this endpoint to poll for task completion before requesting the result.
+    With `wait`, unfinished tasks are answered as soon as their status or progress
+    changes, or after `wait` seconds (long polling). For every change as it happens, use
+    `/status/{task_id}/stream` instead.
     """
-    task_info = await redis.hgetall(f"task:{task_id}")
-    if not task_info:
+    if not wait:
+        info = await read_status(task_id)
+        if info is None:
+            raise HTTPException(404, "Task not found")
+        return info
+
+    async with task_events.subscribe(task_id) as changes:
+        info = await read_status(task_id)
+        if info is None:
+            raise HTTPException(404, "Task not found")
+        if is_final(info["status"]):
+            return info
+        try:
+            await asyncio.wait_for(changes.get(), wait)
+        except asyncio.TimeoutError:
+            return info
+    return await read_status(task_id) or info
+
+
+@app.get("/status/{task_id}/stream", tags=["Task Management"])
+async def stream_task_status(task_id: str) -> StreamingResponse:
+    """
+    Stream the status of an upscaling task as Server-Sent Events.
+
+    Sends a `status` event with the current status right away and another on
+    every change, tile progress included, the same JSON as `/status/{task_id}`.
+    The stream ends once the task is completed, failed, expired or cancelled.
+    Changes are pushed from Redis pub/sub, so waiting clients cause no polling.
+    """
+    if await read_status(task_id) is None:
         raise HTTPException(404, "Task not found")
 
-    return {
-        "task_id": task_id,
-        "status": task_info.get(b"status", b"unknown").decode(),
-        "created_at": task_info.get(b"created_at", b"").decode(),
-    }
+    async def events() -> AsyncIterator[str]:
+        async with task_events.subscribe(task_id) as changes:
+            yield "retry: 3000\n\n"
+            last = None
+            while True:
+                info = await read_status(task_id)
+                if info is None:
+                    return
+                if info != last:
+                    yield f"event: status\ndata: {json.dumps(info)}\n\n"
+                    last = info
+                if is_final(info["status"]):
+                    return
+                try:
+                    await asyncio.wait_for(changes.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.delete("/task/{task_id}", response_model=TaskStatus, tags=["Task Management"])
+async def cancel_task(task_id: str) -> Dict[str, Any]:
+    """
+    Cancel an upscaling task.
+
+    A queued task is taken off the queue. A running task is stopped by its worker,
+    which closes its ESRGAN request; ESRGAN then stops after the tiles in flight.
+    Either way the task reports status "cancelled". Returns 409 for tasks that have
+    already finished.
+    """
+    info = await read_status(task_id)
+    if info is None:
+        raise HTTPException(404, "Task not found")
+    if is_final(info["status"]):
+        raise HTTPException(409, f"Task already {status_group(info['status'])}")
+
+    # Checked again as it is written: the task may finish in the meantime. A
+    # running task's worker stops it on seeing the status change.
+    status = await cancel(redis, task_id)
+    if status is None:
+        raise HTTPException(404, "Task not found")
+    if is_final(status):
+        raise HTTPException(409, f"Task already {status_group(status)}")
+    queued = await remove_queued(redis, task_id)
+    logger.info(f"Task {task_id}: cancelled while {'queued' if queued else 'running'}")
+    return await read_status(task_id) or info
 
 
 @app.get("/result/{task_id}", tags=["Task Management"])
-async def get_task_result(task_id: str) -> Response:
+async def get_task_result(task_id: str, request: Request) -> Response:
     """
     Get the result of a completed upscaling task.
 
     Returns the upscaled image for completed tasks. Make sure to check the task status
-    is "completed" before requesting the result.
+    is "completed" before requesting the result. Single byte ranges (`Range: bytes=`)
+    are supported, so interrupted downloads can be resumed.
 
     ## Error Cases:
     - 404: Task not found (invalid ID or expired)
     - 400: Task not yet completed
-    - 404: Result not found (task completed but result expired)
+    - 410: Result expired (task completed but its result is no longer stored)
+    - 416: Requested range lies outside the result
 
-    Results are stored for 24 hours after task completion.
+    Results are stored for RESULT_TTL seconds (default 24 hours) after task
+    completion, or less when results exceed RESULTS_MAX_BYTES in total.
     """
-    task_info = await redis.hgetall(f"task:{task_id}")
-    if not task_info:
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.hget(f"task:{task_id}", "status")
+        pipe.hmget(f"result:{task_id}", "ref", "size")
+        status, metadata = await pipe.execute(raise_on_error=False)
+    if status is None:
         raise HTTPException(404, "Task not found")
 
-    status = task_info.get(b"status", b"unknown").decode()
+    if isinstance(metadata, ResponseError):
+        # Stored before the result store existed: the image itself
+        size = await redis.strlen(f"result:{task_id}")
+        return StreamingResponse(
+            iter_redis_value(redis, f"result:{task_id}", size),
+            media_type="image/jpeg",
+            headers={"Content-Length": str(size)},
+        )
+
+    ref, size = metadata
+    status = status.decode()
+    store = result_store(redis, RESULT_TTL)
+    if status == "completed" and ref is not None:
+        ref = ref.decode()
+        if not await store.exists(ref):
+            ref = None
+    if status == "expired" or (status == "completed" and ref is None):
+        raise HTTPException(410, "Result has expired")
     if status != "completed":
         raise HTTPException(400, f"Task is not completed. Status: {status}")
 
-    result = await redis.get(f"result:{task_id}")
-    if not result:
-        raise HTTPException(404, "Result not found")
-
-    return Response(content=result, media_type="image/jpeg")
+    size = int(size)
+    try:
+        byte_range = parse_range(request.headers.get("range"), size)
+    except ValueError as e:
+        raise HTTPException(
+            416, str(e), headers={"Content-Range": f"bytes */{size}"}
+        ) from e
+    start, end = byte_range or (0, size - 1)
+    headers = {"Content-Length": str(end - start + 1), "Accept-Ranges": "bytes"}
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        store.iter_range(ref, start, end),
+        status_code=206 if byte_range else 200,
+        media_type="image/jpeg",
+        headers=headers,
+    )
 
 
 @app.get("/jobs", response_model=JobList, tags=["Task Management"])
-async def list_jobs() -> Dict[str, List[Dict[str, str]]]:
+async def list_jobs(
+    limit: int = Query(50, ge=1, le=500, description="Tasks per page"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page"),
+    status: Optional[str] = Query(
+        None,
+        description=(
+            "Only list tasks with this status "
+            "(pending, processing, completed, error, expired, cancelled)"
+        ),
+    ),
+) -> Dict[str, Any]:
     """
-    List all upscaling jobs in the system.
+    List upscaling jobs, newest first, one page at a time.
 
-    Returns a list of all tasks and their current status. This is useful for:
+    Returns up to `limit` tasks and a `next_cursor`; pass it back as `cursor` to get
+    the following page. Pages stay consistent while new tasks arrive. This is useful for:
     - Monitoring overall system usage
     - Finding specific task IDs
     - Checking task creation times
 
-    Results are sorted by creation time (newest first).
-    Only shows tasks from the last 24 hours.
+    Tasks are read from a time-ordered index, so a page costs the same however many
+    tasks are stored.
     """
-    jobs = []
-    async for key in redis.scan_iter("task:*"):
-        task_id = key.decode().split(":", 1)[1]
-        task_info = await redis.hgetall(key)
-        jobs.append(
-            {
-                "task_id": task_id,
-                "status": task_info.get(b"status", b"unknown").decode(),
-                "created_at": task_info.get(b"created_at", b"").decode(),
-            }
+    if status is not None and status not in TASK_STATUSES:
+        raise HTTPException(
+            400,
+            f"Unknown status {status!r}, expected one of {', '.join(TASK_STATUSES)}",
         )
-    return {"jobs": jobs}
+    position: Optional[Tuple[float, Optional[str]]] = None
+    if cursor is not None:
+        # "score:task_id"; a bare score, from before task IDs were added,
+        # resumes after every task with that score
+        score, _, last_id = cursor.partition(":")
+        try:
+            position = (float(score), last_id or None)
+        except ValueError as e:
+            raise HTTPException(400, "Invalid cursor") from e
+
+    jobs, next_cursor = await list_tasks(redis, limit, position, status)
+    return {
+        "jobs": jobs,
+        "next_cursor": (
+            f"{next_cursor[0]!r}:{next_cursor[1]}" if next_cursor is not None else None
+        ),
+    }
+
+
+@app.get("/cache/stats", response_model=CacheStats, tags=["System"])
+async def get_cache_stats() -> Dict[str, int]:
+    """
+    Get result cache statistics.
+
+    Uploads are cached by a hash of the image bytes and processing parameters, so
+    re-uploading an image returns the stored result instead of running ESRGAN again.
+    Identical uploads that arrive while the first one is still processing share
+    its inference and are counted as coalesced.
+    """
+    return await cache_stats(redis)
+
+
+@app.get("/metrics", tags=["System"])
+async def get_metrics() -> Response:
+    """
+    Prometheus metrics for the API.
+
+    Request counts and latencies per route, upload read time, ESRGAN round trips
+    per backend, result cache lookups, Redis store time, admissions, and the async
+    queue depth per lane with its estimated backlog.
+    Queue workers serve their own metrics on WORKER_METRICS_PORT.
+    """
+    depths, retrying, backlog = await queue_depths(redis)
+    for lane, depth in depths.items():
+        QUEUE_DEPTH.labels(lane).set(depth)
+    RETRY_DEPTH.set(retrying)
+    BACKLOG_SECONDS.set(backlog)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/health", tags=["System"])
@@ -0,0 +1,82 @@
+"""
+Prometheus metrics for the API and the queue worker.
+
+The API serves them on /metrics; the worker, which has no HTTP server of its
+own, serves them on WORKER_METRICS_PORT.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Upscales of small images take seconds, of large ones minutes
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+HTTP_REQUESTS = Counter(
+    "upscaler_http_requests_total",
+    "HTTP requests handled by the API",
+    ["method", "route", "status"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "upscaler_http_request_seconds",
+    "Time until the response headers are sent",
+    ["method", "route"],
+    buckets=DURATION_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge(
+    "upscaler_http_requests_in_flight", "HTTP requests being handled", ["route"]
+)
+
+UPLOAD_READ_SECONDS = Histogram(
+    "upscaler_upload_read_seconds",
+    "Time to read an uploaded image",
+    ["endpoint"],
+    buckets=DURATION_BUCKETS,
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "upscaler_queue_wait_seconds",
+    "Time async jobs spend queued before a worker starts them",
+    buckets=DURATION_BUCKETS,
+)
+QUEUE_DEPTH = Gauge(
+    "upscaler_queue_depth", "Async jobs queued or running per lane", ["lane"]
+)
+BACKLOG_SECONDS = Gauge(
+    "upscaler_backlog_seconds", "Estimated seconds of work in queued and running jobs"
+)
+ADMISSIONS = Counter(
+    "upscaler_admissions_total",
+    "Async uploads admitted or rejected at admission, by the lane they belong in",
+    ["lane", "outcome"],
+)
+RETRY_DEPTH = Gauge("upscaler_retry_depth", "Async jobs waiting to be retried")
+JOBS = Counter("upscaler_jobs_total", "Async jobs finished by a worker", ["outcome"])
+JOBS_IN_FLIGHT = Gauge("upscaler_jobs_in_flight", "Async jobs a worker is running")
+
+ESRGAN_REQUEST_SECONDS = Histogram(
+    "upscaler_esrgan_request_seconds",
+    "ESRGAN round trip, from sending the upload to the last byte of the result",
+    ["backend"],
+    buckets=DURATION_BUCKETS,
+)
+ESRGAN_REQUESTS = Counter(
+    "upscaler_esrgan_requests_total",
+    "Requests sent to ESRGAN backends",
+    ["backend", "outcome"],
+)
+ESRGAN_OUTSTANDING = Gauge(
+    "upscaler_esrgan_outstanding", "Requests in flight per ESRGAN backend", ["backend"]
+)
+
+CACHE_LOOKUPS = Counter(
+    "upscaler_cache_lookups_total", "Result cache lookups", ["result"]
+)
+REDIS_STORE_SECONDS = Histogram(
+    "upscaler_redis_store_seconds",
+    "Time to write a result to Redis",
+    ["kind"],
+    buckets=DURATION_BUCKETS,
+)
+MEGAPIXELS_PER_SECOND = Gauge(
+    "upscaler_megapixels_per_second",
+    "Input megapixels one ESRGAN worker upscales per second, from recent jobs",
+    ["model"],
+)
@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+
+from redis.asyncio import Redis
+
+# Size of the pieces large values are read and streamed in
+CHUNK_SIZE = 256 * 1024
+
+# Where task results are kept: "file" for a directory shared by the API and
+# workers, or "redis". Redis holds the result metadata either way.
+RESULT_STORE = os.getenv("RESULT_STORE", "file")
+RESULT_DIR = os.getenv("RESULT_DIR", "/data/results")
+
+
+async def iter_redis_value(
+    redis: Redis,
+    key: str,
+    size: int,
+    chunk_size: int = CHUNK_SIZE,
+    start: int = 0,
+) -> AsyncIterator[bytes]:
+    """Read a Redis string in chunks with GETRANGE instead of all at once"""
+    for offset in range(start, size, chunk_size):
+        yield await redis.getrange(key, offset, min(offset + chunk_size, size) - 1)
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    First and last byte of a single "bytes=" Range header, None for the whole file.
+
+    Raises ValueError if the range cannot be satisfied. Multiple ranges are
+    answered with the whole file, which HTTP allows.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes=") :].strip().partition("-")
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError as e:
+        raise ValueError(f"Invalid range {header!r}") from e
+    if start >= size or end < start:
+        raise ValueError(f"Range {header!r} outside {size} bytes")
+    return start, end
+
+
+class ResultStore:
+    """Content-addressed storage for result images, keyed by their SHA-256"""
+
+    async def put(self, data: bytes) -> str:
+        """Store data and return its reference"""
+        raise NotImplementedError
+
+    async def exists(self, ref: str) -> bool:
+        raise NotImplementedError
+
+    def iter_range(self, ref: str, start: int, end: int) -> AsyncIterator[bytes]:
+        """Bytes start to end, inclusive, in chunks"""
+        raise NotImplementedError
+
+    async def delete(self, ref: str) -> None:
+        raise NotImplementedError
+
+
+class FileResultStore(ResultStore):
+    """Results as files in a directory, shared by the API and the workers"""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+
+    def path(self, ref: str) -> Path:
+        return self.directory / ref[:2] / f"{ref}.jpg"
+
+    def _write(self, ref: str, data: bytes) -> None:
+        path = self.path(ref)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written under a temporary name and renamed, so readers never see a
+        # partial file
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    async def put(self, data: bytes) -> str:
+        ref = hashlib.sha256(data).hexdigest()
+        await asyncio.to_thread(self._write, ref, data)
+        return ref
+
+    async def exists(self, ref: str) -> bool:
+        return self.path(ref).exists()
+
+    async def iter_range(self, ref: str, start: int, end: int) -> AsyncIterator[bytes]:
+        with open(self.path(ref), "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    async def delete(self, ref: str) -> None:
+        try:
+            self.path(ref).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class RedisResultStore(ResultStore):
+    """Results as Redis strings, for setups without a shared volume"""
+
+    def __init__(self, redis: Redis, ttl: int):
+        self.redis = redis
+        # A backstop only; results are deleted once no task refers to them
+        self.ttl = ttl
+
+    def key(self, ref: str) -> str:
+        return f"results:blob:{ref}"
+
+    async def put(self, data: bytes) -> str:
+        ref = hashlib.sha256(data).hexdigest()
+        await self.redis.set(self.key(ref), data, ex=self.ttl)
+        return ref
+
+    async def exists(self, ref: str) -> bool:
+        return bool(await self.redis.exists(self.key(ref)))
+
+    def iter_range(self, ref: str, start: int, end: int) -> AsyncIterator[bytes]:
+        return iter_redis_value(self.redis, self.key(ref), end + 1, start=start)
+
+    async def delete(self, ref: str) -> None:
+        await self.redis.delete(self.key(ref))
+
+
+_file_store = FileResultStore(RESULT_DIR)
+
+
+def result_store(redis: Redis, ttl: int) -> ResultStore:
+    """The configured result store, with Redis-backed results kept in redis"""
+    if RESULT_STORE == "file":
+        return _file_store
+    if RESULT_STORE == "redis":
+        return RedisResultStore(redis, ttl)
+    raise ValueError(f"Unknown RESULT_STORE {RESULT_STORE!r}, expected file or redis")
@@ -0,0 +1,82 @@
+import asyncio
+import contextlib
+import json
+import logging
+from collections import defaultdict
+from typing import AsyncIterator, Dict, Optional, Set
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.task_store import TASK_EVENTS_CHANNEL
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the subscription, and between attempts to restore it
+RESUBSCRIBE_DELAY = 1.0
+
+
+class TaskEvents:
+    """
+    Status changes of tasks, pushed to the requests waiting on them.
+
+    Each process holds a single pub/sub subscription, however many clients are
+    waiting, and hands every event to the queues of the requests interested in
+    that task.
+    """
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._waiters: Dict[str, Set["asyncio.Queue[str]"]] = defaultdict(set)
+        self._listener: Optional[asyncio.Task] = None
+        self._subscribed: Optional[asyncio.Event] = None
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, task_id: str) -> AsyncIterator["asyncio.Queue[str]"]:
+        """
+        A queue receiving the new status of task_id on every change.
+
+        Read the current status once subscribed; later changes are then never
+        missed. After the subscription is restored from a lost connection an
+        empty string is queued, as changes may have been missed meanwhile.
+        """
+        if self._listener is None or self._listener.done():
+            self._subscribed = asyncio.Event()
+            self._listener = asyncio.create_task(self._listen())
+        queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._waiters[task_id].add(queue)
+        try:
+            await asyncio.wait_for(self._subscribed.wait(), RESUBSCRIBE_DELAY)
+        except asyncio.TimeoutError:
+            logger.warning("Task events are not subscribed yet")
+        try:
+            yield queue
+        finally:
+            self._waiters[task_id].discard(queue)
+            if not self._waiters[task_id]:
+                del self._waiters[task_id]
+
+    async def _listen(self) -> None:
+        lost = False
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(TASK_EVENTS_CHANNEL)
+                if lost:
+                    for queues in self._waiters.values():
+                        for queue in queues:
+                            queue.put_nowait("")
+                self._subscribed.set()
+                async for message in pubsub.listen():
+                    event = json.loads(message["data"])
+                    for queue in self._waiters.get(event["task_id"], ()):
+                        queue.put_nowait(event["status"])
+            except RedisError as e:
+                logger.error(f"Task events subscription lost: {e}")
+                self._subscribed.clear()
+                lost = True
+                await asyncio.sleep(RESUBSCRIBE_DELAY)
+            finally:
+                await pubsub.aclose()
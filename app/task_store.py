@@ -0,0 +1,355 @@
+import datetime
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import WatchError
+
+from app.storage import result_store
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Every task ID scored by its creation time, so listings read a page of the
+# newest tasks instead of scanning the keyspace
+TASK_INDEX_KEY = "tasks:index"
+# Set once tasks created before the index existed have been added to it
+TASK_INDEX_BACKFILLED_KEY = "tasks:index:backfilled"
+
+# Status values tasks can be listed by. Errors are stored as "error: <reason>"
+# and indexed under "error"; "expired" tasks completed but their result is gone.
+TASK_STATUSES = ("pending", "processing", "completed", "error", "expired", "cancelled")
+
+# Pub/sub channel every status change is announced on, as JSON with the
+# task_id and the new status
+TASK_EVENTS_CHANNEL = "tasks:events"
+
+# Seconds a task is kept after it was created, and a result after it was stored
+TASK_TTL = int(os.getenv("TASK_TTL", str(7 * 24 * 3600)))
+RESULT_TTL = int(os.getenv("RESULT_TTL", str(24 * 3600)))
+
+# Total size of stored results before the oldest are evicted early
+RESULTS_MAX_BYTES = int(os.getenv("RESULTS_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Seconds between the workers' sweeps for expired results, which otherwise
+# only happen as new results are stored
+RESULT_EVICT_INTERVAL = float(os.getenv("RESULT_EVICT_INTERVAL", "60"))
+
+# Task IDs of stored results scored by when they were stored, their sizes and
+# the running total, so eviction never has to look at the results themselves
+RESULT_INDEX_KEY = "results:index"
+RESULT_SIZES_KEY = "results:sizes"
+RESULT_BYTES_KEY = "results:bytes"
+# Result store reference of each task's result, and the number of tasks
+# referring to each stored result; identical results are stored once
+RESULT_REFS_KEY = "results:refs"
+RESULT_REFCOUNTS_KEY = "results:refcounts"
+
+
+def is_final(status: str) -> bool:
+    """Whether a task's status will not change any more"""
+    return status_group(status) in ("completed", "error", "expired", "cancelled")
+
+
+def status_index_key(status: str) -> str:
+    return f"tasks:status:{status}"
+
+
+def status_group(status: str) -> str:
+    """The TASK_STATUSES value a stored status is indexed under"""
+    return status.split(":", 1)[0] if status.startswith("error") else status
+
+
+async def create_task(
+    redis: Redis, task_id: str, fields: Optional[Dict[str, Union[int, float]]] = None
+) -> None:
+    """
+    Record a new pending task and add it to the indexes.
+
+    fields, such as the task's output options, are stored with it.
+    """
+    score = time.time()
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(
+            f"task:{task_id}",
+            mapping={
+                **(fields or {}),
+                "status": "pending",
+                "created_at": datetime.datetime.utcfromtimestamp(score).isoformat(),
+            },
+        )
+        pipe.expire(f"task:{task_id}", TASK_TTL)
+        pipe.zadd(TASK_INDEX_KEY, {task_id: score})
+        pipe.zadd(status_index_key("pending"), {task_id: score})
+        # Tasks older than this have expired, so keep the indexes bounded too
+        for index in (TASK_INDEX_KEY, *map(status_index_key, TASK_STATUSES)):
+            pipe.zremrangebyscore(index, "-inf", f"({score - TASK_TTL!r}")
+        await pipe.execute()
+
+
+async def delete_task(redis: Redis, task_id: str) -> None:
+    """Remove a task and its index entries, as if it had never been created"""
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.delete(f"task:{task_id}")
+        for index in (TASK_INDEX_KEY, *map(status_index_key, TASK_STATUSES)):
+            pipe.zrem(index, task_id)
+        await pipe.execute()
+
+
+def _index_status(pipe: Pipeline, task_id: str, status: str, score: float) -> None:
+    """Queue the writes that set a task's status on a transaction pipeline"""
+    group = status_group(status)
+    pipe.hset(f"task:{task_id}", "status", status)
+    for other in TASK_STATUSES:
+        if other != group:
+            pipe.zrem(status_index_key(other), task_id)
+    pipe.zadd(status_index_key(group), {task_id: score})
+    # Published with the writes, so subscribers never see a status before it is set
+    pipe.publish(
+        TASK_EVENTS_CHANNEL, json.dumps({"task_id": task_id, "status": status})
+    )
+
+
+async def _task_score(redis: Redis, task_id: str) -> Optional[float]:
+    """Creation time of a task as indexed, None if the task has expired"""
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.exists(f"task:{task_id}")
+        pipe.zscore(TASK_INDEX_KEY, task_id)
+        exists, score = await pipe.execute()
+    if not exists:
+        return None
+    return score if score is not None else time.time()
+
+
+async def set_status(
+    redis: Redis,
+    task_id: str,
+    status: str,
+    fields: Optional[Dict[str, Union[int, float]]] = None,
+) -> None:
+    """
+    Update a task's status and move it to the matching status index.
+
+    fields are written to the task in the same transaction.
+    """
+    score = await _task_score(redis, task_id)
+    if score is None:
+        # Writing would recreate the task without its fields or expiry
+        logger.info(f"Task {task_id}: expired, not setting status {status!r}")
+        return
+    async with redis.pipeline(transaction=True) as pipe:
+        if fields:
+            pipe.hset(f"task:{task_id}", mapping=fields)
+        _index_status(pipe, task_id, status, score)
+        await pipe.execute()
+
+
+async def cancel(redis: Redis, task_id: str) -> Optional[str]:
+    """
+    Mark a task cancelled unless it has finished, in one transaction, so a task
+    completing meanwhile is never marked cancelled. Returns the status the task
+    had, None if it has expired.
+    """
+    key = f"task:{task_id}"
+    async with redis.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                # Any status change from here to the write aborts and retries
+                await pipe.watch(key)
+                status = await pipe.hget(key, "status")
+                if status is None:
+                    return None
+                if is_final(status.decode()):
+                    return status.decode()
+                score = await pipe.zscore(TASK_INDEX_KEY, task_id)
+                pipe.multi()
+                _index_status(pipe, task_id, "cancelled", score or time.time())
+                await pipe.execute()
+                return status.decode()
+            except WatchError:
+                continue
+
+
+async def set_progress(
+    redis: Redis, task_id: str, fields: Dict[str, Union[int, float]]
+) -> None:
+    """
+    Record how far a processing task got: tiles_done and tiles_total.
+
+    Announced as a "processing" event, so streaming clients see the progress.
+    """
+    if await _task_score(redis, task_id) is None:
+        return
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(f"task:{task_id}", mapping=fields)
+        pipe.publish(
+            TASK_EVENTS_CHANNEL,
+            json.dumps({"task_id": task_id, "status": "processing"}),
+        )
+        await pipe.execute()
+
+
+async def store_result(redis: Redis, task_id: str, result: bytes) -> None:
+    """
+    Store a task's result and mark it completed.
+
+    The image goes to the result store first; its metadata is then written
+    with its expiry and counted towards RESULTS_MAX_BYTES in one transaction,
+    so a result is only visible once it is complete. The oldest results are
+    then evicted until the total fits.
+    """
+    score = await _task_score(redis, task_id)
+    if score is None:
+        logger.info(f"Task {task_id}: expired, discarding its result")
+        return
+    ref = await result_store(redis, RESULT_TTL).put(result)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(f"result:{task_id}", mapping={"ref": ref, "size": len(result)})
+        pipe.expire(f"result:{task_id}", RESULT_TTL)
+        pipe.zadd(RESULT_INDEX_KEY, {task_id: time.time()})
+        pipe.hset(RESULT_SIZES_KEY, task_id, len(result))
+        pipe.hset(RESULT_REFS_KEY, task_id, ref)
+        pipe.hincrby(RESULT_REFCOUNTS_KEY, ref, 1)
+        pipe.incrby(RESULT_BYTES_KEY, len(result))
+        _index_status(pipe, task_id, "completed", score)
+        await pipe.execute()
+    await evict_results(redis)
+
+
+async def evict_results(redis: Redis) -> None:
+    """Drop results past their TTL, then the oldest until the total fits the quota"""
+    while True:
+        oldest = await redis.zrange(RESULT_INDEX_KEY, 0, 0, withscores=True)
+        if not oldest:
+            return
+        task_id, stored_at = oldest[0][0].decode(), oldest[0][1]
+        if stored_at > time.time() - RESULT_TTL:
+            if int(await redis.get(RESULT_BYTES_KEY) or 0) <= RESULTS_MAX_BYTES:
+                return
+        # Only the process that removes the entry accounts for it
+        if not await redis.zrem(RESULT_INDEX_KEY, task_id):
+            continue
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hget(RESULT_SIZES_KEY, task_id)
+            pipe.hget(RESULT_REFS_KEY, task_id)
+            size, ref = await pipe.execute()
+        size = int(size or 0)
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.delete(f"result:{task_id}")
+            pipe.hdel(RESULT_SIZES_KEY, task_id)
+            pipe.hdel(RESULT_REFS_KEY, task_id)
+            pipe.decrby(RESULT_BYTES_KEY, size)
+            if ref:
+                pipe.hincrby(RESULT_REFCOUNTS_KEY, ref, -1)
+            results = await pipe.execute()
+        if ref and results[-1] <= 0:
+            # No other task has the same result
+            await redis.hdel(RESULT_REFCOUNTS_KEY, ref)
+            await result_store(redis, RESULT_TTL).delete(ref.decode())
+        await set_status(redis, task_id, "expired")
+        logger.info(f"Task {task_id}: result expired ({size} bytes)")
+
+
+async def list_tasks(
+    redis: Redis,
+    limit: int,
+    cursor: Optional[Tuple[float, Optional[str]]] = None,
+    status: Optional[str] = None,
+) -> Tuple[List[Dict[str, str]], Optional[Tuple[float, str]]]:
+    """
+    One page of tasks, newest first, optionally only those with a status.
+
+    The cursor is the score and task ID of the last task of the previous page,
+    as returned for it; None on the last page. Tasks sharing a score are ordered
+    by descending task ID, so a burst created within the same instant is split
+    across pages without skipping any. Costs two round trips whatever the
+    number of stored tasks.
+    """
+    index = status_index_key(status) if status else TASK_INDEX_KEY
+    async with redis.pipeline(transaction=False) as pipe:
+        if cursor is not None:
+            # Tasks sharing the cursor's score, of which those after its task
+            # are still to come
+            pipe.zrevrangebyscore(index, cursor[0], cursor[0], withscores=True)
+        # Tasks created strictly before; one extra tells if more follow
+        pipe.zrevrangebyscore(
+            index,
+            f"({cursor[0]!r}" if cursor is not None else "+inf",
+            "-inf",
+            start=0,
+            num=limit + 1,
+            withscores=True,
+        )
+        pages = await pipe.execute()
+    entries = pages[-1]
+    if cursor is not None:
+        last_id = cursor[1]
+        ties = [
+            (task_id, tie_score)
+            for task_id, tie_score in pages[0]
+            if last_id is not None and task_id.decode() < last_id
+        ]
+        entries = ties + entries
+    next_cursor = None
+    if len(entries) > limit:
+        task_id, score = entries[limit - 1]
+        next_cursor = (score, task_id.decode())
+    entries = entries[:limit]
+
+    async with redis.pipeline(transaction=False) as pipe:
+        for task_id, _ in entries:
+            pipe.hmget(f"task:{task_id.decode()}", "status", "created_at")
+        fields = await pipe.execute()
+
+    tasks = []
+    missing = []
+    for (task_id, _), (task_status, created_at) in zip(entries, fields):
+        if task_status is None:
+            missing.append(task_id)
+            continue
+        tasks.append(
+            {
+                "task_id": task_id.decode(),
+                "status": task_status.decode(),
+                "created_at": (created_at or b"").decode(),
+            }
+        )
+    if missing:
+        # The task hash is gone, so drop it from the indexes too
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.zrem(TASK_INDEX_KEY, *missing)
+            for group in TASK_STATUSES:
+                pipe.zrem(status_index_key(group), *missing)
+            await pipe.execute()
+    return tasks, next_cursor
+
+
+async def backfill_index(redis: Redis) -> None:
+    """Index tasks created before the index existed; runs once per Redis"""
+    if await redis.exists(TASK_INDEX_BACKFILLED_KEY):
+        return
+    count = 0
+    async for key in redis.scan_iter("task:*", count=1000):
+        task_id = key.decode().split(":", 1)[1]
+        task_status, created_at = await redis.hmget(key, "status", "created_at")
+        try:
+            created = datetime.datetime.fromisoformat(created_at.decode())
+            score = created.replace(tzinfo=datetime.timezone.utc).timestamp()
+        except (AttributeError, ValueError):
+            score = time.time()
+        async with redis.pipeline(transaction=False) as pipe:
+            # Tasks from before retention existed expire like new ones
+            pipe.expireat(key, int(score + TASK_TTL), nx=True)
+            pipe.zadd(TASK_INDEX_KEY, {task_id: score}, nx=True)
+            group = status_group((task_status or b"pending").decode())
+            if group in TASK_STATUSES:
+                pipe.zadd(status_index_key(group), {task_id: score}, nx=True)
+            await pipe.execute()
+        count += 1
+    await redis.set(TASK_INDEX_BACKFILLED_KEY, 1)
+    if count:
+        logger.info(f"Added {count} existing task(s) to the task index")
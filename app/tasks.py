@@ -1,26 +1,59 @@
 import logging
 import os
 import time
+from typing import Any, Dict, Optional
 
-import httpx
 from fastapi import UploadFile
 from redis.asyncio import Redis
 
+from app.cache import cached_upscale, upscale_params
+from app.esrgan_client import esrgan
+from app.metrics import REDIS_STORE_SECONDS
+from app.task_store import set_progress, set_status, store_result
+from app.throughput import estimate_seconds, image_size, record_job, work_megapixels
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Least seconds between progress updates written for a task
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "1"))
+
 
 async def process_image(
-    image_data: bytes, content_type: str, redis: Redis, task_id: str
+    image_data: bytes,
+    content_type: str,
+    redis: Redis,
+    task_id: str,
+    output: Optional[Dict[str, Any]] = None,
 ) -> None:
-    """Process the image using Real-ESRGAN service"""
+    """
+    Process the image using Real-ESRGAN service.
+
+    output holds the task's options (model, scale, width, height). Failures are
+    recorded on the task and re-raised so the worker can retry.
+    """
     logger.info(f"Starting background processing for task {task_id}")
     start_time = time.time()
 
     try:
-        # Update status to processing
-        await redis.hset(f"task:{task_id}", "status", "processing")
+        # Update status to processing, with the ETA's starting point until
+        # ESRGAN reports its first tile; a retried task starts its progress over
+        megapixels = work_megapixels(*image_size(image_data), output)
+        model = (output or {}).get("model")
+        await set_status(
+            redis,
+            task_id,
+            "processing",
+            {
+                "started_at": start_time,
+                "estimated_seconds": await estimate_seconds(
+                    redis, megapixels, model=model
+                ),
+                "tiles_done": 0,
+                "tiles_total": 0,
+            },
+        )
         logger.info(
             f"Task {task_id}: Status updated to processing in {time.time() - start_time:.2f}s"
         )
@@ -29,33 +62,54 @@ async def process_image(
             f"Task {task_id}: Processing image data, size: {len(image_data)} bytes"
         )
 
-        # Send to ESRGAN service
-        logger.info(f"Task {task_id}: Sending to ESRGAN service")
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://esrgan:8001/upscale",
-                content=image_data,
-                headers={"Content-Type": content_type or "image/jpeg"},
-                timeout=float(os.getenv("REQUEST_TIMEOUT", "300")),
-            )
-            response.raise_for_status()
-            logger.info(
-                f"Task {task_id}: ESRGAN processing complete in {time.time() - start_time:.2f}s"
+        last_report = 0.0
+
+        async def on_progress(tiles_done: int, tiles_total: int) -> None:
+            nonlocal last_report
+            now = time.time()
+            if tiles_done < tiles_total and now - last_report < PROGRESS_INTERVAL:
+                return
+            last_report = now
+            await set_progress(
+                redis,
+                task_id,
+                {"tiles_done": tiles_done, "tiles_total": tiles_total},
             )
 
-            # Store result in Redis
-            await redis.set(f"result:{task_id}", response.content)
-            await redis.hset(f"task:{task_id}", "status", "completed")
-            logger.info(
-                f"Task {task_id}: Result stored in Redis in {time.time() - start_time:.2f}s"
+        # Send to ESRGAN service, unless the same image was upscaled before
+        logger.info(f"Task {task_id}: Sending to ESRGAN service")
+        upscale_start = time.time()
+        computed = False
+
+        async def compute() -> bytes:
+            nonlocal computed
+            computed = True
+            return await esrgan.upscale(image_data, content_type, on_progress, output)
+
+        params = upscale_params(output)
+        result = await cached_upscale(redis, image_data, compute, params)
+        if computed:
+            await record_job(
+                redis, megapixels, time.time() - upscale_start, model=model
             )
+        logger.info(
+            f"Task {task_id}: ESRGAN processing complete in {time.time() - start_time:.2f}s"
+        )
+
+        # Store result in Redis
+        with REDIS_STORE_SECONDS.labels("result").time():
+            await store_result(redis, task_id, result)
+        logger.info(
+            f"Task {task_id}: Result stored in Redis in {time.time() - start_time:.2f}s"
+        )
 
     except Exception as e:
         error_msg = (
             f"Task {task_id} failed after {time.time() - start_time:.2f}s: {str(e)}"
         )
         logger.error(error_msg)
-        await redis.hset(f"task:{task_id}", "status", f"error: {str(e)}")
+        await set_status(redis, task_id, f"error: {str(e)}")
+        raise
 
 
 async def process_image_background(
@@ -67,7 +121,7 @@ async def process_image_background(
 
     try:
         # Update status to processing
-        await redis.hset(f"task:{task_id}", "status", "processing")
+        await set_status(redis, task_id, "processing")
         logger.info(
             f"Task {task_id}: Status updated to processing in {time.time() - start_time:.2f}s"
         )
@@ -78,28 +132,20 @@ async def process_image_background(
 
         # Send to ESRGAN service
         logger.info(f"Task {task_id}: Sending to ESRGAN service")
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "http://esrgan:8001/upscale",
-                content=image_data,
-                headers={"Content-Type": image.content_type or "image/jpeg"},
-                timeout=float(os.getenv("REQUEST_TIMEOUT", "300")),
-            )
-            response.raise_for_status()
-            logger.info(
-                f"Task {task_id}: ESRGAN processing complete in {time.time() - start_time:.2f}s"
-            )
+        result = await esrgan.upscale(image_data, image.content_type)
+        logger.info(
+            f"Task {task_id}: ESRGAN processing complete in {time.time() - start_time:.2f}s"
+        )
 
-            # Store result in Redis
-            await redis.set(f"result:{task_id}", response.content)
-            await redis.hset(f"task:{task_id}", "status", "completed")
-            logger.info(
-                f"Task {task_id}: Result stored in Redis in {time.time() - start_time:.2f}s"
-            )
+        # Store result in Redis
+        await store_result(redis, task_id, result)
+        logger.info(
+            f"Task {task_id}: Result stored in Redis in {time.time() - start_time:.2f}s"
+        )
 
     except Exception as e:
         error_msg = (
             f"Task {task_id} failed after {time.time() - start_time:.2f}s: {str(e)}"
         )
         logger.error(error_msg)
-        await redis.hset(f"task:{task_id}", "status", f"error: {str(e)}")
+        await set_status(redis, task_id, f"error: {str(e)}")
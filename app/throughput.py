@@ -0,0 +1,127 @@
+import io
+import logging
+import os
+import statistics
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image
+from redis.asyncio import Redis
+
+from app.cache import DEFAULT_PARAMS, MODELS
+from app.metrics import MEGAPIXELS_PER_SECOND
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Megapixels of input one ESRGAN worker upscales per second, measured from
+# recently finished jobs; newest first. Kept per model, the default model's
+# under the bare key.
+THROUGHPUT_KEY = "throughput:samples"
+THROUGHPUT_SAMPLES = int(os.getenv("THROUGHPUT_SAMPLES", "50"))
+
+# Throughput is counted in input megapixels of the x4 model; a job's cost grows
+# with its pixel count times its model's scale
+REFERENCE_SCALE = 4
+
+# Assumed until jobs have been measured
+DEFAULT_MEGAPIXELS_PER_SECOND = float(
+    os.getenv("DEFAULT_MEGAPIXELS_PER_SECOND", "0.05")
+)
+
+
+def image_size(image_data: bytes) -> Tuple[int, int]:
+    """Width and height of an image, read from its header only"""
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            return image.size
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError("Invalid image data") from e
+
+
+def output_factor(
+    width: int, height: int, output: Optional[Dict[str, Any]] = None
+) -> float:
+    """
+    Output size relative to the input for a request's options: its scale, or
+    the most the image can grow within its width and height, at most 4x, or
+    else its model's scale
+    """
+    output = output or {}
+    fits = [
+        output[side] / size
+        for side, size in (("width", width), ("height", height))
+        if output.get(side)
+    ]
+    factor = (
+        min(fits)
+        if fits
+        else output.get("scale") or MODELS.get(output.get("model"), REFERENCE_SCALE)
+    )
+    return min(factor, REFERENCE_SCALE)
+
+
+def work_megapixels(
+    width: int, height: int, output: Optional[Dict[str, Any]] = None
+) -> float:
+    """
+    Input megapixels of the x4 model an upscale amounts to. ESRGAN shrinks the
+    input of smaller outputs first, so the work falls with the output's area.
+    """
+    factor = output_factor(width, height, output)
+    return width * height / 1_000_000 * (factor / REFERENCE_SCALE) ** 2
+
+
+def throughput_key(model: Optional[str] = None) -> str:
+    if not model or model == DEFAULT_PARAMS["model"]:
+        return THROUGHPUT_KEY
+    return f"{THROUGHPUT_KEY}:{model}"
+
+
+async def record_job(
+    redis: Redis,
+    megapixels: float,
+    seconds: float,
+    scale: int = REFERENCE_SCALE,
+    model: Optional[str] = None,
+) -> None:
+    """Add a finished job to the throughput model of the model it ran on"""
+    if megapixels <= 0 or seconds <= 0:
+        return
+    key = throughput_key(model)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.lpush(key, megapixels * scale / REFERENCE_SCALE / seconds)
+        pipe.ltrim(key, 0, THROUGHPUT_SAMPLES - 1)
+        await pipe.execute()
+
+
+async def megapixels_per_second(redis: Redis, model: Optional[str] = None) -> float:
+    """
+    Current throughput of one ESRGAN worker on a model, at REFERENCE_SCALE.
+
+    The median of recent jobs, so one job stuck behind others or served by a
+    faster backend does not swing every estimate. Models without measured jobs
+    are assumed as fast as the default one.
+    """
+    key = throughput_key(model)
+    samples = await redis.lrange(key, 0, -1)
+    if not samples and key != THROUGHPUT_KEY:
+        return await megapixels_per_second(redis)
+    rate = (
+        statistics.median(float(sample) for sample in samples)
+        if samples
+        else DEFAULT_MEGAPIXELS_PER_SECOND
+    )
+    MEGAPIXELS_PER_SECOND.labels(model or DEFAULT_PARAMS["model"]).set(rate)
+    return rate
+
+
+async def estimate_seconds(
+    redis: Redis,
+    megapixels: float,
+    scale: int = REFERENCE_SCALE,
+    model: Optional[str] = None,
+) -> float:
+    """Expected upscale time of an image of the given size on one worker"""
+    cost = megapixels * scale / REFERENCE_SCALE
+    return cost / await megapixels_per_second(redis, model)
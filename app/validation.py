@@ -0,0 +1,84 @@
+import os
+from typing import BinaryIO, NamedTuple
+
+from PIL import Image
+
+# Largest upload accepted, in bytes, and largest image, in input pixels (0: no
+# limit). Larger ones are rejected with 413 before anything reaches ESRGAN. The
+# byte limit is the documented 10MB; the pixel limit only stops absurd images,
+# so 24 MP phone photos pass and whether one fits is up to ESRGAN's memory
+# budget, which answers 413 itself.
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+
+# Image formats accepted, as PIL names them; others are rejected with 415
+ALLOWED_FORMATS = tuple(
+    name.strip().upper()
+    for name in os.getenv("ALLOWED_IMAGE_FORMATS", "JPEG,PNG").split(",")
+    if name.strip()
+)
+
+# Multipart boundaries and part headers around the file; a request body larger
+# than MAX_UPLOAD_BYTES plus this cannot hold an acceptable upload
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+class ImageRejectedError(Exception):
+    """An upload the service will not upscale, with the HTTP status to answer"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ImageInfo(NamedTuple):
+    format: str
+    width: int
+    height: int
+
+    @property
+    def content_type(self) -> str:
+        return Image.MIME.get(self.format, "application/octet-stream")
+
+
+def check_upload_size(size: int) -> None:
+    """Raise ImageRejectedError (413) for an upload of more than MAX_UPLOAD_BYTES"""
+    if MAX_UPLOAD_BYTES and size > MAX_UPLOAD_BYTES:
+        raise ImageRejectedError(
+            f"Upload too large: {size} bytes, the limit is {MAX_UPLOAD_BYTES}", 413
+        )
+
+
+def probe_image(file: BinaryIO) -> ImageInfo:
+    """
+    Format and dimensions of an uploaded image, checked against the limits.
+
+    Only the header is read; no pixels are decoded. Raises ImageRejectedError
+    with 415 for files that are not an image of an allowed format, and 413 for
+    images of more than MAX_IMAGE_PIXELS. The file is rewound afterwards.
+    """
+    try:
+        with Image.open(file) as image:
+            info = ImageInfo(image.format or "", *image.size)
+    except Image.DecompressionBombError as e:
+        raise ImageRejectedError(f"Image too large: {e}", 413) from e
+    except OSError as e:
+        # Includes files PIL cannot identify as any image
+        raise ImageRejectedError("Invalid image data", 415) from e
+    finally:
+        file.seek(0)
+
+    if info.format not in ALLOWED_FORMATS:
+        raise ImageRejectedError(
+            f"Unsupported image format {info.format}, "
+            f"expected {' or '.join(ALLOWED_FORMATS)}",
+            415,
+        )
+    pixels = info.width * info.height
+    if MAX_IMAGE_PIXELS and pixels > MAX_IMAGE_PIXELS:
+        raise ImageRejectedError(
+            f"Image too large: {info.width}x{info.height} is {pixels} pixels, "
+            f"the limit is {MAX_IMAGE_PIXELS}",
+            413,
+        )
+    return info
@@ -0,0 +1,206 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import time
+from typing import Any, Coroutine, Dict, Set
+
+import httpx
+from prometheus_client import start_http_server
+from redis.asyncio import Redis
+
+from app.esrgan_client import EsrganProcessingError
+from app.job_queue import (
+    MAX_ATTEMPTS,
+    VISIBILITY_TIMEOUT,
+    ack,
+    claim_jobs,
+    heartbeat,
+    migrate_stream,
+    promote_due_retries,
+    retry_later,
+)
+from app.metrics import JOBS, JOBS_IN_FLIGHT, QUEUE_WAIT_SECONDS
+from app.task_events import TaskEvents
+from app.task_store import RESULT_EVICT_INTERVAL, evict_results, set_status
+from app.tasks import process_image
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of jobs a single worker process sends to ESRGAN at once
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))
+
+# How long an idle worker waits for new jobs before checking for retries
+POLL_INTERVAL_MS = 1000
+
+# Port serving this worker's Prometheus metrics; 0 disables it
+METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+
+redis = Redis(
+    host=os.environ.get("REDIS_HOST", "redis"),
+    port=int(os.environ.get("REDIS_PORT", "6379")),
+    password=os.environ.get("REDIS_PASSWORD", ""),
+    decode_responses=False,  # Keep binary data for image results
+)
+task_events = TaskEvents(redis)
+
+
+# Client errors that may well succeed when sent again
+RETRYABLE_CLIENT_ERRORS = {408, 429}
+
+
+def is_retryable(err: Exception) -> bool:
+    """
+    Whether a failed job is worth another attempt: ESRGAN rejecting the request
+    itself (4xx, such as an image it cannot decode) fails the same way again
+    """
+    if isinstance(err, EsrganProcessingError):
+        status = err.status_code
+    elif isinstance(err, httpx.HTTPStatusError):
+        status = err.response.status_code
+    else:
+        return True
+    return status >= 500 or status in RETRYABLE_CLIENT_ERRORS
+
+
+async def run_unless_cancelled(task_id: str, work: Coroutine[Any, Any, None]) -> bool:
+    """
+    Run a task's work, stopping it as soon as the task is cancelled.
+
+    Returns False if it was cancelled; exceptions from the work are raised.
+    Stopping the work closes its ESRGAN request, which ends the upscale there.
+    """
+    async with task_events.subscribe(task_id) as changes:
+        # Cancelled between being claimed and subscribing
+        if await redis.hget(f"task:{task_id}", "status") == b"cancelled":
+            work.close()
+            return False
+
+        async def cancelled() -> None:
+            while True:
+                status = await changes.get()
+                if not status:
+                    # Changes may have been missed while resubscribing
+                    stored = await redis.hget(f"task:{task_id}", "status")
+                    status = (stored or b"").decode()
+                if status == "cancelled":
+                    return
+
+        running = asyncio.ensure_future(work)
+        watcher = asyncio.ensure_future(cancelled())
+        try:
+            await asyncio.wait({running, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            running.cancel()
+            raise
+        finally:
+            watcher.cancel()
+        if running.done():
+            running.result()
+            return True
+        running.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await running
+        return False
+
+
+async def handle_job(consumer: str, job: Dict[str, str]) -> None:
+    """Run one queued job, keeping it leased until it is acked or retried"""
+    task_id = job["task_id"]
+    content_type = job.get("content_type", "")
+    output = json.loads(job.get("output") or "{}")
+    if job.get("enqueued_at"):
+        QUEUE_WAIT_SECONDS.observe(time.time() - float(job["enqueued_at"]))
+    attempt = await redis.hincrby(f"task:{task_id}", "attempts", 1)
+    logger.info(
+        f"Task {task_id}: picked up by {consumer} from the {job['lane']} lane "
+        f"(attempt {attempt})"
+    )
+
+    image_data = await redis.get(f"upload:{task_id}")
+    if image_data is None:
+        logger.error(f"Task {task_id}: upload data missing, dropping job")
+        JOBS.labels("dropped").inc()
+        await set_status(redis, task_id, "error: upload data missing")
+        await ack(redis, job)
+        return
+
+    async def keep_alive() -> None:
+        while True:
+            await asyncio.sleep(VISIBILITY_TIMEOUT / 3)
+            await heartbeat(redis, job)
+
+    keep_alive_task = asyncio.create_task(keep_alive())
+    JOBS_IN_FLIGHT.inc()
+    try:
+        work = process_image(image_data, content_type, redis, task_id, output)
+        if await run_unless_cancelled(task_id, work):
+            JOBS.labels("completed").inc()
+        else:
+            JOBS.labels("cancelled").inc()
+            # The work may have set another status before it was stopped
+            await set_status(redis, task_id, "cancelled")
+            logger.info(f"Task {task_id}: cancelled")
+    except Exception as err:
+        if not is_retryable(err):
+            JOBS.labels("failed").inc()
+            logger.error(f"Task {task_id}: rejected by ESRGAN, not retrying")
+        elif attempt < MAX_ATTEMPTS:
+            JOBS.labels("retried").inc()
+            delay = await retry_later(redis, job, attempt)
+            await set_status(redis, task_id, "pending")
+            logger.info(f"Task {task_id}: retrying in {delay:.0f}s")
+            return
+        else:
+            JOBS.labels("failed").inc()
+            logger.error(f"Task {task_id}: giving up after {attempt} attempts")
+    finally:
+        keep_alive_task.cancel()
+        JOBS_IN_FLIGHT.dec()
+
+    await ack(redis, job)
+
+
+async def run_worker() -> None:
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    await migrate_stream(redis)
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+    logger.info(f"Worker {consumer} started with concurrency {WORKER_CONCURRENCY}")
+
+    running: Set[asyncio.Task] = set()
+    next_eviction = time.monotonic() + RESULT_EVICT_INTERVAL
+    while True:
+        for task in [task for task in running if task.done()]:
+            running.discard(task)
+            if not task.cancelled() and task.exception():
+                logger.error(f"Job handler crashed: {task.exception()}")
+
+        # Results past their TTL go even while no new results are stored, and
+        # while every slot is busy
+        if time.monotonic() >= next_eviction:
+            next_eviction = time.monotonic() + RESULT_EVICT_INTERVAL
+            await evict_results(redis)
+
+        free_slots = WORKER_CONCURRENCY - len(running)
+        if free_slots == 0:
+            # Woken in time for the next sweep if no job finishes before it
+            await asyncio.wait(
+                running,
+                timeout=max(0.0, next_eviction - time.monotonic()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            continue
+
+        await promote_due_retries(redis)
+        jobs = await claim_jobs(redis, free_slots, POLL_INTERVAL_MS)
+        for job in jobs:
+            running.add(asyncio.create_task(handle_job(consumer, job)))
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
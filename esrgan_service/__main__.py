@@ -1,4 +1,16 @@
+import os
+
 import uvicorn
 
+# Number of inference processes. With more than one, the model is loaded once
+# and shared by a pool of forked workers.
+WORKERS = int(os.getenv("ESRGAN_WORKERS", "1"))
+PORT = int(os.getenv("ESRGAN_PORT", "8001"))
+
 if __name__ == "__main__":
-    uvicorn.run("esrgan_service.main:app", host="0.0.0.0", port=8001, reload=False)
+    if WORKERS > 1:
+        from esrgan_service.pool import run_pool
+
+        run_pool(WORKERS, f"0.0.0.0:{PORT}")
+    else:
+        uvicorn.run("esrgan_service.main:app", host="0.0.0.0", port=PORT, reload=False)
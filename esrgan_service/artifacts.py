@@ -0,0 +1,84 @@
+"""
+Pre-serialized models, so restarts and new replicas skip building them.
+
+Building a model imports basicsr, loads its weights and, with inference modes,
+optimizes and quality checks it, which takes from seconds to minutes on CPU.
+The model as it ends up running is saved once as a frozen TorchScript archive
+in ESRGAN_ARTIFACT_DIR, named after everything it is built from: the weights
+file, the model, the inference modes, the device and the torch version. Later
+starts load the archive instead, in under a second, for as long as none of
+those change.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, ContextManager, Dict, List, Tuple
+
+import torch
+
+from esrgan_service.models import ModelSpec
+
+METADATA_FILE = "metadata.json"
+
+
+def artifact_path(
+    directory: str, model_path: str, spec: ModelSpec, device: str, modes: List[str]
+) -> Path:
+    """Where the archive of a model built with these settings is kept"""
+    weights = os.stat(model_path)
+    key = json.dumps(
+        [
+            os.path.abspath(model_path),
+            weights.st_size,
+            weights.st_mtime_ns,
+            spec.name,
+            device,
+            sorted(modes),
+            torch.__version__,
+        ]
+    )
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return Path(directory) / f"{spec.name}-{digest}.pt"
+
+
+def save_artifact(
+    path: Path,
+    model: torch.nn.Module,
+    example: torch.Tensor,
+    context: ContextManager,
+    metadata: Dict[str, Any],
+) -> None:
+    """
+    Trace and freeze the model on example inside context (such as autocast),
+    unless it is TorchScript already, and save it with its metadata
+    """
+    if not isinstance(model, torch.jit.ScriptModule):
+        with torch.no_grad(), context:
+            model = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written under a temporary name and moved into place, so replicas
+    # starting at the same time never load a half-written archive
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".pt.tmp")
+    os.close(fd)
+    try:
+        torch.jit.save(
+            model, tmp_path, _extra_files={METADATA_FILE: json.dumps(metadata)}
+        )
+        # Readable by replicas running as other users, unlike mkstemp's default
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_artifact(
+    path: Path, device: str
+) -> Tuple[torch.jit.ScriptModule, Dict[str, Any]]:
+    """A saved model, on device, and the metadata saved with it"""
+    extra_files = {METADATA_FILE: ""}
+    model = torch.jit.load(str(path), map_location=device, _extra_files=extra_files)
+    return model, json.loads(extra_files[METADATA_FILE])
@@ -0,0 +1,277 @@
+"""
+Inference backends for the ESRGAN model.
+
+A backend runs the model on batches of CHW float32 tiles; tiling, batching and
+the HTTP API are the same whichever backend is used. ESRGAN_BACKEND selects:
+
+    torch  eager PyTorch, with the CPU inference modes from optimize.py. With
+           an artifact directory, the model as built is saved there as
+           TorchScript and loaded from it on later starts, see artifacts.py.
+    onnx   ONNX Runtime on CPU. The weights are exported to ONNX once and the
+           graph is cached next to them on the models volume.
+"""
+
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+
+from esrgan_service.artifacts import artifact_path, load_artifact, save_artifact
+from esrgan_service.models import DEFAULT_MODEL, MODELS, ModelSpec
+from esrgan_service.optimize import (
+    autocast,
+    bf16_supported,
+    load_model,
+    memory_format_for,
+    prepare,
+    quality_check,
+    reference_tiles,
+    runner,
+)
+
+BACKENDS = ("torch", "onnx")
+
+
+class InferenceBackend:
+    name = ""
+    scale = 4
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        """Run the model on a batch of CHW float32 tiles"""
+        raise NotImplementedError
+
+    def info(self) -> Dict[str, Any]:
+        return {"backend": self.name, "scale": self.scale}
+
+    def model_bytes(self) -> int:
+        """Memory taken by the model weights"""
+        raise NotImplementedError
+
+
+class TorchBackend(InferenceBackend):
+    name = "torch"
+
+    def __init__(
+        self,
+        model_path: str,
+        device: str,
+        modes: List[str],
+        quality_tiles: int,
+        min_psnr: float,
+        spec: ModelSpec = MODELS[DEFAULT_MODEL],
+        artifact_dir: Optional[str] = None,
+    ):
+        self.scale = spec.scale
+        self.device = device
+        self.half = device != "cpu"  # Use half precision only on GPU
+        self.requested = modes or ["fp32"]
+        self.modes = ["fp32"]
+        self.quality: Optional[Dict[str, float]] = None
+        self.artifact: Optional[str] = None
+
+        artifact = (
+            artifact_path(artifact_dir, model_path, spec, device, self.requested)
+            if artifact_dir
+            else None
+        )
+        if artifact is not None and artifact.exists():
+            # Built, optimized and checked by an earlier start
+            model, metadata = load_artifact(artifact, device)
+            self.modes = metadata["modes"]
+            self.quality = metadata["quality"]
+            self.bytes = metadata["model_bytes"]
+            self.run_model = runner(model, self.modes)
+            self.artifact = str(artifact)
+            print(f"Loaded {spec.name} from {artifact}")
+            return
+
+        model = load_model(model_path, spec)
+        model = model.half().to(device) if self.half else model
+        self.bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+        prepared = self._prepare(model, modes, quality_tiles, min_psnr)
+        self.run_model = runner(prepared, self.modes)
+        if artifact is None:
+            return
+        if "compile" in self.modes:
+            print("torch.compile models cannot be saved, building them on every start")
+            return
+
+        example = torch.rand(1, 3, 64, 64, device=device)
+        example = example.half() if self.half else example
+        try:
+            save_artifact(
+                artifact,
+                prepared,
+                example.contiguous(memory_format=memory_format_for(self.modes)),
+                autocast(self.modes),
+                {
+                    "modes": self.modes,
+                    "quality": self.quality,
+                    "model_bytes": self.bytes,
+                },
+            )
+        except Exception as err:
+            print(f"Could not save {spec.name} to {artifact}: {err}")
+            return
+        self.artifact = str(artifact)
+        print(f"Saved {spec.name} to {artifact} for the next start")
+
+    def _prepare(
+        self,
+        model: torch.nn.Module,
+        modes: List[str],
+        quality_tiles: int,
+        min_psnr: float,
+    ) -> torch.nn.Module:
+        """The model with the requested modes applied, if they keep its quality"""
+        if modes and self.device != "cpu":
+            print(f"Ignoring inference modes {modes}: they apply to CPU only")
+            return model
+        if "bf16" in modes and not bf16_supported():
+            print("CPU has no native bfloat16 support, running without bf16")
+            modes = [mode for mode in modes if mode != "bf16"]
+        if not modes:
+            return model
+
+        # Compare with fp32 on reference tiles and keep the optimized model
+        # only if it is close enough
+        tiles = reference_tiles(limit=quality_tiles)
+        prepared = prepare(model, modes, tiles)
+        self.quality = quality_check(model, runner(prepared, modes), tiles)
+        print(f"Inference modes {modes}: {self.quality}")
+        if self.quality["min_psnr_db"] < min_psnr:
+            print(f"Inference modes {modes} fall below {min_psnr} dB PSNR, using fp32")
+            return model
+        self.modes = modes
+        return prepared
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            tensor = torch.from_numpy(batch).to(self.device)
+            if self.half:
+                tensor = tensor.half()
+            return self.run_model(tensor).float().cpu().numpy()
+
+    def model_bytes(self) -> int:
+        return self.bytes
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "scale": self.scale,
+            "modes": self.modes,
+            "requested": self.requested,
+            "quality": self.quality,
+            "artifact": self.artifact,
+        }
+
+
+def export_onnx(
+    model_path: str, onnx_path: Path, spec: ModelSpec = MODELS[DEFAULT_MODEL]
+) -> None:
+    """Export the PyTorch weights to an ONNX graph with dynamic batch and size"""
+    model = load_model(model_path, spec)
+    example = torch.rand(1, 3, 64, 64)
+    # Written under a temporary name and moved into place, so processes
+    # starting at the same time never load a half-written graph
+    fd, tmp_path = tempfile.mkstemp(dir=onnx_path.parent, suffix=".onnx.tmp")
+    os.close(fd)
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                example,
+                tmp_path,
+                input_names=["input"],
+                output_names=["output"],
+                dynamic_axes={
+                    "input": {0: "batch", 2: "height", 3: "width"},
+                    "output": {0: "batch", 2: "height", 3: "width"},
+                },
+                opset_version=17,
+            )
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, onnx_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class OnnxBackend(InferenceBackend):
+    name = "onnx"
+
+    def __init__(
+        self,
+        model_path: str,
+        onnx_path: Optional[str] = None,
+        spec: ModelSpec = MODELS[DEFAULT_MODEL],
+    ):
+        self.scale = spec.scale
+        try:
+            import onnxruntime
+        except ImportError as err:
+            raise RuntimeError(
+                "The onnx backend needs onnxruntime: pip install onnxruntime"
+            ) from err
+        self._ort = onnxruntime
+
+        self.onnx_path = Path(onnx_path or Path(model_path).with_suffix(".onnx"))
+        if not self.onnx_path.exists():
+            print(f"Exporting {model_path} to {self.onnx_path}...")
+            export_onnx(model_path, self.onnx_path, spec)
+        # Sessions start their own thread pools, so they are created on first
+        # use: after a pre-fork server has forked and set the thread count
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        ort = self._ort
+        with self._lock:
+            if self._session is None:
+                options = ort.SessionOptions()
+                options.graph_optimization_level = (
+                    ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                )
+                options.intra_op_num_threads = torch.get_num_threads()
+                self._session = ort.InferenceSession(
+                    str(self.onnx_path),
+                    sess_options=options,
+                    providers=["CPUExecutionProvider"],
+                )
+            return self._session
+
+    def forward(self, batch: np.ndarray) -> np.ndarray:
+        return self._get_session().run(None, {"input": batch})[0]
+
+    def model_bytes(self) -> int:
+        # The initializers make up nearly all of the graph file
+        return self.onnx_path.stat().st_size
+
+    def info(self) -> Dict[str, Any]:
+        return {"backend": self.name, "scale": self.scale, "graph": str(self.onnx_path)}
+
+
+def create_backend(
+    name: str,
+    model_path: str,
+    device: str,
+    modes: List[str],
+    quality_tiles: int,
+    min_psnr: float,
+    onnx_path: Optional[str] = None,
+    spec: ModelSpec = MODELS[DEFAULT_MODEL],
+    artifact_dir: Optional[str] = None,
+) -> InferenceBackend:
+    if name == "torch":
+        return TorchBackend(
+            model_path, device, modes, quality_tiles, min_psnr, spec, artifact_dir
+        )
+    if name == "onnx":
+        if device != "cpu":
+            print("The onnx backend runs on CPU only")
+        return OnnxBackend(model_path, onnx_path, spec)
+    raise ValueError(f"Unknown inference backend {name!r}, expected one of {BACKENDS}")
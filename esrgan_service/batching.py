@@ -0,0 +1,102 @@
+"""
+Dynamic micro-batching of tiles across concurrent requests.
+
+Tiles are grouped by shape. A group is run as one batched forward pass as soon
+as it reaches max_batch_size tiles, or when its oldest tile has waited
+max_wait seconds, whichever comes first.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+@dataclass
+class _PendingTile:
+    tile: np.ndarray
+    future: "Future[np.ndarray]" = field(default_factory=Future)
+    enqueued: float = field(default_factory=time.monotonic)
+
+
+class TileBatcher:
+    def __init__(
+        self,
+        forward: Callable[[np.ndarray], np.ndarray],
+        max_batch_size: int,
+        max_wait: float,
+    ):
+        self.forward = forward
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self._groups: Dict[Tuple[int, ...], List[_PendingTile]] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def submit(self, tile: np.ndarray) -> "Future[np.ndarray]":
+        """Queue one CHW tile; the future resolves to its upscaled tile"""
+        pending = _PendingTile(tile)
+        with self._cond:
+            # Started lazily so no thread exists before a pre-fork server forks
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="tile-batcher", daemon=True
+                )
+                self._thread.start()
+            self._groups.setdefault(tile.shape, []).append(pending)
+            self._cond.notify()
+        return pending.future
+
+    def close(self) -> None:
+        """Stop the batching thread once the tiles already queued have run"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _next_batch(self) -> Optional[List[_PendingTile]]:
+        with self._cond:
+            while not self._groups:
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+            # Serve the group holding the oldest tile first
+            shape, group = min(
+                self._groups.items(), key=lambda item: item[1][0].enqueued
+            )
+            deadline = group[0].enqueued + self.max_wait
+            while len(group) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = group[: self.max_batch_size]
+            del group[: self.max_batch_size]
+            if not group:
+                del self._groups[shape]
+            return batch
+
+    def _run(self) -> None:
+        while (queued := self._next_batch()) is not None:
+            batch = [
+                pending
+                for pending in queued
+                if pending.future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+
+            try:
+                outputs = self.forward(np.stack([pending.tile for pending in batch]))
+            except Exception as err:
+                for pending in batch:
+                    pending.future.set_exception(err)
+                continue
+
+            for pending, output in zip(batch, outputs):
+                pending.future.set_result(output)
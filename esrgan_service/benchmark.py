@@ -0,0 +1,323 @@
+"""
+Inference benchmark for the ESRGAN pipeline.
+
+Runs the same decode, upscale and encode pipeline as /upscale, in-process, over
+a grid of image sizes, tile sizes, thread counts, backends and canvases (in
+memory, or memory-mapped on disk as for large images). For every case
+it records per-stage latency, throughput in input megapixels per second and
+peak RSS, and writes the results to a JSON file. Given a baseline file from an
+earlier run it reports the change per case and exits non-zero on regressions.
+
+    python -m esrgan_service.benchmark --sizes 128x128 256x256 --threads 1 2 \\
+        --backends torch onnx torch:channels_last,bf16 \\
+        --output benchmark.json --baseline baseline.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from esrgan_service.backends import InferenceBackend, create_backend
+from esrgan_service.batching import TileBatcher
+from esrgan_service.budget import choose_tile_size
+from esrgan_service.optimize import REFERENCE_DIR, parse_modes
+from esrgan_service.pipeline import process_image
+
+TILE_PAD = 10
+TILE_MEMORY = 2048 * 1024 * 1024
+
+# Fields identifying a case, used to match results against the baseline
+CASE_KEYS = ("backend", "image", "size", "tile", "canvas", "threads", "batch_size")
+# Values of keys added since older baselines were written
+CASE_DEFAULTS = {"canvas": "memory"}
+
+
+def parse_size(value: str) -> Tuple[int, int]:
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def synthetic_image(width: int, height: int) -> Image.Image:
+    """Deterministic test image: smooth gradients with edges and some noise"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = [127 + 100 * np.sin(x / 17 + c) * np.cos(y / 23 - c) for c in range(3)]
+    image = np.stack(channels, axis=-1)
+    image[(x // 32 + y // 32) % 2 == 0] += 40
+    image += rng.normal(0, 6, image.shape)
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8))
+
+
+def reference_image(width: int, height: int) -> Image.Image:
+    path = sorted(REFERENCE_DIR.glob("*.jpg"))[0]
+    return Image.open(path).convert("RGB").resize((width, height), Image.BICUBIC)
+
+
+def encode_jpeg(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No /proc: fall back to the lifetime peak, reported in KiB on Linux
+        # and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakRss:
+    """Samples RSS in a background thread and keeps the highest value seen"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "PeakRss":
+        self.peak = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def make_backend(spec: str, model_path: str) -> InferenceBackend:
+    """Backend from "name" or "name:mode,mode", e.g. torch:channels_last,bf16"""
+    name, _, modes = spec.partition(":")
+    # Modes are benchmarked as asked for, however they score
+    return create_backend(name, model_path, "cpu", parse_modes(modes), 1, 0.0)
+
+
+def run_case(
+    backend: InferenceBackend,
+    batcher: TileBatcher,
+    image_data: bytes,
+    width: int,
+    height: int,
+    tile: str,
+    canvas: str,
+    batch_size: int,
+    repeat: int,
+) -> Dict[str, Any]:
+    if tile == "auto":
+        tile_size = choose_tile_size(height, width, TILE_PAD, TILE_MEMORY, batch_size)
+    else:
+        tile_size = int(tile)
+
+    stages: Dict[str, List[float]] = {"decode": [], "inference": [], "encode": []}
+    totals = []
+    with PeakRss() as rss:
+        # One untimed run first, so lazy initialisation is not measured
+        for run in range(repeat + 1):
+            timings: Dict[str, float] = {}
+            start = time.perf_counter()
+            output = process_image(
+                image_data,
+                batcher.submit,
+                backend.scale,
+                tile_size,
+                TILE_PAD,
+                2 * batch_size,
+                large=canvas == "disk",
+                timings=timings,
+            )
+            total = time.perf_counter() - start
+            output.close()
+            if run:
+                totals.append(total)
+                for stage, seconds in timings.items():
+                    stages[stage].append(seconds)
+
+    total = statistics.median(totals)
+    result: Dict[str, Any] = {
+        f"{stage}_ms": round(statistics.median(values) * 1000, 1)
+        for stage, values in stages.items()
+    }
+    result.update(
+        {
+            "total_ms": round(total * 1000, 1),
+            "mpix_per_s": round(width * height / 1e6 / total, 4),
+            "peak_rss_mb": round(rss.peak / 2**20, 1),
+            "tile_size": tile_size,
+        }
+    )
+    return result
+
+
+def run_grid(args: argparse.Namespace) -> Iterator[Dict[str, Any]]:
+    sizes = [parse_size(size) for size in args.sizes]
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for spec in args.backends:
+            # Built per thread count: ONNX Runtime fixes it per session
+            backend = make_backend(spec, args.model)
+            batcher = TileBatcher(backend.forward, args.batch_size, 0.01)
+            try:
+                yield from run_backend(args, spec, threads, backend, batcher, sizes)
+            finally:
+                batcher.close()
+
+
+def run_backend(
+    args: argparse.Namespace,
+    spec: str,
+    threads: int,
+    backend: InferenceBackend,
+    batcher: TileBatcher,
+    sizes: List[Tuple[int, int]],
+) -> Iterator[Dict[str, Any]]:
+    for image_name in args.images:
+        for width, height in sizes:
+            make_image = (
+                synthetic_image if image_name == "synthetic" else reference_image
+            )
+            image_data = encode_jpeg(make_image(width, height))
+            for tile in args.tiles:
+                for canvas in args.canvases:
+                    case = {
+                        "backend": spec,
+                        "image": image_name,
+                        "size": f"{width}x{height}",
+                        "tile": tile,
+                        "canvas": canvas,
+                        "threads": threads,
+                        "batch_size": args.batch_size,
+                    }
+                    result = run_case(
+                        backend,
+                        batcher,
+                        image_data,
+                        width,
+                        height,
+                        tile,
+                        canvas,
+                        args.batch_size,
+                        args.repeat,
+                    )
+                    print(json.dumps({**case, **result}), flush=True)
+                    yield {**case, **result}
+
+
+def case_key(result: Dict[str, Any]) -> Tuple:
+    return tuple(str(result.get(key, CASE_DEFAULTS.get(key))) for key in CASE_KEYS)
+
+
+def compare(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float
+) -> List[str]:
+    """Print the change against the baseline per case; return the regressions"""
+    previous = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(case_key(result))
+        if before is None:
+            continue
+        for metric in ("total_ms", "peak_rss_mb"):
+            change = result[metric] / before[metric] - 1 if before[metric] else 0.0
+            line = (
+                f"{' '.join(case_key(result))} {metric}: "
+                f"{before[metric]} -> {result[metric]} ({change:+.1%})"
+            )
+            print(line)
+            if change > tolerance:
+                regressions.append(line)
+    return regressions
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the ESRGAN pipeline")
+    parser.add_argument("--model", default="/app/models/RealESRGAN_x4plus.pth")
+    parser.add_argument("--sizes", nargs="+", default=["128x128", "256x256"])
+    parser.add_argument(
+        "--tiles",
+        nargs="+",
+        default=["auto", "0", "128"],
+        help="Tile sizes; 0 disables tiling, auto picks like the service does",
+    )
+    parser.add_argument(
+        "--canvases",
+        nargs="+",
+        choices=["memory", "disk"],
+        default=["memory", "disk"],
+        help="Upscale into memory, or into a memory-mapped file as large images are",
+    )
+    parser.add_argument(
+        "--threads", nargs="+", type=int, default=[torch.get_num_threads()]
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["torch"],
+        help="Backends with optional inference modes, e.g. torch:channels_last,bf16",
+    )
+    parser.add_argument(
+        "--images", nargs="+", choices=["synthetic", "reference"], default=["synthetic"]
+    )
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="Earlier output to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed slowdown or memory growth against the baseline",
+    )
+    args = parser.parse_args(argv)
+
+    results = list(run_grid(args))
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+        },
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.tolerance:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Memory-aware tile sizing and admission.
+
+Each request is charged an estimate of the memory it needs while it runs.
+Requests are admitted against a shared budget, so the total stays under a
+ceiling however many arrive at once, and each request's tile size is chosen
+so that a full batch of its tiles fits the per-forward-pass budget.
+"""
+
+import asyncio
+import math
+from typing import Dict, Optional
+
+# Peak activation memory of RRDBNet x4plus per input pixel, measured on CPU
+# in fp32 with torch.no_grad()
+ACTIVATION_BYTES_PER_PIXEL = 16 * 1024
+
+# PIL keeps decoded RGB images at four bytes per pixel
+DECODED_BYTES_PER_PIXEL = 4
+
+# Tile sizes are rounded to this step so tiles from different requests often
+# share a shape and can be batched together
+TILE_STEP = 32
+MIN_TILE_SIZE = 64
+
+
+def choose_tile_size(
+    height: int, width: int, tile_pad: int, tile_memory: int, batch_size: int
+) -> int:
+    """
+    Pick a tile size for an image; 0 means process it whole.
+
+    Images whose activations fit in tile_memory are not tiled at all. Otherwise
+    the largest tile is used such that batch_size padded tiles fit together.
+    """
+    if height * width * ACTIVATION_BYTES_PER_PIXEL <= tile_memory:
+        return 0
+    return largest_tile_size(tile_pad, tile_memory, batch_size)
+
+
+def largest_tile_size(tile_pad: int, tile_memory: int, batch_size: int) -> int:
+    """The largest tile size for which batch_size padded tiles fit tile_memory"""
+    tile_pixels = tile_memory / (ACTIVATION_BYTES_PER_PIXEL * batch_size)
+    tile_size = int(math.sqrt(tile_pixels)) - 2 * tile_pad
+    return max(MIN_TILE_SIZE, tile_size // TILE_STEP * TILE_STEP)
+
+
+def fit_tile_size(
+    height: int,
+    width: int,
+    scale: int,
+    tile_pad: int,
+    window: int,
+    canvas_in_memory: bool,
+    tile_memory: int,
+    batch_size: int,
+    budget: int,
+) -> int:
+    """
+    choose_tile_size for a process whose requests may use budget bytes each.
+
+    A budget smaller than tile_memory (a worker pool's share of it) caps the
+    tile memory, and an image too large to run whole within the budget, with
+    its input, canvas and tiles in flight, is tiled even if its activations
+    alone would fit.
+    """
+    tile_memory = min(tile_memory, budget)
+    tile_size = choose_tile_size(height, width, tile_pad, tile_memory, batch_size)
+    whole = estimate_request_bytes(
+        height, width, scale, 0, tile_pad, window, canvas_in_memory
+    )
+    if tile_size == 0 and whole > budget:
+        return largest_tile_size(tile_pad, tile_memory, batch_size)
+    return tile_size
+
+
+def estimate_request_bytes(
+    height: int,
+    width: int,
+    scale: int,
+    tile_size: int,
+    tile_pad: int,
+    window: int,
+    canvas_in_memory: bool,
+) -> int:
+    """Working memory a request needs: decoded input, canvas and tiles in flight"""
+    if tile_size > 0:
+        tile_h = min(height, tile_size + 2 * tile_pad)
+        tile_w = min(width, tile_size + 2 * tile_pad)
+    else:
+        tile_h, tile_w = height, width
+    tile_pixels = tile_h * tile_w
+
+    decoded = height * width * DECODED_BYTES_PER_PIXEL
+    canvas = height * width * scale * scale * 3 if canvas_in_memory else 0
+    activations = tile_pixels * ACTIVATION_BYTES_PER_PIXEL
+    # float32 input and output of every tile waiting in the batcher
+    in_flight = window * tile_pixels * 3 * 4 * (1 + scale * scale)
+    return decoded + canvas + activations + in_flight
+
+
+class MemoryBudget:
+    """Shared memory budget that requests reserve from before they run"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.used = 0
+        # Created on first use, inside the server's event loop
+        self._cond: Optional[asyncio.Condition] = None
+
+    @property
+    def cond(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self, nbytes: int, timeout: float) -> None:
+        """Wait up to timeout seconds for nbytes to be free, then reserve them"""
+        async with self.cond:
+            await asyncio.wait_for(
+                self.cond.wait_for(lambda: self.used + nbytes <= self.total),
+                timeout,
+            )
+            self.used += nbytes
+
+    def release(self, nbytes: int) -> None:
+        """Return reserved bytes; must be called from the event loop thread"""
+        self.used -= nbytes
+
+        async def notify() -> None:
+            async with self.cond:
+                self.cond.notify_all()
+
+        asyncio.ensure_future(notify())
+
+    def stats(self) -> Dict[str, int]:
+        return {"used_bytes": self.used, "total_bytes": self.total}
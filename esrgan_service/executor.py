@@ -0,0 +1,82 @@
+"""
+Bounded executor for blocking image work.
+
+Decode, inference and encode run on a small dedicated thread pool so the event
+loop stays free for health checks. The number of accepted jobs is capped; once
+the queue is full new jobs are refused immediately instead of piling up.
+"""
+
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+
+class QueueFullError(Exception):
+    """Raised when the executor cannot accept more work"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class BoundedExecutor:
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        # Threads are created on first submit, so forking before then is safe
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._accepted = 0
+        # Moving average of job duration, used to estimate Retry-After
+        self._avg_duration = 0.0
+
+    @property
+    def running(self) -> int:
+        return min(self._accepted, self.max_workers)
+
+    @property
+    def queued(self) -> int:
+        return max(self._accepted - self.max_workers, 0)
+
+    @property
+    def saturated(self) -> bool:
+        return self._accepted >= self.max_workers + self.max_queue
+
+    def retry_after(self) -> int:
+        """Seconds until a queue slot is likely to free up"""
+        waves = self._accepted / self.max_workers
+        return max(1, math.ceil(self._avg_duration * waves))
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run fn(*args) on the pool, raising QueueFullError if it is saturated"""
+        with self._lock:
+            if self.saturated:
+                raise QueueFullError(self.retry_after())
+            self._accepted += 1
+
+        def timed() -> Any:
+            start = time.monotonic()
+            try:
+                return fn(*args)
+            finally:
+                duration = time.monotonic() - start
+                with self._lock:
+                    self._accepted -= 1
+                    self._avg_duration = (
+                        duration
+                        if not self._avg_duration
+                        else 0.8 * self._avg_duration + 0.2 * duration
+                    )
+
+        return await asyncio.wrap_future(self._executor.submit(timed))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+        }
@@ -1,12 +1,54 @@
+import asyncio
 import io
+import json
 import os
+import threading
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    Optional,
+    Tuple,
+)
 
 import numpy as np
 import torch
-from basicsr.archs.rrdbnet_arch import RRDBNet
-from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from PIL import Image
-from realesrgan import RealESRGANer
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from esrgan_service import pipeline
+from esrgan_service.backends import InferenceBackend, create_backend
+from esrgan_service.batching import TileBatcher
+from esrgan_service.budget import (
+    DECODED_BYTES_PER_PIXEL,
+    MIN_TILE_SIZE,
+    MemoryBudget,
+    choose_tile_size,
+    estimate_request_bytes,
+    fit_tile_size,
+)
+from esrgan_service.executor import BoundedExecutor, QueueFullError
+from esrgan_service.metrics import (
+    BATCH_SIZE,
+    IN_FLIGHT,
+    MEMORY_RESERVED_BYTES,
+    MEMORY_WAIT_SECONDS,
+    REQUEST_SECONDS,
+    REQUESTS,
+    STAGE_SECONDS,
+    TILE_SECONDS,
+    render,
+)
+from esrgan_service.models import DEFAULT_FAMILY, DEFAULT_MODEL, MODELS, ModelSpec
+from esrgan_service.optimize import parse_modes
+from esrgan_service.registry import LoadedModel, ModelRegistry
+from esrgan_service.tiling import OnTile, UpscaleCancelled
 
 # Determine if we should use GPU
 USE_GPU = os.getenv("USE_GPU", "0").lower() in ("true", "1", "t")
@@ -14,7 +56,24 @@ DEVICE = "cuda" if USE_GPU and torch.cuda.is_available() else "cpu"
 
 print(f"Initializing Real-ESRGAN using device: {DEVICE}")
 
-MODEL_PATH = "/app/models/RealESRGAN_x4plus.pth"
+MODEL_PATH = os.getenv("MODEL_PATH", "/app/models/RealESRGAN_x4plus.pth")
+
+# Native 2x model, used when the output is at most twice the input size. Without
+# it those outputs come from the x4 model run on an input shrunk to half size.
+MODEL_X2_PATH = os.getenv(
+    "MODEL_X2_PATH", os.path.join(os.path.dirname(MODEL_PATH), "RealESRGAN_x2plus.pth")
+)
+
+# Weights of the other models, see esrgan_service/models.py, as <name>.pth
+MODEL_DIR = os.getenv("MODEL_DIR", os.path.dirname(MODEL_PATH))
+MODEL_PATHS = {name: os.path.join(MODEL_DIR, f"{name}.pth") for name in MODELS}
+MODEL_PATHS[DEFAULT_MODEL] = MODEL_PATH
+MODEL_PATHS["RealESRGAN_x2plus"] = MODEL_X2_PATH
+
+# Memory the models loaded on demand may take together in each worker process
+# before the least recently used are unloaded (0: no limit). The default model
+# is loaded at startup and always kept.
+MODEL_MEMORY_MB = int(os.getenv("ESRGAN_MODEL_MEMORY_MB", "512"))
 
 # Verify model exists
 if not os.path.exists(MODEL_PATH):
@@ -25,25 +84,123 @@ if not os.path.exists(MODEL_PATH):
 # Get request timeout from environment
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "60"))
 
-# Initialize model once at startup
-print("Initializing Real-ESRGAN...")
-model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32)
-upsampler = RealESRGANer(
-    scale=4,
-    model_path=MODEL_PATH,
-    model=model,
-    tile=200,  # Use smaller tiles on CPU to manage memory
-    tile_pad=10,
-    pre_pad=0,
-    half=USE_GPU,  # Use half precision only on GPU
-    device=DEVICE,
+# Tiles of the same shape from concurrent requests are run together, up to
+# this many per forward pass, waiting at most this long for a batch to fill
+MAX_BATCH_SIZE = int(os.getenv("ESRGAN_MAX_BATCH_SIZE", "4"))
+MAX_BATCH_WAIT_MS = float(os.getenv("ESRGAN_MAX_BATCH_WAIT_MS", "10"))
+
+# Images processed at once (decode, inference and encode), and how many more
+# may wait for a thread before new requests get a 503
+INFERENCE_WORKERS = int(os.getenv("ESRGAN_INFERENCE_WORKERS", "2"))
+QUEUE_DEPTH = int(os.getenv("ESRGAN_QUEUE_DEPTH", "4"))
+
+# Size above which the upscaled image is built in a memory-mapped file under
+# ESRGAN_SPOOL_DIR instead of in RAM
+LARGE_IMAGE_PIXELS = int(os.getenv("ESRGAN_LARGE_IMAGE_PIXELS", str(2000 * 2000)))
+SPOOL_DIR = os.getenv("ESRGAN_SPOOL_DIR") or None
+
+# Working memory all in-flight requests may use together (split between the
+# processes of a worker pool), memory a single batched forward pass may use,
+# never more than a process's budget, and how long a request waits for memory
+# before getting a 503
+MEMORY_BUDGET_MB = int(os.getenv("ESRGAN_MEMORY_BUDGET_MB", "3072")) // int(
+    os.getenv("ESRGAN_WORKERS", "1")
 )
+TILE_MEMORY_MB = min(int(os.getenv("ESRGAN_TILE_MEMORY_MB", "2048")), MEMORY_BUDGET_MB)
+MEMORY_WAIT = float(os.getenv("ESRGAN_MEMORY_WAIT", "30"))
+TILE_PAD = 10
+
+# Tiles in flight per request, enough to fill a batch
+TILE_WINDOW = 2 * MAX_BATCH_SIZE
+
+# Content type of /upscale responses reporting progress
+PROGRESS_MEDIA_TYPE = "application/x-ndjson"
+
+# Inference backend: "torch" or "onnx", see esrgan_service/backends.py. The
+# ONNX graph is exported next to the weights unless ESRGAN_ONNX_PATH is set.
+BACKEND = os.getenv("ESRGAN_BACKEND", "torch")
+ONNX_PATH = os.getenv("ESRGAN_ONNX_PATH") or None
+
+# CPU inference modes of the torch backend, see esrgan_service/optimize.py. The
+# optimized model is compared with fp32 on ESRGAN_QUALITY_TILES reference tiles
+# at startup, and the service falls back to fp32 if any tile scores below
+# ESRGAN_MIN_PSNR dB.
+INFERENCE_MODES = parse_modes(os.getenv("ESRGAN_INFERENCE_MODES", ""))
+QUALITY_TILES = int(os.getenv("ESRGAN_QUALITY_TILES", "4"))
+MIN_PSNR = float(os.getenv("ESRGAN_MIN_PSNR", "30"))
+
+# Directory where the torch backend keeps each model as built, optimized and
+# checked, so later starts load it in a second, see esrgan_service/artifacts.py
+ARTIFACT_DIR = os.getenv("ESRGAN_ARTIFACT_DIR") or None
+
+# Tile sides run through the default model at startup, before the service
+# reports ready, so the first requests do not pay for lazy allocation or kernel
+# selection: by default the smallest tile and the one large images are split
+# into. Empty disables the warm-up.
+WARMUP_TILES = [
+    int(size)
+    for size in os.getenv(
+        "ESRGAN_WARMUP_TILES",
+        f"{MIN_TILE_SIZE},"
+        + str(
+            choose_tile_size(
+                8192, 8192, TILE_PAD, TILE_MEMORY_MB * 1024 * 1024, MAX_BATCH_SIZE
+            )
+        ),
+    ).split(",")
+    if size.strip()
+]
+
+
+def recorded(backend: InferenceBackend) -> Callable[[np.ndarray], np.ndarray]:
+    """The backend's forward pass, recording batch size and tile time"""
+
+    def forward(batch: np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        output = backend.forward(batch)
+        per_tile = (time.perf_counter() - start) / len(batch)
+        BATCH_SIZE.observe(len(batch))
+        for _ in range(len(batch)):
+            TILE_SECONDS.observe(per_tile)
+        return output
+
+    return forward
+
+
+def load_model(spec: ModelSpec, path: str) -> LoadedModel:
+    """Build a model's backend and its batcher, as only its own tiles share a batch"""
+    backend = create_backend(
+        BACKEND,
+        path,
+        DEVICE,
+        INFERENCE_MODES,
+        QUALITY_TILES,
+        MIN_PSNR,
+        ONNX_PATH if spec.name == DEFAULT_MODEL else None,
+        spec,
+        ARTIFACT_DIR,
+    )
+    batcher = TileBatcher(recorded(backend), MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS / 1000)
+    return LoadedModel(spec, backend, batcher)
+
+
+registry = ModelRegistry(MODEL_PATHS, load_model, MODEL_MEMORY_MB * 1024 * 1024)
+if not registry.installed("RealESRGAN_x2plus"):
+    print(f"No x2 model at {MODEL_X2_PATH}, 2x outputs use the x4 model")
+
+# The default model, once loaded, and how far startup has got: "loading" it,
+# "warming_up", "ready", or "failed" when it could not be loaded
+default_model: Optional[LoadedModel] = None
+startup_state = "loading"
 
 if DEVICE == "cpu":
     print("Running on CPU mode...")
 else:
     print("Running on GPU mode...")
 
+executor = BoundedExecutor(INFERENCE_WORKERS, QUEUE_DEPTH)
+memory_budget = MemoryBudget(MEMORY_BUDGET_MB * 1024 * 1024)
+
 app = FastAPI(
     title="Real-ESRGAN Service",
     # Set longer timeout for the whole application
@@ -51,76 +208,447 @@ app = FastAPI(
 )
 
 
+def load_default_model() -> LoadedModel:
+    """Load the default model, unless a worker pool did before forking"""
+    global default_model
+    if default_model is None:
+        print(f"Initializing Real-ESRGAN with the {BACKEND} backend...")
+        default_model = registry.preload(DEFAULT_MODEL)
+    return default_model
+
+
+def warm_up(backend: InferenceBackend) -> None:
+    """Run one tile of each warm-up size through the model"""
+    for size in WARMUP_TILES:
+        side = size + 2 * TILE_PAD
+        start = time.perf_counter()
+        backend.forward(np.random.rand(1, 3, side, side).astype(np.float32))
+        print(
+            f"Warmed up on a {side}x{side} tile in {time.perf_counter() - start:.1f}s"
+        )
+
+
+def start_up() -> None:
+    """Load and warm up the default model. Blocking; runs on its own thread."""
+    global startup_state
+    try:
+        backend = load_default_model().backend
+        startup_state = "warming_up"
+        warm_up(backend)
+    except Exception as err:
+        print(f"Startup failed: {err}")
+        startup_state = "failed"
+        return
+    startup_state = "ready"
+    print("Ready to serve requests")
+
+
+@app.on_event("startup")
+async def start_loading():
+    # In the background, so /health answers while the model loads; requests
+    # arriving before then wait for it
+    threading.Thread(target=start_up, name="model-loader", daemon=True).start()
+
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    route = request.url.path
+    upscale = route == "/upscale"
+    if upscale:
+        IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        if upscale:
+            IN_FLIGHT.dec()
+        REQUEST_SECONDS.labels(route).observe(time.perf_counter() - start)
+        REQUESTS.labels(route, status).inc()
+
+
 @app.get("/health")
-def health_check():
-    """Health check endpoint that returns the current device being used"""
+async def health_check():
+    """
+    Liveness check: status "starting" until the model is loaded and warmed up,
+    then "healthy", and 500 if it could not be loaded.
+
+    Runs on the event loop rather than a worker thread, so it answers promptly
+    even while every inference thread is busy, or the model is loading.
+    """
+    if startup_state == "failed":
+        raise HTTPException(500, "ESRGAN service failed to load its model")
     try:
         # Try to create a small tensor to verify CUDA/CPU is working
         device = torch.device(DEVICE)
         torch.tensor([1.0], device=device)
         return {
-            "status": "healthy",
+            "status": "healthy" if startup_state == "ready" else "starting",
+            "startup": startup_state,
             "device": DEVICE,
             "gpu_available": torch.cuda.is_available() if USE_GPU else False,
+            "executor": executor.stats(),
+            "memory": memory_budget.stats(),
+            "inference": default_model.backend.info() if default_model else None,
+            "models": [
+                model["name"] for model in registry.stats()["models"] if model["loaded"]
+            ],
         }
     except Exception as err:
         raise HTTPException(500, "ESRGAN service is unhealthy") from err
 
 
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """
+    Readiness check: 503 until the model is loaded and warmed up, and while the
+    inference queue cannot accept more work
+    """
+    if startup_state != "ready":
+        response.status_code = 503
+        return {"status": startup_state, "executor": executor.stats()}
+    if executor.saturated:
+        response.status_code = 503
+        response.headers["Retry-After"] = str(executor.retry_after())
+        return {"status": "busy", "executor": executor.stats()}
+    return {"status": "ready", "executor": executor.stats()}
+
+
+@app.get("/models")
+async def list_models():
+    """Known models: whether installed and loaded, their memory and last use"""
+    return registry.stats()
+
+
+def process_image(
+    image_data: bytes,
+    plan: pipeline.OutputPlan,
+    model_name: str,
+    tile_size: int,
+    large: bool,
+    on_tile: Optional[OnTile] = None,
+    cancel: Optional[threading.Event] = None,
+) -> BinaryIO:
+    """Run the upscale pipeline for one request. Blocking; runs on the executor."""
+    timings: Dict[str, float] = {}
+    try:
+        if cancel is not None and cancel.is_set():
+            # Abandoned while it was queued
+            raise UpscaleCancelled("Cancelled before it started")
+        if plan.model_scale is None:
+            return pipeline.resize_image(
+                image_data, plan.output_size, SPOOL_DIR, timings
+            )
+        # Loads the model first if no recent request used it
+        with registry.use(model_name) as model:
+            return pipeline.process_image(
+                image_data,
+                model.batcher.submit,
+                plan.model_scale,
+                tile_size,
+                TILE_PAD,
+                TILE_WINDOW,
+                large,
+                SPOOL_DIR,
+                timings,
+                on_tile,
+                cancel,
+                plan.input_size,
+                plan.output_size,
+            )
+    except pipeline.InvalidImageError as err:
+        raise HTTPException(400, "Invalid image data") from err
+    except UpscaleCancelled as err:
+        print(f"Upscale stopped: {err}")
+        raise HTTPException(499, "Client closed request") from err
+    finally:
+        for stage, seconds in timings.items():
+            STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+async def watch_disconnect(request: Request, cancel: threading.Event) -> None:
+    """Set cancel once the client goes away, so its upscale stops between tiles"""
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            print("Client disconnected, cancelling its upscale")
+            cancel.set()
+            return
+
+
+def iter_file(file: BinaryIO, chunk_size: int = 256 * 1024) -> Iterator[bytes]:
+    """Stream a file in chunks, closing (and so deleting) it when done"""
+    try:
+        while chunk := file.read(chunk_size):
+            yield chunk
+    finally:
+        file.close()
+
+
+def frame(**fields: Any) -> bytes:
+    return json.dumps(fields).encode() + b"\n"
+
+
+async def progress_frames(
+    job: "asyncio.Future[BinaryIO]",
+    progress: "asyncio.Queue[Tuple[int, int]]",
+    initial: Optional[Tuple[int, int]],
+) -> AsyncIterator[bytes]:
+    """
+    Body of a progress response: one JSON line per finished tile, then either
+    {"size": n} followed by the n bytes of the JPEG, or {"error", "status"}.
+    """
+    if initial is not None:
+        done, total = initial
+        yield frame(tiles_done=done, tiles_total=total)
+    while True:
+        update = asyncio.ensure_future(progress.get())
+        await asyncio.wait({job, update}, return_when=asyncio.FIRST_COMPLETED)
+        if not update.done():
+            update.cancel()
+            break
+        done, total = update.result()
+        yield frame(tiles_done=done, tiles_total=total)
+    while not progress.empty():
+        done, total = progress.get_nowait()
+        yield frame(tiles_done=done, tiles_total=total)
+
+    try:
+        output = job.result()
+    except HTTPException as err:
+        yield frame(error=err.detail, status=err.status_code)
+        return
+    except Exception as err:
+        print(f"Unexpected error: {str(err)}")
+        yield frame(error=f"Unexpected error during processing: {err}", status=500)
+        return
+    yield frame(size=os.fstat(output.fileno()).st_size)
+    for chunk in iter_file(output):
+        yield chunk
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics, aggregated over all pool workers"""
+    return Response(render(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post("/upscale")
-async def upscale_image(request: Request):
+async def upscale_image(
+    request: Request,
+    tile: Optional[int] = Query(
+        None,
+        ge=0,
+        le=4096,
+        description=f"Tile size override, at least {MIN_TILE_SIZE}; 0 disables "
+        "tiling. Chosen automatically by default.",
+    ),
+    progress: bool = Query(
+        False, description="Report tiles as they finish before sending the image"
+    ),
+    scale: Optional[float] = Query(
+        None, ge=1, le=4, description="Output size relative to the input (default 4)"
+    ),
+    target_width: Optional[int] = Query(
+        None, alias="width", ge=1, description="Fit the output within this width"
+    ),
+    target_height: Optional[int] = Query(
+        None, alias="height", ge=1, description="Fit the output within this height"
+    ),
+    model_name: Optional[str] = Query(
+        None,
+        alias="model",
+        description="Model to upscale with, see /models. By default the x4 or x2 "
+        "model, whichever is enough for the output size.",
+    ),
+):
     """
     Upscale an image using Real-ESRGAN.
     Accepts raw binary image data with a content type header.
     Returns the upscaled image as JPEG.
+    Returns 413 when the image cannot fit in the memory budget, and 503 with a
+    Retry-After header when the inference queue or memory budget is full.
+    If the client disconnects, the upscale stops after the tiles in flight.
+
+    The output is 4x the input unless scale, or a width and/or height to fit
+    the output within keeping the aspect ratio, ask for less. The x2 model is
+    used when it is enough, and the input is shrunk first when the model would
+    overshoot, so only the pixels needed are upscaled. Another model, such as
+    the lighter realesr-general-x4v3, can be chosen by name; it is loaded on
+    first use and unloaded when others need its memory.
+
+    With progress, the response starts once processing does and is a stream of
+    JSON lines, {"tiles_done", "tiles_total"} per tile, ending in {"size"}
+    followed by that many bytes of JPEG, or in {"error", "status"}.
     """
+    content_type = request.headers.get("content-type", "")
+    print(f"Received request with content-type: {content_type}")
+
+    if not content_type.startswith("image/"):
+        raise HTTPException(
+            status_code=400, detail="Content-Type must be an image format"
+        )
+
+    # Get the raw image data
+    image_data = await request.body()
+    print(f"Received image data, size: {len(image_data)} bytes")
+
+    # Only the header is read here; pixels are decoded on the executor
     try:
-        content_type = request.headers.get("content-type", "")
-        print(f"Received request with content-type: {content_type}")
+        width, height = Image.open(io.BytesIO(image_data)).size
+    except Exception as err:
+        raise HTTPException(400, "Invalid image data") from err
 
-        if not content_type.startswith("image/"):
-            raise HTTPException(
-                status_code=400, detail="Content-Type must be an image format"
-            )
+    if tile and tile < MIN_TILE_SIZE:
+        raise HTTPException(
+            422, f"tile must be 0 or at least {MIN_TILE_SIZE}, got {tile}"
+        )
+    if scale is not None and (target_width or target_height):
+        raise HTTPException(400, "Pass either scale or width and height, not both")
+    if model_name is None:
+        candidates = [MODELS[name] for name in DEFAULT_FAMILY]
+    elif model_name in MODELS:
+        candidates = [MODELS[model_name]]
+    else:
+        raise HTTPException(
+            400, f"Unknown model {model_name}, expected one of {', '.join(MODELS)}"
+        )
+    by_scale = {
+        spec.scale: spec.name for spec in candidates if registry.installed(spec.name)
+    }
+    if not by_scale:
+        raise HTTPException(400, f"Model {model_name} is not installed")
+    plan = pipeline.plan_output(
+        width, height, sorted(by_scale), scale, target_width, target_height
+    )
+    in_width, in_height = plan.input_size
+    out_width, out_height = plan.output_size
+    large = in_width * in_height > LARGE_IMAGE_PIXELS
+    if plan.model_scale is None:
+        tile_size = 0
+    elif tile is None:
+        tile_size = fit_tile_size(
+            in_height,
+            in_width,
+            plan.model_scale,
+            TILE_PAD,
+            TILE_WINDOW,
+            not large,
+            TILE_MEMORY_MB * 1024 * 1024,
+            MAX_BATCH_SIZE,
+            memory_budget.total,
+        )
+    else:
+        # The model needs even tile sides when it upscales 2x
+        tile_size = tile - tile % 2
+    if plan.model_scale is None:
+        cost = (width * height + out_width * out_height) * DECODED_BYTES_PER_PIXEL
+    else:
+        model_scale = plan.model_scale
+        cost = estimate_request_bytes(
+            in_height,
+            in_width,
+            model_scale,
+            tile_size,
+            TILE_PAD,
+            TILE_WINDOW,
+            not large,
+        )
+        # The decoded input until it is shrunk, and the output once resized
+        if plan.input_size != (width, height):
+            cost += width * height * DECODED_BYTES_PER_PIXEL
+        if plan.output_size != (in_width * model_scale, in_height * model_scale):
+            cost += out_width * out_height * DECODED_BYTES_PER_PIXEL
+    model_name = by_scale.get(plan.model_scale or 0, "")
+    print(
+        f"Image {width}x{height} to {out_width}x{out_height}: "
+        f"{model_name or 'resize only'} on "
+        f"{in_width}x{in_height}, tile size {tile_size}, needs {cost >> 20} MB"
+    )
+    if cost > memory_budget.total:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image too large: needs {cost >> 20} MB, "
+            f"budget is {memory_budget.total >> 20} MB",
+        )
 
-        # Get the raw image data
-        image_data = await request.body()
-        print(f"Received image data, size: {len(image_data)} bytes")
-
-        # Convert to PIL Image
-        try:
-            image = Image.open(io.BytesIO(image_data))
-            print(f"Loaded image: {image.format}, size: {image.size}")
-            image = image.convert("RGB")
-        except Exception as err:
-            raise HTTPException(400, "Invalid image data") from err
-
-        # Check image size
-        max_pixels = 2000 * 2000  # Max 4MP image
-        if image.size[0] * image.size[1] > max_pixels:
-            raise HTTPException(
-                status_code=413,
-                detail=f"Image too large. Max size: {max_pixels} pixels",
-            )
+    # Watches the connection from here until the work ends, the whole body
+    # having been read
+    cancel = threading.Event()
+    watcher = asyncio.ensure_future(watch_disconnect(request, cancel))
+    try:
+        with MEMORY_WAIT_SECONDS.time():
+            await memory_budget.acquire(cost, MEMORY_WAIT)
+    except asyncio.TimeoutError as err:
+        watcher.cancel()
+        raise HTTPException(
+            status_code=503,
+            detail="Memory budget is exhausted, try again later",
+            headers={"Retry-After": str(executor.retry_after())},
+        ) from err
+    MEMORY_RESERVED_BYTES.set(memory_budget.used)
 
-        print("Processing image with Real-ESRGAN...")
-        try:
-            output, _ = upsampler.enhance(np.array(image))
-            print(f"Processing complete, output shape: {output.shape}")
-            output_image = Image.fromarray(output)
-            output_buffer = io.BytesIO()
-            output_image.save(output_buffer, format="JPEG")
-            output_buffer.seek(0)
-            return Response(
-                content=output_buffer.read(),
-                media_type="image/jpeg",
-            )
-        except Exception as err:
-            print(f"Unexpected error: {str(err)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Unexpected error during processing: {str(err)}",
-            ) from err
+    def release(_: asyncio.Future) -> None:
+        memory_budget.release(cost)
+        MEMORY_RESERVED_BYTES.set(memory_budget.used)
+        watcher.cancel()
+
+    updates: "asyncio.Queue[Tuple[int, int]]" = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    def on_tile(done: int, total: int) -> None:
+        loop.call_soon_threadsafe(updates.put_nowait, (done, total))
 
+    try:
+        job = asyncio.ensure_future(
+            executor.run(
+                process_image,
+                image_data,
+                plan,
+                model_name,
+                tile_size,
+                large,
+                on_tile if progress else None,
+                cancel,
+            )
+        )
+        # Keep the memory reserved until the work itself ends, even if this
+        # request is abandoned while it runs
+        job.add_done_callback(release)
+        if progress:
+            # Answer once the first tile is done, so a job refused or failing
+            # right away still gets its status code
+            first = asyncio.ensure_future(updates.get())
+            await asyncio.wait({job, first}, return_when=asyncio.FIRST_COMPLETED)
+            initial = first.result() if first.done() else None
+            first.cancel()
+            if not job.done() or job.exception() is None:
+                return StreamingResponse(
+                    progress_frames(job, updates, initial),
+                    media_type=PROGRESS_MEDIA_TYPE,
+                )
+        output = await asyncio.shield(job)
+        size = os.fstat(output.fileno()).st_size
+    except QueueFullError as err:
+        print(f"Rejecting request: {err}")
+        raise HTTPException(
+            status_code=503,
+            detail=str(err),
+            headers={"Retry-After": str(err.retry_after)},
+        ) from err
     except HTTPException:
         raise
+    except Exception as err:
+        print(f"Unexpected error: {str(err)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Unexpected error during processing: {str(err)}",
+        ) from err
+
+    return StreamingResponse(
+        iter_file(output),
+        media_type="image/jpeg",
+        headers={"Content-Length": str(size)},
+    )
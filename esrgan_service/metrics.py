@@ -0,0 +1,86 @@
+"""
+Prometheus metrics for the ESRGAN service.
+
+With a pre-fork worker pool every process keeps its own values; pool.py then
+sets PROMETHEUS_MULTIPROC_DIR so they are aggregated over all workers, however
+many of them a scrape happens to reach.
+"""
+
+import os
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Upscales of small images take seconds, of large ones minutes
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUESTS = Counter(
+    "esrgan_http_requests_total", "HTTP requests handled", ["route", "status"]
+)
+REQUEST_SECONDS = Histogram(
+    "esrgan_http_request_seconds",
+    "Time until the response headers are sent",
+    ["route"],
+    buckets=DURATION_BUCKETS,
+)
+IN_FLIGHT = Gauge(
+    "esrgan_requests_in_flight",
+    "Upscale requests being handled",
+    multiprocess_mode="livesum",
+)
+
+MEMORY_WAIT_SECONDS = Histogram(
+    "esrgan_memory_wait_seconds",
+    "Time requests wait for the memory budget",
+    buckets=DURATION_BUCKETS,
+)
+MEMORY_RESERVED_BYTES = Gauge(
+    "esrgan_memory_reserved_bytes",
+    "Working memory reserved by requests in flight",
+    multiprocess_mode="livesum",
+)
+MODEL_BYTES = Gauge(
+    "esrgan_model_bytes",
+    "Memory taken by the weights of each loaded model, 0 once evicted",
+    ["model"],
+    multiprocess_mode="max",
+)
+MODEL_LOADS = Counter(
+    "esrgan_model_loads_total", "Models loaded for a request", ["model"]
+)
+MODEL_EVICTIONS = Counter(
+    "esrgan_model_evictions_total",
+    "Models unloaded to make room for another",
+    ["model"],
+)
+
+STAGE_SECONDS = Histogram(
+    "esrgan_stage_seconds",
+    "Time per request spent decoding, upscaling and encoding",
+    ["stage"],
+    buckets=DURATION_BUCKETS,
+)
+TILE_SECONDS = Histogram(
+    "esrgan_tile_seconds",
+    "Inference time per tile, the batch time split over its tiles",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+BATCH_SIZE = Histogram(
+    "esrgan_batch_size", "Tiles per forward pass", buckets=(1, 2, 4, 8, 16, 32)
+)
+
+
+def render() -> bytes:
+    """Current metrics in the Prometheus text format"""
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
@@ -0,0 +1,64 @@
+"""
+Real-ESRGAN model variants the service can run.
+
+Each request picks one by name; weights are looked up as <name>.pth in the
+models directory and only loaded once a request needs them, see registry.py.
+"""
+
+from dataclasses import dataclass
+
+import torch
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    name: str
+    # Native upscaling factor
+    scale: int
+    # "rrdb" for RRDBNet, or "srvgg" for the far lighter SRVGGNetCompact
+    arch: str
+    # RRDB blocks, or SRVGG convolutions
+    depth: int
+
+
+MODELS = {
+    spec.name: spec
+    for spec in (
+        ModelSpec("RealESRGAN_x4plus", 4, "rrdb", 23),
+        ModelSpec("RealESRGAN_x2plus", 2, "rrdb", 23),
+        ModelSpec("RealESRGAN_x4plus_anime_6B", 4, "rrdb", 6),
+        ModelSpec("realesr-general-x4v3", 4, "srvgg", 32),
+    )
+}
+
+DEFAULT_MODEL = "RealESRGAN_x4plus"
+
+# Models chosen from, by the output size asked for, when a request names none
+DEFAULT_FAMILY = ("RealESRGAN_x4plus", "RealESRGAN_x2plus")
+
+
+def build_model(spec: ModelSpec) -> torch.nn.Module:
+    """The network of a model variant, without its weights"""
+    if spec.arch == "rrdb":
+        from basicsr.archs.rrdbnet_arch import RRDBNet
+
+        return RRDBNet(
+            num_in_ch=3,
+            num_out_ch=3,
+            scale=spec.scale,
+            num_feat=64,
+            num_block=spec.depth,
+            num_grow_ch=32,
+        )
+    if spec.arch == "srvgg":
+        from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+
+        return SRVGGNetCompact(
+            num_in_ch=3,
+            num_out_ch=3,
+            num_feat=64,
+            num_conv=spec.depth,
+            upscale=spec.scale,
+            act_type="prelu",
+        )
+    raise ValueError(f"Unknown model architecture {spec.arch!r}")
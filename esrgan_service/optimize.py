@@ -0,0 +1,243 @@
+"""
+CPU inference modes for the ESRGAN model, and a quality check for them.
+
+Modes are combined from a comma separated list:
+
+    channels_last  NHWC memory layout, which oneDNN convolutions prefer
+    bf16           bfloat16 autocast; needs a CPU with native bfloat16 support
+    int8           static post-training int8 quantization, calibrated on the
+                   reference images
+    torchscript    traced and frozen TorchScript graph
+    compile        torch.compile; needs a C++ compiler at runtime
+
+Every mode changes the numbers the model produces, so the quality check runs
+the reference images through the plain fp32 model and the optimized one and
+reports the PSNR between their outputs. Run it for every mode with:
+
+    python -m esrgan_service.optimize --model /app/models/RealESRGAN_x4plus.pth
+"""
+
+import argparse
+import copy
+import math
+import time
+from contextlib import nullcontext
+from pathlib import Path
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import numpy as np
+import torch
+from PIL import Image
+
+from esrgan_service.models import DEFAULT_MODEL, MODELS, ModelSpec, build_model
+from esrgan_service.tiling import from_model_output, to_model_input
+
+INFERENCE_MODES = ("channels_last", "bf16", "int8", "torchscript", "compile")
+
+REFERENCE_DIR = Path(__file__).parent / "reference"
+REFERENCE_TILE_SIZE = 64
+
+RunModel = Callable[[torch.Tensor], torch.Tensor]
+
+
+def parse_modes(value: str) -> List[str]:
+    """Validate a comma separated list of inference modes"""
+    modes = [mode.strip().lower() for mode in value.split(",") if mode.strip()]
+    modes = [mode for mode in modes if mode != "fp32"]
+    unknown = sorted(set(modes) - set(INFERENCE_MODES))
+    if unknown:
+        raise ValueError(
+            f"Unknown inference modes {unknown}, expected any of {INFERENCE_MODES}"
+        )
+    if "int8" in modes and "bf16" in modes:
+        raise ValueError("int8 and bf16 inference modes cannot be combined")
+    if "torchscript" in modes and "compile" in modes:
+        raise ValueError("torchscript and compile inference modes cannot be combined")
+    return modes
+
+
+def bf16_supported() -> bool:
+    return torch.backends.mkldnn.is_available() and bool(
+        torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    )
+
+
+def reference_tiles(
+    tile_size: int = REFERENCE_TILE_SIZE,
+    limit: Optional[int] = None,
+    directory: Path = REFERENCE_DIR,
+) -> List[torch.Tensor]:
+    """Single-tile model inputs cut from the reference images, at most limit"""
+    tiles = []
+    for path in sorted(directory.glob("*.jpg")):
+        image = np.asarray(Image.open(path).convert("RGB"))
+        height, width = image.shape[:2]
+        for y in range(0, height - tile_size + 1, tile_size):
+            for x in range(0, width - tile_size + 1, tile_size):
+                region = image[y : y + tile_size, x : x + tile_size]
+                tiles.append(torch.from_numpy(to_model_input(region))[None])
+    if not tiles:
+        raise RuntimeError(f"No reference images found in {directory}")
+    if limit is not None and len(tiles) > limit:
+        # Spread the tiles over the images instead of taking the first corner
+        step = len(tiles) / limit
+        tiles = [tiles[int(i * step)] for i in range(limit)]
+    return tiles
+
+
+def prepare(
+    model: torch.nn.Module, modes: Sequence[str], calibration: List[torch.Tensor]
+) -> torch.nn.Module:
+    """
+    Apply inference modes to an fp32 CPU model.
+
+    The model is left untouched; the modes are applied to a copy, which runner()
+    runs. bf16 is applied by runner() as it runs the model.
+    """
+    model = copy.deepcopy(model).eval()
+    example = calibration[0]
+
+    if "int8" in modes:
+        # Dynamic quantization only covers Linear and recurrent layers; RRDBNet
+        # is all convolutions, so quantize statically with calibrated observers
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        model = prepare_fx(model, get_default_qconfig_mapping("x86"), (example,))
+        with torch.no_grad():
+            for batch in calibration:
+                model(batch)
+        model = convert_fx(model)
+
+    memory_format = memory_format_for(modes)
+    if "channels_last" in modes:
+        model = model.to(memory_format=memory_format)
+
+    if "torchscript" in modes:
+        with torch.no_grad():
+            model = torch.jit.freeze(
+                torch.jit.trace(model, example.contiguous(memory_format=memory_format))
+            )
+    elif "compile" in modes:
+        model = torch.compile(model, dynamic=True)
+    return model
+
+
+def memory_format_for(modes: Sequence[str]) -> torch.memory_format:
+    if "channels_last" in modes:
+        return torch.channels_last
+    return torch.contiguous_format
+
+
+def autocast(modes: Sequence[str]) -> ContextManager:
+    if "bf16" in modes:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def runner(model: torch.nn.Module, modes: Sequence[str]) -> RunModel:
+    """Run a prepared model on a batch of CHW float32 tiles, with float32 output"""
+    memory_format = memory_format_for(modes)
+
+    def run(batch: torch.Tensor) -> torch.Tensor:
+        batch = batch.contiguous(memory_format=memory_format)
+        with torch.no_grad(), autocast(modes):
+            return model(batch).float()
+
+    return run
+
+
+def optimize(
+    model: torch.nn.Module, modes: Sequence[str], calibration: List[torch.Tensor]
+) -> RunModel:
+    """An optimized copy of an fp32 CPU model, see prepare()"""
+    return runner(prepare(model, modes, calibration), modes)
+
+
+def psnr(reference: np.ndarray, output: np.ndarray) -> float:
+    """Peak signal-to-noise ratio between two 8-bit images, in dB"""
+    mse = np.mean((reference.astype(np.float64) - output.astype(np.float64)) ** 2)
+    return math.inf if mse == 0 else 10 * math.log10(255.0**2 / mse)
+
+
+def _run_timed(
+    run: RunModel, tiles: List[torch.Tensor]
+) -> Tuple[List[np.ndarray], float]:
+    outputs = []
+    start = time.perf_counter()
+    for batch in tiles:
+        outputs.extend(from_model_output(tile) for tile in run(batch).numpy())
+    return outputs, time.perf_counter() - start
+
+
+def quality_check(
+    model: torch.nn.Module, run: RunModel, tiles: List[torch.Tensor]
+) -> Dict[str, float]:
+    """Compare an optimized model with the fp32 model on reference tiles"""
+    reference_run = optimize(model, [], tiles)
+    # Warm up both first, so one-off tracing or compilation is not timed
+    reference_run(tiles[0])
+    run(tiles[0])
+
+    reference, reference_time = _run_timed(reference_run, tiles)
+    outputs, duration = _run_timed(run, tiles)
+    scores = [psnr(ref, out) for ref, out in zip(reference, outputs)]
+    return {
+        "psnr_db": round(float(np.mean(scores)), 2),
+        "min_psnr_db": round(min(scores), 2),
+        "speedup": round(reference_time / duration, 2),
+    }
+
+
+def load_model(model_path: str, spec: Optional[ModelSpec] = None) -> torch.nn.Module:
+    """Load the weights of a model variant, RealESRGAN_x4plus by default"""
+    model = build_model(spec or MODELS[DEFAULT_MODEL])
+    state = torch.load(model_path, map_location="cpu")
+    model.load_state_dict(state.get("params_ema", state.get("params", state)))
+    return model.eval()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare ESRGAN CPU inference modes with fp32 on reference images"
+    )
+    parser.add_argument("--model", default="/app/models/RealESRGAN_x4plus.pth")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=list(INFERENCE_MODES) + ["channels_last,bf16"],
+        help="Mode combinations to check, e.g. channels_last,bf16",
+    )
+    parser.add_argument("--tile-size", type=int, default=REFERENCE_TILE_SIZE)
+    parser.add_argument("--tiles", type=int, default=None, help="Reference tiles used")
+    args = parser.parse_args(argv)
+
+    model = load_model(args.model)
+    tiles = reference_tiles(args.tile_size, args.tiles)
+    print(f"{'modes':<28}{'psnr_db':>10}{'min_psnr_db':>14}{'speedup':>10}")
+    for value in args.modes:
+        modes = parse_modes(value)
+        if "bf16" in modes and not bf16_supported():
+            print(f"{value:<28}  skipped: CPU has no native bfloat16 support")
+            continue
+        try:
+            result = quality_check(model, optimize(model, modes, tiles), tiles)
+        except Exception as err:
+            print(f"{value:<28}  failed: {err}")
+            continue
+        print(
+            f"{value:<28}{result['psnr_db']:>10}"
+            f"{result['min_psnr_db']:>14}{result['speedup']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
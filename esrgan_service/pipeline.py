@@ -0,0 +1,193 @@
+"""
+Decode, upscale and encode pipeline behind /upscale, without the HTTP layer.
+
+Kept apart from main.py, which loads the model on import, so benchmarks can run
+the same pipeline against any backend.
+"""
+
+import io
+import math
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from esrgan_service.tiling import OnTile, SubmitTile, pil_reader, upscale
+
+
+class InvalidImageError(ValueError):
+    """Raised when the input bytes cannot be decoded as an image"""
+
+
+@dataclass
+class OutputPlan:
+    # Native scale of the model to run, None when resizing is enough
+    model_scale: Optional[int]
+    # Size (width, height) the input is shrunk to before it is upscaled
+    input_size: Tuple[int, int]
+    # Size (width, height) of the image returned
+    output_size: Tuple[int, int]
+
+
+def plan_output(
+    width: int,
+    height: int,
+    model_scales: Sequence[int],
+    scale: Optional[float] = None,
+    target_width: Optional[int] = None,
+    target_height: Optional[int] = None,
+) -> OutputPlan:
+    """
+    How to produce the output a request asks for with the least inference.
+
+    The output is the input scaled by scale, or fitted within target_width and
+    target_height keeping the aspect ratio, never more than the largest model
+    scale; by default that largest scale. The smallest model reaching the
+    output size is used, and the input is shrunk first so that the model
+    synthesises barely more pixels than the output has. Outputs no larger than
+    the input need no model at all.
+    """
+    largest = max(model_scales)
+    fits = [
+        target / size
+        for target, size in ((target_width, width), (target_height, height))
+        if target
+    ]
+    factor = min(min(fits) if fits else scale or largest, largest)
+    output_size = (max(1, round(width * factor)), max(1, round(height * factor)))
+    if factor <= 1:
+        return OutputPlan(None, (width, height), output_size)
+
+    model_scale = min(s for s in model_scales if s >= factor)
+    input_size = (
+        min(width, math.ceil(output_size[0] / model_scale)),
+        min(height, math.ceil(output_size[1] / model_scale)),
+    )
+    return OutputPlan(model_scale, input_size, output_size)
+
+
+def encode_jpeg(image: Image.Image, spool_dir: Optional[str] = None) -> BinaryIO:
+    """JPEG-encode an image into an anonymous temporary file, rewound for reading"""
+    output = tempfile.TemporaryFile(dir=spool_dir)
+    image.save(output, format="JPEG")
+    output.seek(0)
+    return output
+
+
+def decode(image_data: bytes) -> Image.Image:
+    """Decode image bytes to RGB, raising InvalidImageError if they are no image"""
+    try:
+        return Image.open(io.BytesIO(image_data)).convert("RGB")
+    except Exception as err:
+        raise InvalidImageError("Invalid image data") from err
+
+
+def resize_image(
+    image_data: bytes,
+    output_size: Tuple[int, int],
+    spool_dir: Optional[str] = None,
+    timings: Optional[Dict[str, float]] = None,
+) -> BinaryIO:
+    """Decode, resize and JPEG-encode an image, for outputs needing no model"""
+    timings = {} if timings is None else timings
+
+    start = time.perf_counter()
+    image = decode(image_data)
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image = image.resize(output_size, Image.LANCZOS)
+    timings["resize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output = encode_jpeg(image, spool_dir)
+    timings["encode"] = time.perf_counter() - start
+    return output
+
+
+def process_image(
+    image_data: bytes,
+    submit: SubmitTile,
+    scale: int,
+    tile_size: int,
+    tile_pad: int,
+    window: int,
+    large: bool,
+    spool_dir: Optional[str] = None,
+    timings: Optional[Dict[str, float]] = None,
+    on_tile: Optional[OnTile] = None,
+    cancel: Optional[threading.Event] = None,
+    input_size: Optional[Tuple[int, int]] = None,
+    output_size: Optional[Tuple[int, int]] = None,
+) -> BinaryIO:
+    """
+    Decode, upscale and JPEG-encode an image. Blocking.
+
+    Returns the JPEG as an anonymous temporary file, rewound for reading. Large
+    images are upscaled into a memory-mapped canvas on disk rather than in RAM.
+    Seconds spent decoding, resizing, upscaling and encoding are stored in
+    timings, and on_tile is told about every finished tile. Setting cancel
+    stops the work between tiles with UpscaleCancelled. The image is shrunk to
+    input_size before it is upscaled, and the result resized to output_size,
+    as planned by plan_output.
+    """
+    timings = {} if timings is None else timings
+
+    start = time.perf_counter()
+    image = decode(image_data)
+    timings["decode"] = time.perf_counter() - start
+
+    if input_size is not None and image.size != tuple(input_size):
+        start = time.perf_counter()
+        image = image.resize(input_size, Image.LANCZOS)
+        timings["resize"] = time.perf_counter() - start
+
+    width, height = image.size
+    out_shape = (height * scale, width * scale)
+    with tempfile.TemporaryFile(dir=spool_dir) if large else nullcontext() as spool:
+        start = time.perf_counter()
+        if large:
+            # A fourth padding channel lets PIL encode straight from the mapping
+            print("Large image, upscaling into a memory-mapped canvas")
+            canvas = np.memmap(spool, np.uint8, "w+", shape=(*out_shape, 4))
+        else:
+            canvas = np.empty((*out_shape, 3), dtype=np.uint8)
+
+        print("Processing image with Real-ESRGAN...")
+        upscale(
+            pil_reader(image),
+            height,
+            width,
+            canvas,
+            submit,
+            scale,
+            tile_size,
+            tile_pad,
+            window,
+            on_tile,
+            cancel,
+        )
+        print(f"Processing complete, output shape: {canvas.shape}")
+        timings["inference"] = time.perf_counter() - start
+
+        if large:
+            output_image = Image.frombuffer(
+                "RGBX", out_shape[::-1], canvas, "raw", "RGBX", 0, 1
+            )
+        else:
+            output_image = Image.fromarray(canvas)
+        if output_size is not None and output_image.size != tuple(output_size):
+            # The model overshot by less than its scale; trim it to size
+            start = time.perf_counter()
+            output_image = output_image.resize(output_size, Image.LANCZOS)
+            timings["resize"] = timings.get("resize", 0) + time.perf_counter() - start
+
+        start = time.perf_counter()
+        output = encode_jpeg(output_image, spool_dir)
+        timings["encode"] = time.perf_counter() - start
+        return output
@@ -0,0 +1,105 @@
+"""
+Pre-fork pool of ESRGAN worker processes.
+
+The model is loaded once in the parent, then the workers are forked from it.
+Inference only reads the weights, so their memory pages stay shared between
+all workers (copy-on-write) instead of every process loading its own copy.
+
+The parent never runs the model on more than one thread, which would leave the
+workers hanging after fork. With an artifact directory, the model is built,
+optimized and checked in a short-lived process of its own, on every core, and
+the parent only loads the saved archive.
+"""
+
+import gc
+import multiprocessing
+import os
+import tempfile
+
+import torch
+from gunicorn.app.base import BaseApplication
+
+
+class PreforkPool(BaseApplication):
+    def __init__(self, workers: int, threads_per_worker: int, bind: str):
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.bind = bind
+        super().__init__()
+
+    def load_config(self):
+        self.cfg.set("bind", self.bind)
+        self.cfg.set("workers", self.workers)
+        self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+        self.cfg.set("preload_app", True)
+        self.cfg.set("post_fork", self.post_fork)
+        self.cfg.set("child_exit", self.child_exit)
+
+    def load(self):
+        # Load the model in the parent process; each worker only warms it up
+        from esrgan_service.main import (
+            ARTIFACT_DIR,
+            BACKEND,
+            INFERENCE_MODES,
+            app,
+            load_default_model,
+        )
+
+        if ARTIFACT_DIR and BACKEND == "torch" and "compile" not in INFERENCE_MODES:
+            builder = multiprocessing.get_context("spawn").Process(
+                target=build_artifact, name="artifact-builder"
+            )
+            builder.start()
+            builder.join()
+            self.drop_metrics(builder.pid)
+
+        # On one thread: OpenMP's thread pool does not survive fork, so workers
+        # of a parent that ran the model on several threads hang on their first
+        # forward pass once post_fork gives them more than one
+        torch.set_num_threads(1)
+        load_default_model()
+
+        # Keep the garbage collector from touching (and so copying) the pages
+        # of objects created so far in every forked worker
+        gc.freeze()
+        return app
+
+    def post_fork(self, server, worker):
+        # Split the cores between workers instead of each using all of them
+        torch.set_num_threads(self.threads_per_worker)
+        server.log.info(
+            f"Worker {worker.pid} using {self.threads_per_worker} torch threads"
+        )
+
+    def child_exit(self, server, worker):
+        self.drop_metrics(worker.pid)
+
+    @staticmethod
+    def drop_metrics(pid: int) -> None:
+        """Drop the gauges of a dead process from the aggregated metrics"""
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid)
+
+
+def build_artifact() -> None:
+    """
+    Build the default model and save it to the artifact directory, unless it is
+    there already. Runs in a fresh process, so its threads never reach the pool.
+    """
+    from esrgan_service.main import load_default_model
+
+    load_default_model()
+
+
+def run_pool(workers: int, bind: str = "0.0.0.0:8001") -> None:
+    threads_per_worker = int(
+        os.getenv(
+            "ESRGAN_THREADS_PER_WORKER", str(max(1, (os.cpu_count() or 1) // workers))
+        )
+    )
+    # Workers write their metrics here so /metrics can aggregate them; it must
+    # be set before prometheus_client is imported with the app
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="metrics-")
+    PreforkPool(workers, threads_per_worker, bind).run()
@@ -0,0 +1,161 @@
+"""
+Models loaded on first use and kept within a memory budget.
+
+A model is loaded by the first request that needs it, by whichever thread runs
+that request; requests for other models are not held up meanwhile. Loaded
+models count against a budget, and loading one that would exceed it unloads
+the least recently used models first. Models a request is running on, and the
+ones preloaded at startup, are never unloaded, so the budget is exceeded rather
+than a request failing when they alone take more.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List
+
+from esrgan_service.backends import InferenceBackend
+from esrgan_service.batching import TileBatcher
+from esrgan_service.metrics import MODEL_BYTES, MODEL_EVICTIONS, MODEL_LOADS
+from esrgan_service.models import MODELS, ModelSpec
+
+
+@dataclass
+class LoadedModel:
+    spec: ModelSpec
+    backend: InferenceBackend
+    batcher: TileBatcher
+    bytes: int = 0
+    # Requests running on the model, which keep it loaded
+    in_use: int = 0
+    pinned: bool = False
+    last_used: float = field(default_factory=time.time)
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        paths: Dict[str, str],
+        load: Callable[[ModelSpec, str], LoadedModel],
+        budget_bytes: int,
+    ):
+        """
+        paths maps each model name to its weights file, and load builds a model
+        from them. A budget of 0 keeps every model loaded once used.
+        """
+        self.paths = paths
+        self.load = load
+        self.budget = budget_bytes
+        self._loaded: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self._loading: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def used(self) -> int:
+        return sum(model.bytes for model in self._loaded.values())
+
+    def installed(self, name: str) -> bool:
+        return os.path.exists(self.paths[name])
+
+    def preload(self, name: str) -> LoadedModel:
+        """Load a model now and keep it loaded for good"""
+        with self.use(name) as model:
+            model.pinned = True
+        return model
+
+    @contextmanager
+    def use(self, name: str) -> Iterator[LoadedModel]:
+        """Load the model if needed and keep it loaded while the block runs"""
+        model = self._acquire(name)
+        try:
+            yield model
+        finally:
+            with self._lock:
+                model.in_use -= 1
+                model.last_used = time.time()
+
+    def _take(self, name: str) -> LoadedModel:
+        """The loaded model, marked in use; call with the lock held"""
+        model = self._loaded[name]
+        model.in_use += 1
+        model.last_used = time.time()
+        self._loaded.move_to_end(name)
+        return model
+
+    def _acquire(self, name: str) -> LoadedModel:
+        with self._lock:
+            if name in self._loaded:
+                return self._take(name)
+            loading = self._loading.setdefault(name, threading.Lock())
+
+        # One thread loads each model; others asking for it wait here
+        with loading:
+            with self._lock:
+                if name in self._loaded:
+                    return self._take(name)
+                # The weights file size stands in for the memory they will take
+                self._evict(os.path.getsize(self.paths[name]))
+
+            spec = MODELS[name]
+            print(f"Loading model {name} from {self.paths[name]}...")
+            start = time.perf_counter()
+            model = self.load(spec, self.paths[name])
+            model.bytes = model.backend.model_bytes()
+            print(
+                f"Loaded model {name} ({model.bytes >> 20} MB) in "
+                f"{time.perf_counter() - start:.1f}s"
+            )
+            MODEL_LOADS.labels(name).inc()
+            MODEL_BYTES.labels(name).set(model.bytes)
+
+            with self._lock:
+                self._loaded[name] = model
+                return self._take(name)
+
+    def _evict(self, incoming: int) -> None:
+        """Unload idle models, least recently used first, until incoming fits"""
+        if not self.budget:
+            return
+        while self.used + incoming > self.budget:
+            idle = [
+                name
+                for name, model in self._loaded.items()
+                if not model.in_use and not model.pinned
+            ]
+            if not idle:
+                print(
+                    f"Model memory budget of {self.budget >> 20} MB exceeded: "
+                    "the loaded models are all in use"
+                )
+                return
+            model = self._loaded.pop(idle[0])
+            model.batcher.close()
+            print(f"Unloaded model {idle[0]} to make room")
+            MODEL_EVICTIONS.labels(idle[0]).inc()
+            MODEL_BYTES.labels(idle[0]).set(0)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            models: List[Dict[str, Any]] = []
+            for name, spec in MODELS.items():
+                model = self._loaded.get(name)
+                models.append(
+                    {
+                        "name": name,
+                        "scale": spec.scale,
+                        "installed": self.installed(name),
+                        "loaded": model is not None,
+                        "bytes": model.bytes if model else 0,
+                        "in_use": model.in_use if model else 0,
+                        "pinned": model.pinned if model else False,
+                        "last_used": model.last_used if model else None,
+                    }
+                )
+            return {
+                "budget_bytes": self.budget,
+                "used_bytes": self.used,
+                "models": models,
+            }
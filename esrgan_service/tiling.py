@@ -0,0 +1,201 @@
+"""
+Tiled Real-ESRGAN inference.
+
+Follows RealESRGANer.enhance/tile_process step for step so the output is
+identical, but hands every padded tile to a submit function instead of running
+the model directly. That lets tiles from concurrent requests share batches.
+Input regions are read per tile and output tiles are written into a caller's
+canvas as 8-bit pixels, so no full-size float copy of the image ever exists.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, Deque, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Submit one CHW float32 tile for inference, returning the upscaled tile
+SubmitTile = Callable[[np.ndarray], "Future[np.ndarray]"]
+
+# Read the HWC uint8 region [y0:y1, x0:x1] of the input image
+ReadRegion = Callable[[int, int, int, int], np.ndarray]
+
+# Called with the number of tiles done and the total after every tile
+OnTile = Callable[[int, int], None]
+
+
+class UpscaleCancelled(Exception):
+    """Raised when an upscale is stopped through its cancel event"""
+
+
+@dataclass
+class Tile:
+    # Input region including the overlap padding
+    in_y0: int
+    in_y1: int
+    in_x0: int
+    in_x1: int
+    # Region of the upscaled tile to keep, relative to the tile
+    crop_y0: int
+    crop_y1: int
+    crop_x0: int
+    crop_x1: int
+    # Where the kept region goes in the output image
+    out_y0: int
+    out_y1: int
+    out_x0: int
+    out_x1: int
+
+
+def plan_tiles(
+    height: int, width: int, scale: int, tile_size: int, tile_pad: int
+) -> List[Tile]:
+    """Split an image into overlapping tiles; tile_size 0 means a single tile"""
+    if tile_size <= 0:
+        out_h, out_w = height * scale, width * scale
+        return [Tile(0, height, 0, width, 0, out_h, 0, out_w, 0, out_h, 0, out_w)]
+
+    tiles = []
+    tiles_x = -(-width // tile_size)
+    tiles_y = -(-height // tile_size)
+    for y in range(tiles_y):
+        for x in range(tiles_x):
+            start_x = x * tile_size
+            end_x = min(start_x + tile_size, width)
+            start_y = y * tile_size
+            end_y = min(start_y + tile_size, height)
+
+            pad_x0 = max(start_x - tile_pad, 0)
+            pad_x1 = min(end_x + tile_pad, width)
+            pad_y0 = max(start_y - tile_pad, 0)
+            pad_y1 = min(end_y + tile_pad, height)
+
+            crop_x0 = (start_x - pad_x0) * scale
+            crop_y0 = (start_y - pad_y0) * scale
+            tiles.append(
+                Tile(
+                    pad_y0,
+                    pad_y1,
+                    pad_x0,
+                    pad_x1,
+                    crop_y0,
+                    crop_y0 + (end_y - start_y) * scale,
+                    crop_x0,
+                    crop_x0 + (end_x - start_x) * scale,
+                    start_y * scale,
+                    end_y * scale,
+                    start_x * scale,
+                    end_x * scale,
+                )
+            )
+    return tiles
+
+
+def mod_padded_size(height: int, width: int, scale: int) -> Tuple[int, int]:
+    """Size after RealESRGANer's mod padding, which lets the model divide the image"""
+    mod_scale = {2: 2, 1: 4}.get(scale, 1)
+    return -(-height // mod_scale) * mod_scale, -(-width // mod_scale) * mod_scale
+
+
+def pil_reader(image: Image.Image) -> ReadRegion:
+    """Read regions of a decoded PIL image without converting it to numpy whole"""
+    return lambda y0, y1, x0, x1: np.asarray(image.crop((x0, y0, x1, y1)))
+
+
+def to_model_input(region: np.ndarray) -> np.ndarray:
+    """HWC uint8 image region to the CHW float32 layout the model expects"""
+    # RealESRGANer treats its input as BGR and swaps the channels; do the same
+    return np.ascontiguousarray(
+        np.transpose(region[:, :, ::-1].astype(np.float32) / 255, (2, 0, 1))
+    )
+
+
+def from_model_output(output: np.ndarray) -> np.ndarray:
+    """CHW float model output back to an HWC uint8 image region"""
+    output = np.clip(output, 0, 1)[::-1]
+    return (np.transpose(output, (1, 2, 0)) * 255.0).round().astype(np.uint8)
+
+
+def upscale(
+    read_region: ReadRegion,
+    height: int,
+    width: int,
+    canvas: np.ndarray,
+    submit: SubmitTile,
+    scale: int,
+    tile_size: int,
+    tile_pad: int,
+    window: int = 8,
+    on_tile: Optional[OnTile] = None,
+    cancel: Optional[threading.Event] = None,
+) -> None:
+    """
+    Upscale an RGB image tile by tile into canvas.
+
+    Input regions are read on demand and each upscaled tile is written straight
+    into canvas, which may be a memory-mapped file with extra channels beyond
+    RGB. At most window tiles are in flight at a time, which keeps enough work
+    queued for batching while memory stays bounded by the tile size. on_tile is
+    called as each tile is stitched in. Once cancel is set, UpscaleCancelled is
+    raised before the next tile is submitted or stitched, and tiles not yet
+    upscaled are dropped.
+    """
+    padded_h, padded_w = mod_padded_size(height, width, scale)
+    out_h, out_w = height * scale, width * scale
+    pending: Deque[Tuple[Tile, "Future[np.ndarray]"]] = deque()
+
+    def read_padded(tile: Tile) -> np.ndarray:
+        # Mod padding reflects the bottom/right edges, as RealESRGANer does
+        region = read_region(
+            tile.in_y0, min(tile.in_y1, height), tile.in_x0, min(tile.in_x1, width)
+        )
+        pad_h = max(tile.in_y1 - height, 0)
+        pad_w = max(tile.in_x1 - width, 0)
+        if pad_h or pad_w:
+            region = np.pad(region, ((0, pad_h), (0, pad_w), (0, 0)), mode="reflect")
+        return region
+
+    def stitch(tile: Tile, future: "Future[np.ndarray]") -> None:
+        # Drop whatever falls in the mod padding
+        keep_h = min(tile.out_y1, out_h) - tile.out_y0
+        keep_w = min(tile.out_x1, out_w) - tile.out_x0
+        if keep_h <= 0 or keep_w <= 0:
+            return
+        result = future.result()[
+            :,
+            tile.crop_y0 : tile.crop_y0 + keep_h,
+            tile.crop_x0 : tile.crop_x0 + keep_w,
+        ]
+        canvas[
+            tile.out_y0 : tile.out_y0 + keep_h, tile.out_x0 : tile.out_x0 + keep_w, :3
+        ] = from_model_output(result)
+
+    tiles = plan_tiles(padded_h, padded_w, scale, tile_size, tile_pad)
+    done = 0
+
+    def check_cancelled() -> None:
+        if cancel is not None and cancel.is_set():
+            raise UpscaleCancelled(f"Cancelled after {done} of {len(tiles)} tiles")
+
+    def stitch_next() -> None:
+        nonlocal done
+        check_cancelled()
+        stitch(*pending.popleft())
+        done += 1
+        if on_tile is not None:
+            on_tile(done, len(tiles))
+
+    try:
+        for tile in tiles:
+            check_cancelled()
+            pending.append((tile, submit(to_model_input(read_padded(tile)))))
+            if len(pending) >= window:
+                stitch_next()
+        while pending:
+            stitch_next()
+    finally:
+        for _, future in pending:
+            future.cancel()
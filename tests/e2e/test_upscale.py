@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import io
+import json
 import os
+import socket
+import struct
+import subprocess
+import sys
 import time
+import zlib
 
 import pytest
+import redis
 import requests
 from PIL import Image
 
+from esrgan_service.budget import estimate_request_bytes, fit_tile_size
+
 
 @pytest.fixture
 def image_path():
@@ -125,6 +134,13 @@ def test_image_upscale_async(image_path):
             if result_response.status_code != 200:
                 raise Exception(f"Failed to get result: {result_response.text}")
 
+            # Ranges of the result can be fetched on their own
+            range_response = requests.get(result_url, headers={"Range": "bytes=0-99"})
+            assert range_response.status_code == 206, "Range should be partial content"
+            assert (
+                range_response.content == result_response.content[:100]
+            ), "Range should match the start of the result"
+
             # Save and verify the result
             processed_image = Image.open(io.BytesIO(result_response.content))
             output_path = "tests/e2e/images/upscaled_bird_async.jpg"
@@ -196,3 +212,347 @@ def test_list_jobs(image_path):
     except Exception as e:
         print(f"Test failed: {str(e)}")
         raise
+
+
+def test_list_jobs_pages(image_path):
+    """Test paging through jobs with a cursor and filtering them by status"""
+    print("Starting test for paging through jobs...")
+
+    # Get API host and port from environment or use defaults
+    api_host = os.environ.get("API_HOST", "localhost")
+    api_port = os.environ.get("API_PORT", "8000")
+    jobs_url = f"http://{api_host}:{api_port}/jobs"
+
+    with open(image_path, "rb") as f:
+        image_data = f.read()
+    task_ids = []
+    for _ in range(3):
+        files = {"image": ("bird.jpg", image_data, "image/jpeg")}
+        response = requests.post(
+            f"http://{api_host}:{api_port}/upscale/async", files=files
+        )
+        assert response.status_code == 200, f"Failed to submit job: {response.text}"
+        task_ids.append(response.json()["task_id"])
+
+    # The newest tasks come first, two per page, without repeats
+    seen = []
+    cursor = None
+    while len(seen) < 3:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        page = requests.get(jobs_url, params=params).json()
+        assert len(page["jobs"]) <= 2, "Page is larger than the limit"
+        seen.extend(job["task_id"] for job in page["jobs"])
+        cursor = page["next_cursor"]
+        assert cursor or len(seen) >= 3, "Expected another page"
+    assert seen[:3] == task_ids[::-1], f"Expected {task_ids[::-1]}, got {seen}"
+
+    for status in ("pending", "completed"):
+        jobs = requests.get(jobs_url, params={"status": status}).json()["jobs"]
+        assert all(job["status"] == status for job in jobs), f"Not all {status}"
+
+    response = requests.get(jobs_url, params={"status": "unknown"})
+    assert response.status_code == 400, "Unknown status should be rejected"
+    print("Test completed successfully!")
+
+
+def test_list_jobs_same_score():
+    """Test that tasks created in the same instant are not skipped across pages"""
+    print("Starting test for paging through tasks with identical scores...")
+
+    # Get API and Redis hosts and ports from environment or use defaults
+    api_host = os.environ.get("API_HOST", "localhost")
+    api_port = os.environ.get("API_PORT", "8000")
+    jobs_url = f"http://{api_host}:{api_port}/jobs"
+    store = redis.Redis(
+        host=os.environ.get("REDIS_HOST", "localhost"),
+        port=int(os.environ.get("REDIS_PORT", "6379")),
+        password=os.environ.get("REDIS_PASSWORD") or None,
+    )
+
+    # A burst of tasks sharing one score, newer than any other task
+    score = time.time() + 3600
+    task_ids = [f"same-score-{i}-{time.time_ns()}" for i in range(5)]
+    for task_id in task_ids:
+        store.hset(f"task:{task_id}", mapping={"status": "pending", "created_at": ""})
+        store.zadd("tasks:index", {task_id: score})
+    try:
+        seen = []
+        cursor = None
+        for _ in range(3):
+            params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+            page = requests.get(jobs_url, params=params).json()
+            seen.extend(job["task_id"] for job in page["jobs"])
+            cursor = page["next_cursor"]
+        print(f"First three pages: {seen}")
+        assert sorted(seen[:5]) == sorted(task_ids), f"Tasks skipped: {seen}"
+        assert len(set(seen)) == len(seen), f"Tasks repeated: {seen}"
+    finally:
+        for task_id in task_ids:
+            store.delete(f"task:{task_id}")
+            store.zrem("tasks:index", task_id)
+    print("Test completed successfully!")
+
+
+def test_status_stream(image_path):
+    """Test that status changes are pushed until the task finishes"""
+    print("Starting test for streaming task status...")
+
+    # Get API host and port from environment or use defaults
+    api_host = os.environ.get("API_HOST", "localhost")
+    api_port = os.environ.get("API_PORT", "8000")
+
+    with open(image_path, "rb") as f:
+        files = {"image": ("bird.jpg", f.read(), "image/jpeg")}
+    response = requests.post(f"http://{api_host}:{api_port}/upscale/async", files=files)
+    assert response.status_code == 200, f"Failed to submit job: {response.text}"
+    task_id = response.json()["task_id"]
+
+    statuses = []
+    stream_url = f"http://{api_host}:{api_port}/status/{task_id}/stream"
+    with requests.get(stream_url, stream=True, timeout=600) as response:
+        assert response.status_code == 200, f"Failed to stream: {response.text}"
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("data: "):
+                event = json.loads(line[len("data: ") :])
+                statuses.append(event["status"])
+                print(f"Status: {statuses[-1]}")
+                if event["status"] == "processing":
+                    # Tile progress and ETA are reported while processing
+                    print(f"Progress: {event['progress']}, ETA {event['eta_seconds']}s")
+                    assert 0 <= event["progress"] <= 1
+                    assert event["eta_seconds"] >= 0
+    # The server ends the stream once the task is finished
+    assert statuses, "No status events received"
+    assert statuses[-1] == "completed", f"Task did not complete: {statuses}"
+
+    # Long polling a finished task answers right away
+    status_url = f"http://{api_host}:{api_port}/status/{task_id}"
+    response = requests.get(status_url, params={"wait": 30}, timeout=10)
+    assert response.json()["status"] == "completed"
+    print("Test completed successfully!")
+
+
+def test_cancel_task(image_path):
+    """Test that a job can be cancelled before it finishes, but only once"""
+    print("Starting test for cancelling a job...")
+
+    # Get API host and port from environment or use defaults
+    api_host = os.environ.get("API_HOST", "localhost")
+    api_port = os.environ.get("API_PORT", "8000")
+
+    # An image not upscaled before, so the job is not answered from the cache
+    image = Image.open(image_path).convert("RGB")
+    image.putpixel((0, 0), (int(time.time()) % 256, 0, 0))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    files = {"image": ("bird.jpg", buffer.getvalue(), "image/jpeg")}
+    response = requests.post(f"http://{api_host}:{api_port}/upscale/async", files=files)
+    assert response.status_code == 200, f"Failed to submit job: {response.text}"
+    task_id = response.json()["task_id"]
+
+    task_url = f"http://{api_host}:{api_port}/task/{task_id}"
+    response = requests.delete(task_url)
+    print(f"Cancel response: {response.status_code}")
+    assert response.status_code == 200, f"Failed to cancel: {response.text}"
+    assert response.json()["status"] == "cancelled"
+
+    response = requests.get(f"http://{api_host}:{api_port}/status/{task_id}")
+    assert response.json()["status"] == "cancelled"
+    response = requests.delete(task_url)
+    assert response.status_code == 409, "A cancelled task cannot be cancelled again"
+    print("Test completed successfully!")
+
+
+def test_image_upscale_output_size(image_path):
+    """Test that scale and target size options set the size of the output"""
+    print("Starting test for output size options...")
+
+    # Get API host and port from environment or use defaults
+    api_host = os.environ.get("API_HOST", "localhost")
+    api_port = os.environ.get("API_PORT", "8000")
+    url = f"http://{api_host}:{api_port}/upscale"
+
+    with open(image_path, "rb") as f:
+        image_data = f.read()
+    width, height = Image.open(io.BytesIO(image_data)).size
+
+    for params, expected in (
+        ({"scale": 2}, (width * 2, height * 2)),
+        ({"width": width * 3}, (width * 3, height * 3)),
+    ):
+        files = {"image": ("bird.jpg", image_data, "image/jpeg")}
+        response = requests.post(url, files=files, params=params, timeout=600)
+        assert response.status_code == 200, f"Failed to upscale: {response.text}"
+        size = Image.open(io.BytesIO(response.content)).size
+        print(f"{params}: {size}")
+        assert size == expected, f"Expected {expected}, got {size}"
+
+    files = {"image": ("bird.jpg", image_data, "image/jpeg")}
+    response = requests.post(url, files=files, params={"scale": 2, "width": 100})
+    assert response.status_code == 400, "scale and width together should be rejected"
+    print("Test completed successfully!")
+
+
+def test_image_upscale_model(image_path):
+    """Test that a request can name the model, and unknown models are rejected"""
+    print("Starting test for model selection...")
+
+    # Get API host and port from environment or use defaults
+    api_host = os.environ.get("API_HOST", "localhost")
+    api_port = os.environ.get("API_PORT", "8000")
+    url = f"http://{api_host}:{api_port}/upscale"
+
+    with open(image_path, "rb") as f:
+        image_data = f.read()
+    width, height = Image.open(io.BytesIO(image_data)).size
+
+    files = {"image": ("bird.jpg", image_data, "image/jpeg")}
+    params = {"model": "RealESRGAN_x4plus", "scale": 2}
+    response = requests.post(url, files=files, params=params, timeout=600)
+    assert response.status_code == 200, f"Failed to upscale: {response.text}"
+    size = Image.open(io.BytesIO(response.content)).size
+    print(f"{params}: {size}")
+    assert size == (width * 2, height * 2), f"Unexpected output size {size}"
+
+    files = {"image": ("bird.jpg", image_data, "image/jpeg")}
+    response = requests.post(url, files=files, params={"model": "no-such-model"})
+    print(f"Unknown model response: {response.status_code}")
+    assert response.status_code == 400, "An unknown model should be rejected"
+    print("Test completed successfully!")
+
+
+def test_rejected_uploads():
+    """Test that oversized and unsupported uploads are rejected by the API"""
+    print("Starting test for rejected uploads...")
+
+    # Get API host and port from environment or use defaults
+    api_host = os.environ.get("API_HOST", "localhost")
+    api_port = os.environ.get("API_PORT", "8000")
+
+    def encode(image, image_format):
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format)
+        return buffer.getvalue()
+
+    def png_claiming(width, height):
+        # A tiny PNG whose header claims the given size; only headers are read
+        data = bytearray(encode(Image.new("RGB", (1, 1)), "PNG"))
+        data[16:24] = struct.pack(">II", width, height)
+        data[29:33] = struct.pack(">I", zlib.crc32(bytes(data[12:29])))
+        return bytes(data)
+
+    uploads = {
+        "too many pixels": (png_claiming(20000, 20000), 413),
+        # Over the documented 10MB upload limit, whatever the image inside
+        "too many bytes": (
+            encode(Image.new("RGB", (64, 64)), "PNG") + bytes(11 * 1024 * 1024),
+            413,
+        ),
+        "unsupported format": (encode(Image.new("RGB", (64, 64)), "GIF"), 415),
+        "not an image": (b"not an image", 415),
+    }
+    for endpoint in ("upscale", "upscale/async"):
+        for name, (data, expected) in uploads.items():
+            files = {"image": ("upload.png", data, "image/png")}
+            response = requests.post(
+                f"http://{api_host}:{api_port}/{endpoint}", files=files
+            )
+            print(f"{endpoint}, {name}: {response.status_code}")
+            assert response.status_code == expected, response.text
+    print("Test completed successfully!")
+
+
+def test_small_images_fit_pool_budget():
+    """Test that images run whole on one process are tiled to fit a pool's share"""
+    mb = 1024 * 1024
+    # The default 3072 MB budget split between two pool workers
+    budget = 3072 * mb // 2
+    for side in (64, 300, 330, 360, 400, 1000):
+        tile_size = fit_tile_size(side, side, 4, 10, 8, True, 2048 * mb, 4, budget)
+        cost = estimate_request_bytes(side, side, 4, tile_size, 10, 8, True)
+        print(f"{side}x{side}: tile size {tile_size}, needs {cost // mb} MB")
+        assert cost <= budget, f"{side}x{side} needs {cost // mb} MB"
+    # Without a pool, small images still run whole
+    assert fit_tile_size(300, 300, 4, 10, 8, True, 2048 * mb, 4, 3072 * mb) == 0
+
+
+def test_worker_pool_smoke():
+    """Test that a pre-fork ESRGAN pool with several threads per worker serves requests"""
+    pytest.importorskip("torch")
+    model_path = os.environ.get("MODEL_PATH", "models/RealESRGAN_x4plus.pth")
+    if not os.path.exists(model_path):
+        pytest.skip(f"No model at {model_path}")
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = {
+        **os.environ,
+        "MODEL_PATH": model_path,
+        "ESRGAN_PORT": str(port),
+        "ESRGAN_WORKERS": "2",
+        "ESRGAN_THREADS_PER_WORKER": "2",
+        # The parent would run the model on several threads before forking
+        "OMP_NUM_THREADS": "4",
+        "ESRGAN_WARMUP_TILES": "64",
+    }
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    pool = subprocess.Popen(
+        [sys.executable, "-m", "esrgan_service"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        status = None
+        deadline = time.time() + 600
+        while status != "healthy" and time.time() < deadline:
+            assert pool.poll() is None, "The worker pool exited"
+            time.sleep(2)
+            try:
+                status = requests.get(f"{url}/health", timeout=5).json()["status"]
+            except requests.RequestException:
+                continue
+        print(f"Pool status: {status}")
+        assert status == "healthy", "The worker pool never finished warming up"
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (32, 32), (200, 100, 50)).save(buffer, format="PNG")
+        # Each may go to either worker
+        responses = [
+            requests.post(
+                f"{url}/upscale",
+                data=buffer.getvalue(),
+                headers={"Content-Type": "image/png"},
+                timeout=300,
+            )
+            for _ in range(2)
+        ]
+        for response in responses:
+            assert response.status_code == 200, response.text
+            assert Image.open(io.BytesIO(response.content)).size == (128, 128)
+    finally:
+        pool.terminate()
+        pool.wait(60)
+    print("Test completed successfully!")
+
+
+def test_cache_stats():
+    """Test that result cache statistics are exposed"""
+    print("Starting test for cache statistics...")
+
+    # Get API host and port from environment or use defaults
+    api_host = os.environ.get("API_HOST", "localhost")
+    api_port = os.environ.get("API_PORT", "8000")
+    stats_url = f"http://{api_host}:{api_port}/cache/stats"
+
+    response = requests.get(stats_url)
+    print(f"Cache stats response: {response.status_code}")
+    assert response.status_code == 200, f"Failed to get cache stats: {response.text}"
+
+    stats = response.json()
+    for field in ("hits", "misses", "coalesced", "evictions", "entries", "bytes"):
+        assert field in stats, f"Missing cache stat: {field}"
+    assert stats["bytes"] <= stats["max_bytes"], "Cache exceeds its size limit"
+    print("Test completed successfully!")
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Load generator for the upscaler API.
+
+Drives /upscale, or /upscale/async followed by /status polling and /result, at
+a fixed concurrency (closed loop) or request rate (open loop), then reports
+latency percentiles and error rates per endpoint, Redis commands per request
+and the API's memory use. Pair it with tests/load/stub_esrgan.py to measure
+the API and queue without a model:
+
+    python -m tests.load.loadgen --mode async --concurrency 20 --duration 60 \\
+        --redis-url redis://localhost:6379 --api-pid $(pgrep -f "uvicorn app.main")
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import random
+import statistics
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+
+@dataclass
+class Stats:
+    latencies: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    statuses: Dict[str, Counter] = field(default_factory=lambda: defaultdict(Counter))
+    completed: int = 0
+    failed: int = 0
+
+    def record(self, endpoint: str, started: float, status: object) -> None:
+        self.latencies[endpoint].append(time.perf_counter() - started)
+        self.statuses[endpoint][status] += 1
+
+
+class Images:
+    """JPEG uploads; unique by default so every request misses the result cache"""
+
+    def __init__(self, path: Optional[str], size: int, unique: bool):
+        self.unique = unique
+        self.counter = 0
+        if path:
+            with open(path, "rb") as f:
+                self.fixed: Optional[bytes] = f.read()
+        else:
+            self.fixed = None
+            self.base = Image.effect_noise((size, size), 64).convert("RGB")
+
+    def next(self) -> bytes:
+        if self.fixed is not None and not self.unique:
+            return self.fixed
+        if self.fixed is not None:
+            # Appending bytes after the end of the JPEG changes its hash only
+            self.counter += 1
+            return self.fixed + str(self.counter).encode()
+        self.counter += self.unique
+        buffer = io.BytesIO()
+        # The comment makes each upload's bytes, and so its cache key, unique
+        self.base.save(
+            buffer, format="JPEG", quality=95, comment=f"load {self.counter}"
+        )
+        return buffer.getvalue()
+
+
+async def run_sync(client: httpx.AsyncClient, stats: Stats, image: bytes) -> bool:
+    started = time.perf_counter()
+    try:
+        async with client.stream(
+            "POST", "/upscale", files={"image": ("load.jpg", image, "image/jpeg")}
+        ) as response:
+            async for _ in response.aiter_bytes():
+                pass
+        stats.record("POST /upscale", started, response.status_code)
+        return response.status_code == 200
+    except httpx.HTTPError as err:
+        stats.record("POST /upscale", started, type(err).__name__)
+        return False
+
+
+async def run_async(
+    client: httpx.AsyncClient,
+    stats: Stats,
+    image: bytes,
+    poll_interval: float,
+    job_timeout: float,
+) -> bool:
+    job_started = time.perf_counter()
+    try:
+        started = time.perf_counter()
+        response = await client.post(
+            "/upscale/async", files={"image": ("load.jpg", image, "image/jpeg")}
+        )
+        stats.record("POST /upscale/async", started, response.status_code)
+        if response.status_code != 200:
+            return False
+        task_id = response.json()["task_id"]
+
+        while True:
+            if time.perf_counter() - job_started > job_timeout:
+                stats.record("async job", job_started, "timeout")
+                return False
+            await asyncio.sleep(poll_interval)
+            started = time.perf_counter()
+            response = await client.get(f"/status/{task_id}")
+            stats.record("GET /status", started, response.status_code)
+            if response.status_code != 200:
+                return False
+            status = response.json()["status"]
+            if status == "completed":
+                break
+            if status.startswith("error") or status == "failed":
+                stats.record("async job", job_started, "failed")
+                return False
+
+        started = time.perf_counter()
+        async with client.stream("GET", f"/result/{task_id}") as response:
+            async for _ in response.aiter_bytes():
+                pass
+        stats.record("GET /result", started, response.status_code)
+        stats.record("async job", job_started, response.status_code)
+        return response.status_code == 200
+    except httpx.HTTPError as err:
+        stats.record("async job", job_started, type(err).__name__)
+        return False
+
+
+async def sample_rss(pid: int, samples: List[int], interval: float = 0.5) -> None:
+    """Append the RSS of a local process, in bytes, every interval seconds"""
+    while True:
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        samples.append(int(line.split()[1]) * 1024)
+        except OSError:
+            return
+        await asyncio.sleep(interval)
+
+
+async def redis_commands(redis: Redis) -> Optional[Counter]:
+    """Calls per Redis command since the server started, if the server says"""
+    try:
+        stats = await redis.info("commandstats")
+    except ResponseError:
+        return None
+    return Counter(
+        {name.replace("cmdstat_", ""): value["calls"] for name, value in stats.items()}
+    )
+
+
+async def generate_load(args: argparse.Namespace) -> Dict:
+    stats = Stats()
+    images = Images(args.image, args.image_size, not args.same_image)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits)
+
+    async def one_request() -> None:
+        image = images.next()
+        if args.mode == "async" or (args.mode == "mixed" and random.random() < 0.5):
+            ok = await run_async(client, stats, image, args.poll_interval, args.timeout)
+        else:
+            ok = await run_sync(client, stats, image)
+        if ok:
+            stats.completed += 1
+        else:
+            stats.failed += 1
+
+    redis = Redis.from_url(args.redis_url) if args.redis_url else None
+    commands_before = await redis_commands(redis) if redis else None
+    rss: List[int] = []
+    rss_task = (
+        asyncio.create_task(sample_rss(args.api_pid, rss)) if args.api_pid else None
+    )
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    issued = 0
+
+    def more() -> bool:
+        if args.requests:
+            return issued < args.requests
+        return time.perf_counter() < deadline
+
+    if args.rate:
+        # Open loop: start requests on a Poisson schedule, whatever the latency
+        in_flight = set()
+        while more():
+            if len(in_flight) < args.max_in_flight:
+                issued += 1
+                task = asyncio.create_task(one_request())
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+            else:
+                stats.statuses["client"]["skipped: max in flight"] += 1
+            await asyncio.sleep(random.expovariate(args.rate))
+        await asyncio.gather(*in_flight)
+    else:
+        # Closed loop: each of the workers sends its next request when done
+        async def worker() -> None:
+            nonlocal issued
+            while more():
+                issued += 1
+                await one_request()
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+    elapsed = time.perf_counter() - started
+    await client.aclose()
+    if rss_task:
+        rss_task.cancel()
+
+    report: Dict = {
+        "mode": args.mode,
+        "concurrency": None if args.rate else args.concurrency,
+        "rate": args.rate,
+        "elapsed_s": round(elapsed, 2),
+        "requests": issued,
+        "completed": stats.completed,
+        "failed": stats.failed,
+        "throughput_rps": round(stats.completed / elapsed, 2),
+        "endpoints": {},
+    }
+    for endpoint, latencies in stats.latencies.items():
+        latencies.sort()
+        statuses = stats.statuses[endpoint]
+        errors = sum(n for status, n in statuses.items() if status not in (200, 202))
+        report["endpoints"][endpoint] = {
+            "count": len(latencies),
+            "error_rate": round(errors / len(latencies), 4),
+            "statuses": {str(status): n for status, n in statuses.items()},
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p90_ms": round(percentile(latencies, 90) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "max_ms": round(latencies[-1] * 1000, 1),
+            "mean_ms": round(statistics.mean(latencies) * 1000, 1),
+        }
+    if stats.statuses["client"]:
+        report["client"] = dict(stats.statuses["client"])
+
+    if redis and commands_before is None:
+        print("Redis server does not report commandstats, skipping Redis counts")
+    elif redis:
+        commands = await redis_commands(redis) - commands_before
+        # Counts every client of the server, so the workers' commands are
+        # included; the info command itself is left out
+        commands.pop("info", None)
+        per_request = max(issued, 1)
+        report["redis"] = {
+            "commands_per_request": round(sum(commands.values()) / per_request, 2),
+            "by_command": {
+                name: round(calls / per_request, 2)
+                for name, calls in commands.most_common()
+            },
+        }
+    if redis:
+        await redis.aclose()
+    if rss:
+        report["api_rss_mb"] = {
+            "start": round(rss[0] / 2**20, 1),
+            "peak": round(max(rss) / 2**20, 1),
+            "end": round(rss[-1] / 2**20, 1),
+        }
+    return report
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def print_report(report: Dict) -> None:
+    print(
+        f"\n{report['requests']} requests in {report['elapsed_s']}s: "
+        f"{report['completed']} completed, {report['failed']} failed, "
+        f"{report['throughput_rps']} req/s"
+    )
+    print(
+        f"\n{'endpoint':<22}{'count':>7}{'errors':>8}"
+        f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    )
+    for endpoint, row in report["endpoints"].items():
+        print(
+            f"{endpoint:<22}{row['count']:>7}{row['error_rate']:>8.1%}"
+            f"{row['p50_ms']:>10}{row['p90_ms']:>10}{row['p99_ms']:>10}"
+            f"{row['max_ms']:>10}"
+        )
+        if set(row["statuses"]) - {"200", "202"}:
+            print(f"{'':<22}statuses: {row['statuses']}")
+    if "client" in report:
+        print(f"\nclient: {report['client']}")
+    if "redis" in report:
+        redis = report["redis"]
+        top = ", ".join(
+            f"{name} {calls}" for name, calls in list(redis["by_command"].items())[:8]
+        )
+        print(f"\nRedis commands per request: {redis['commands_per_request']} ({top})")
+    if "api_rss_mb" in report:
+        rss = report["api_rss_mb"]
+        print(
+            f"API RSS: {rss['start']} MB at start, {rss['peak']} MB peak, {rss['end']} MB at end"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--mode", choices=["sync", "async", "mixed"], default="sync")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="Requests per second (open loop)"
+    )
+    parser.add_argument("--max-in-flight", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=0,
+        help="Stop after this many (overrides duration)",
+    )
+    parser.add_argument("--image", help="Upload this file instead of generated images")
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument(
+        "--same-image",
+        action="store_true",
+        help="Send identical images, to measure the result cache",
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--redis-url", help="Count Redis commands on this server")
+    parser.add_argument("--api-pid", type=int, help="Sample this local process's RSS")
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(generate_load(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Stub ESRGAN service for load testing the API without a model.
+
+Speaks the same HTTP contract as esrgan_service (/upscale and its progress
+stream, /health, /ready) but only sleeps for a configurable time and returns a
+fixed-size body, so the API, queue and cache paths can be measured on any
+machine:
+
+    python -m tests.load.stub_esrgan --port 8001 --latency 0.5 --jitter 0.1 \\
+        --output-bytes 2000000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+from typing import AsyncIterator
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+# Seconds spent "upscaling", uniformly varied by up to +/- JITTER
+LATENCY = float(os.getenv("STUB_LATENCY", "0.5"))
+JITTER = float(os.getenv("STUB_JITTER", "0"))
+# Size of each response; OUTPUT_SCALE > 0 makes it that multiple of the upload
+OUTPUT_BYTES = int(os.getenv("STUB_OUTPUT_BYTES", str(1024 * 1024)))
+OUTPUT_SCALE = float(os.getenv("STUB_OUTPUT_SCALE", "0"))
+# Fraction of requests answered with a 500
+ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+# Requests handled at once; more get a 503 like a saturated ESRGAN service
+MAX_CONCURRENCY = int(os.getenv("STUB_MAX_CONCURRENCY", "0"))
+# Tiles reported when progress is requested
+TILES = int(os.getenv("STUB_TILES", "8"))
+
+CHUNK_SIZE = 256 * 1024
+
+app = FastAPI(title="Stub ESRGAN Service")
+in_flight = 0
+
+
+@app.get("/health")
+async def health_check():
+    return {"status": "healthy", "device": "stub", "in_flight": in_flight}
+
+
+@app.get("/ready")
+async def readiness_check():
+    if MAX_CONCURRENCY and in_flight >= MAX_CONCURRENCY:
+        raise HTTPException(503, "Busy", headers={"Retry-After": "1"})
+    return {"status": "ready"}
+
+
+@app.post("/upscale")
+async def upscale_image(request: Request, progress: bool = False):
+    global in_flight
+
+    if MAX_CONCURRENCY and in_flight >= MAX_CONCURRENCY:
+        raise HTTPException(503, "Busy", headers={"Retry-After": "1"})
+
+    in_flight += 1
+    try:
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+        if not received:
+            raise HTTPException(400, "Invalid image data")
+
+        latency = max(0.0, LATENCY + random.uniform(-JITTER, JITTER))
+        failed = random.random() < ERROR_RATE
+        if not progress:
+            await asyncio.sleep(latency)
+            if failed:
+                raise HTTPException(500, "Stub failure")
+    finally:
+        # A progress stream counts itself again once it starts, so a response
+        # that never starts (the client left) never holds a slot
+        in_flight -= 1
+
+    size = int(received * OUTPUT_SCALE) if OUTPUT_SCALE > 0 else OUTPUT_BYTES
+    # Starts like a JPEG; the rest is filler
+    body = b"\xff\xd8\xff\xe0" + bytes(max(0, size - 4))
+
+    async def chunks() -> AsyncIterator[bytes]:
+        for offset in range(0, len(body), CHUNK_SIZE):
+            yield body[offset : offset + CHUNK_SIZE]
+
+    if not progress:
+        return StreamingResponse(
+            chunks(),
+            media_type="image/jpeg",
+            headers={"Content-Length": str(len(body))},
+        )
+
+    async def progress_frames() -> AsyncIterator[bytes]:
+        # The latency is spent "upscaling" TILES tiles, reported like ESRGAN does
+        global in_flight
+        in_flight += 1
+        try:
+            for done in range(1, TILES + 1):
+                await asyncio.sleep(latency / TILES)
+                frame = {"tiles_done": done, "tiles_total": TILES}
+                yield json.dumps(frame).encode() + b"\n"
+        finally:
+            in_flight -= 1
+        if failed:
+            yield json.dumps({"error": "Stub failure", "status": 500}).encode() + b"\n"
+            return
+        yield json.dumps({"size": len(body)}).encode() + b"\n"
+        async for chunk in chunks():
+            yield chunk
+
+    return StreamingResponse(progress_frames(), media_type="application/x-ndjson")
+
+
+def main() -> None:
+    global LATENCY, JITTER, OUTPUT_BYTES, OUTPUT_SCALE, ERROR_RATE, MAX_CONCURRENCY
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=LATENCY)
+    parser.add_argument("--jitter", type=float, default=JITTER)
+    parser.add_argument("--output-bytes", type=int, default=OUTPUT_BYTES)
+    parser.add_argument("--output-scale", type=float, default=OUTPUT_SCALE)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY)
+    args = parser.parse_args()
+
+    LATENCY, JITTER = args.latency, args.jitter
+    OUTPUT_BYTES, OUTPUT_SCALE = args.output_bytes, args.output_scale
+    ERROR_RATE, MAX_CONCURRENCY = args.error_rate, args.max_concurrency
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()